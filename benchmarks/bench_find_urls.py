@@ -0,0 +1,82 @@
+"""Cost of extracting urls from chat messages, before and after the single-pass extractor
+
+Run with `python -m benchmarks.bench_find_urls`
+"""
+import random
+import timeit
+
+import tldextract
+
+from koabot.core.routing import find_urls
+from koabot.patterns import URL_PATTERN
+
+LINKS = [
+    "https://danbooru.donmai.us/posts/5123456?q=order%3Arank",
+    "https://www.pixiv.net/en/artworks/104523123",
+    "https://twitter.com/someartist/status/1650000000000000000?s=20",
+    "https://i.imgur.com/AbCdEf1.png",
+    "<https://www.youtube.com/watch?v=dQw4w9WgXcQ>",
+    "https://e621.net/posts/3999999",
+]
+WORDS = ("lol", "this", "is", "so", "good", "check", "out", "the", "new", "art", "from", "them", ":)",
+         "wait", "what", "omg", "lmao", "yes", "no", "maybe", "tomorrow", "stream", "at", "8pm")
+
+
+def make_message(rnd: random.Random, word_count: int, link_count: int) -> str:
+    words = [rnd.choice(WORDS) for _ in range(word_count)]
+    for _ in range(link_count):
+        words.insert(rnd.randrange(len(words) + 1), rnd.choice(LINKS))
+    return " ".join(words)
+
+
+def legacy_find_urls(string: str) -> list[tuple[str, str]]:
+    url_matches = []
+    escaping_url = False
+    i = 0
+    while i < len(string):
+        if string[i] == '<':
+            escaping_url = True
+            i += 1
+            continue
+
+        if (url_match := URL_PATTERN.match(string, i)):
+            url_match_end = url_match.end()
+            end_of_string = url_match_end >= len(string)
+            within_string = url_match_end < len(string)
+            if not escaping_url or end_of_string or (within_string and string[url_match_end] != '>'):
+                url_matches.append((url_match.group(), tldextract.extract(url_match.group()).fqdn))
+
+            i = url_match_end
+            continue
+
+        escaping_url = False
+        i += 1
+
+    return url_matches
+
+
+def main():
+    rnd = random.Random(123)
+    corpora = {
+        "short chat": [make_message(rnd, rnd.randint(3, 15), 0) for _ in range(200)],
+        "one link": [make_message(rnd, rnd.randint(0, 10), 1) for _ in range(200)],
+        "link dumps": [make_message(rnd, rnd.randint(0, 5), rnd.randint(5, 10)) for _ in range(200)],
+        "long text": [make_message(rnd, 300, 2) for _ in range(20)],
+    }
+
+    print(f"{'corpus':>12} {'char loop':>14} {'finditer':>14}")
+    for name, messages in corpora.items():
+        # both produce the same urls
+        assert [legacy_find_urls(m) for m in messages] == [list(find_urls(m)) for m in messages]
+
+        number = 20
+        legacy = timeit.timeit(lambda: [legacy_find_urls(m) for m in messages], number=number)
+        current = timeit.timeit(lambda: [list(find_urls(m)) for m in messages], number=number)
+
+        # per message, in microseconds
+        per_message = number * len(messages)
+        print(f"{name:>12} {legacy / per_message * 1e6:>12.1f}us {current / per_message * 1e6:>12.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Cost of hashing a gallery, before and after moving it to ImageHasher
+
+The legacy way blocks the event loop for the whole gallery, so the time the
+loop spends blocked is reported along with the total time.
+
+Run with `python -m benchmarks.bench_gallery_hashing`
+"""
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import imagehash
+import numpy as np
+from PIL import Image
+
+from koabot.core.imagehashing import ImageHasher
+
+GALLERY_SIZES = [2, 5, 10, 20]
+IMAGE_SIZE = (1200, 1600)
+
+
+def make_gallery(directory: Path, size: int) -> list[Path]:
+    rng = np.random.default_rng(size)
+    paths = []
+
+    for i in range(size):
+        pixels = rng.integers(0, 256, (IMAGE_SIZE[1] // 8, IMAGE_SIZE[0] // 8, 3), dtype=np.uint8)
+        path = Path(directory, f"{size}_{i}.png")
+        Image.fromarray(pixels).resize(IMAGE_SIZE).save(path)
+        paths.append(path)
+
+    return paths
+
+
+def legacy_hash(paths: list[Path]) -> None:
+    for hash_func in [imagehash.phash, imagehash.dhash, imagehash.average_hash, imagehash.colorhash]:
+        if hash_func != imagehash.colorhash:
+            hash_param = {'hash_size': 16}
+        else:
+            hash_param = {'binbits': 6}
+
+        for path in paths:
+            hash_func(Image.open(path), **hash_param)
+
+
+async def measure(hashing) -> tuple[float, float]:
+    """Run the hashing and return its total time along with the longest time the loop went unresponsive"""
+    longest_stall = 0
+    done = False
+
+    async def heartbeat():
+        nonlocal longest_stall
+        while not done:
+            before = time.perf_counter()
+            await asyncio.sleep(0.001)
+            longest_stall = max(longest_stall, time.perf_counter() - before)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0)
+
+    started_at = time.perf_counter()
+    await hashing()
+    elapsed = time.perf_counter() - started_at
+
+    done = True
+    await heartbeat_task
+    return elapsed, longest_stall
+
+
+async def main():
+    hasher = ImageHasher()
+    print(f"{'images':>6} {'legacy total':>13} {'legacy stall':>13} {'pool total':>11} {'pool stall':>11}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        # spawn the workers up front, to not bill their startup to the first gallery
+        await hasher.hash_files(make_gallery(Path(directory), hasher.workers))
+
+        for size in GALLERY_SIZES:
+            paths = make_gallery(Path(directory), size)
+
+            async def run_legacy():
+                legacy_hash(paths)
+
+            legacy_total, legacy_stall = await measure(run_legacy)
+            pool_total, pool_stall = await measure(lambda: hasher.hash_files(paths))
+
+            print(f"{size:>6} {legacy_total * 1e3:>11.0f}ms {legacy_stall * 1e3:>11.0f}ms "
+                  f"{pool_total * 1e3:>9.0f}ms {pool_stall * 1e3:>9.0f}ms")
+
+    hasher.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
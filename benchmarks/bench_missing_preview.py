@@ -0,0 +1,63 @@
+"""Cost of Board.post_is_missing_preview, before and after precompiling the tag rules
+
+Pass the path of a danbooru posts.json (i.e. saved from /posts.json?limit=200) to run it
+over real posts. Without one, posts shaped like danbooru's are generated.
+
+Run with `python -m benchmarks.bench_missing_preview [posts.json]`
+"""
+import json
+import random
+import sys
+import timeit
+
+from koabot.core.posts import parse_tag_string
+
+RULE_COUNTS = [10, 50, 200]
+
+
+def make_posts(count: int) -> list[dict]:
+    rng = random.Random(0)
+    vocabulary = [f"general_tag_{i}" for i in range(5000)]
+    return [{'id': i, 'is_banned': False, 'tag_string_general': " ".join(rng.sample(vocabulary, rng.randint(10, 60)))}
+            for i in range(count)]
+
+
+def list_contains(lst: list, items_to_be_matched: list) -> bool:
+    # as in koabot.core.utils
+    return not set(lst).isdisjoint(items_to_be_matched)
+
+
+def legacy_check(post: dict, rules: dict) -> bool:
+    return list_contains(post['tag_string_general'].split(), rules['no_preview_tags']['danbooru']) or post['is_banned']
+
+
+def compiled_check(post: dict, no_preview_tags: dict[str, frozenset[str]]) -> bool:
+    no_preview = no_preview_tags['danbooru']
+    return not no_preview.isdisjoint(parse_tag_string(post['tag_string_general'])) or post['is_banned']
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="UTF-8") as posts_file:
+            posts = [post for post in json.load(posts_file) if 'tag_string_general' in post]
+    else:
+        posts = make_posts(200)
+
+    print(f"{len(posts)} posts")
+    print(f"{'rules':>6} {'list_contains':>14} {'frozenset':>10}")
+
+    for rule_count in RULE_COUNTS:
+        rules = {'no_preview_tags': {'danbooru': [f"loli_{i}" for i in range(rule_count)]}}
+        no_preview_tags = {board: frozenset(tags) for board, tags in rules['no_preview_tags'].items()}
+
+        number = 200
+        legacy = timeit.timeit(lambda: [legacy_check(post, rules) for post in posts], number=number)
+        compiled = timeit.timeit(lambda: [compiled_check(post, no_preview_tags) for post in posts], number=number)
+
+        # per post, in microseconds
+        per_post = number * len(posts)
+        print(f"{rule_count:>6} {legacy / per_post * 1e6:>12.2f}us {compiled / per_post * 1e6:>8.2f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""Cost of finding the near-duplicates of an image, scanning every hash vs multi-index hashing
+
+Run with `python -m benchmarks.bench_nearduplicates`
+"""
+import random
+import timeit
+
+from koabot.core.nearduplicates import MultiIndexHash, hamming_distance
+
+INDEX_SIZES = [1_000, 10_000, 100_000]
+MAX_DISTANCE = 10
+
+
+def main():
+    rng = random.Random(0)
+    print(f"{'images':>7} {'linear scan':>12} {'multi-index':>12}")
+
+    for size in INDEX_SIZES:
+        phashes = [rng.getrandbits(256) for _ in range(size)]
+        index = MultiIndexHash(256, MAX_DISTANCE)
+        for i, phash in enumerate(phashes):
+            index.add(phash, i)
+
+        # half of the queries have a near-duplicate in the index
+        queries = [phashes[i] ^ (1 << i) for i in range(10)] + [rng.getrandbits(256) for _ in range(10)]
+
+        number = 5
+        linear = timeit.timeit(lambda: [[p for p in phashes if hamming_distance(q, p) <= MAX_DISTANCE]
+                                        for q in queries], number=number)
+        indexed = timeit.timeit(lambda: [index.search(q) for q in queries], number=number)
+
+        # per query, in microseconds
+        per_query = number * len(queries)
+        print(f"{size:>7} {linear / per_query * 1e6:>10.0f}us {indexed / per_query * 1e6:>10.1f}us")
+
+
+if __name__ == '__main__':
+    main()
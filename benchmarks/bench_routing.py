@@ -0,0 +1,48 @@
+"""Per-message cost of routing urls to their sites, before and after DomainRouter
+
+Run with `python -m benchmarks.bench_routing`
+"""
+import re
+import timeit
+
+from koabot.core.routing import DomainRouter
+
+SITE_COUNTS = [10, 50, 200]
+HOSTS = ["danbooru.donmai.us", "www.pixiv.net", "twitter.com", "i.imgur.com", "www.youtube.com"]
+
+
+def make_patterns(site_count: int) -> list[str]:
+    real_sites = ["*.donmai.us", "www.pixiv.net", "pixiv.net", "*twitter.com", "*.imgur.com", "e621.net"]
+    fillers = [f"*.site{i}.com" if i % 2 else f"www.site{i}.net" for i in range(site_count - len(real_sites))]
+    # the sites people actually link sit at the end, so the old scan has to go through everything
+    return fillers + real_sites
+
+
+def legacy_route(patterns: list[str], host: str) -> str | None:
+    for pattern in patterns:
+        if re.match(pattern, host):
+            return pattern
+    return None
+
+
+def main():
+    print(f"{'sites':>6} {'regex scan':>14} {'DomainRouter':>14}")
+
+    for site_count in SITE_COUNTS:
+        patterns = make_patterns(site_count)
+        legacy_patterns = [p.replace('.', r'\.').replace('*', '(.*?)') for p in patterns]
+
+        router = DomainRouter()
+        for pattern in patterns:
+            router.add(pattern, pattern)
+
+        number = 2000
+        legacy = timeit.timeit(lambda: [legacy_route(legacy_patterns, h) for h in HOSTS], number=number)
+        routed = timeit.timeit(lambda: [router.route(h) for h in HOSTS], number=number)
+
+        # per message of len(HOSTS) urls, in microseconds
+        print(f"{site_count:>6} {legacy / number * 1e6:>12.1f}us {routed / number * 1e6:>12.1f}us")
+
+
+if __name__ == '__main__':
+    main()
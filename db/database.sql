@@ -57,6 +57,28 @@ CREATE TABLE IF NOT EXISTS userAvatar (
     CONSTRAINT fk_userUserAvat FOREIGN KEY (userId) REFERENCES discordUser(userId)
 );
 
+CREATE TABLE IF NOT EXISTS boardPostHash (
+    board TEXT NOT NULL,
+    postId INTEGER NOT NULL,
+    -- md5 of the file that was hashed, to notice when a post's file is replaced
+    fileMd5 TEXT NOT NULL,
+    pHash TEXT NOT NULL,
+    dHash TEXT NOT NULL,
+    averageHash TEXT NOT NULL,
+    colorHash TEXT NOT NULL,
+    dateHashed TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT pk_boardPostHash PRIMARY KEY (board, postId)
+);
+
+-- where each blob of the blob store was downloaded from
+CREATE TABLE IF NOT EXISTS blobUrl (
+    url TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    CONSTRAINT pk_blobUrl PRIMARY KEY (url)
+);
+
+CREATE INDEX IF NOT EXISTS idx_blobUrl_digest ON blobUrl (digest);
+
 -- Glaring issue: wouldn't this too many entries?
 -- CREATE TABLE IF NOT EXISTS serverEmojiUsage (
 --     emusId integer NOT NULL,
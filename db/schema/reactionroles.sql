@@ -1,27 +1,41 @@
 CREATE TABLE IF NOT EXISTS reactionRoles (
     rrId INTEGER NOT NULL,
+    -- the message people react to, which is how binds are looked up
+    messageDId INTEGER NOT NULL UNIQUE,
+    channelDId INTEGER NOT NULL,
     isEnabled INTEGER DEFAULT TRUE,
     dateCreated TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
     CONSTRAINT pk_reactRole PRIMARY KEY (rrId)
 );
 
-CREATE TABLE IF NOT EXISTS discordServerRR (
-    rrId INTEGER NOT NULL,
-    serverId INTEGER NOT NULL,
-    CONSTRAINT pk_discServRR PRIMARY KEY (rrId, serverId),
-    CONSTRAINT fk_discRRid_discServRR FOREIGN KEY (rrId) REFERENCES reactionRoles(rrId),
-    CONSTRAINT fk_discServid_discServRR FOREIGN KEY (serverId) REFERENCES discordServer(serverId)
-);
-
 CREATE TABLE IF NOT EXISTS discordRole (
     roleId INTEGER NOT NULL,
     roleDId INTEGER NOT NULL UNIQUE,
     CONSTRAINT pk_discRole PRIMARY KEY (roleId)
 );
 
-CREATE TABLE IF NOT EXISTS rrRelationships (
+-- a set of reactions that grants a set of roles
+CREATE TABLE IF NOT EXISTS rrLink (
+    linkId INTEGER NOT NULL,
     rrId INTEGER NOT NULL,
+    CONSTRAINT pk_rrLink PRIMARY KEY (linkId),
+    CONSTRAINT fk_reactRoleid_rrLink FOREIGN KEY (rrId) REFERENCES reactionRoles(rrId)
+);
+
+CREATE INDEX IF NOT EXISTS idx_rrLink_rrId ON rrLink (rrId);
+
+CREATE TABLE IF NOT EXISTS rrLinkReaction (
+    linkId INTEGER NOT NULL,
+    -- unicode emoji, or <:name:id> for custom ones
+    reaction TEXT NOT NULL,
+    CONSTRAINT pk_rrLinkReact PRIMARY KEY (linkId, reaction),
+    CONSTRAINT fk_rrLinkid_rrLinkReact FOREIGN KEY (linkId) REFERENCES rrLink(linkId)
+);
+
+CREATE TABLE IF NOT EXISTS rrRelationships (
+    linkId INTEGER NOT NULL,
     roleId INTEGER NOT NULL,
-    CONSTRAINT fk_reactRoleid_rrRel FOREIGN KEY (rrId) REFERENCES reactionRoles(rrId),
+    CONSTRAINT pk_rrRel PRIMARY KEY (linkId, roleId),
+    CONSTRAINT fk_rrLinkid_rrRel FOREIGN KEY (linkId) REFERENCES rrLink(linkId),
     CONSTRAINT fk_discRoleid_rrRel FOREIGN KEY (roleId) REFERENCES discordRole(roleId)
 );
@@ -37,15 +37,29 @@ def set_base_directories(bot: KBot) -> None:
 
 async def create_database_schema(conn: aiosqlite.Connection) -> None:
     """Generate tables in database"""
-    schema = "db/database.sql"
-    with open(schema, encoding="UTF-8") as file:
-        sql_script = file.read()
+    schemas = ["db/database.sql", *sorted(str(path) for path in Path("db/schema").glob("*.sql"))]
 
     async with conn.cursor() as cursor:
-        await cursor.executescript(sql_script)
+        for schema in schemas:
+            with open(schema, encoding="UTF-8") as file:
+                sql_script = file.read()
+
+            await cursor.executescript(sql_script)
+
         await conn.commit()
 
 
+async def configure_database(conn: aiosqlite.Connection) -> None:
+    """Tune the database for a bot that writes often and reads while writing"""
+    # readers don't wait for writers, and commits don't wait for the disk to sync
+    await conn.execute("PRAGMA journal_mode = WAL")
+    await conn.execute("PRAGMA synchronous = NORMAL")
+    await conn.execute("PRAGMA temp_store = MEMORY")
+    # in KiB when negative
+    await conn.execute("PRAGMA cache_size = -16000")
+    await conn.execute("PRAGMA busy_timeout = 5000")
+
+
 def db_migration_setup(db_name: str) -> None:
     """Fixes the location of the database to DATA_DIR"""
     source = Path(CACHE_DIR, db_name)
@@ -63,6 +77,8 @@ def db_migration_setup(db_name: str) -> None:
 
 async def main():
     print(f"Starting {PROJECT_NAME}...")
+    # made here rather than at import, since the image hashing workers import this module too
+    bot = KBot(command_prefix='!', description='', intents=discord.Intents.all())
     bot.launch_time = datetime.utcnow()
     bot.debug_mode = ('--debug' in argv) or os.environ.get("KOABOT_DEBUG", False)
     set_base_directories(bot)
@@ -93,11 +109,11 @@ async def main():
     async with aiosqlite.connect(db_file) as conn, bot:
         bot.database_conn = conn
 
+        await configure_database(conn)
         await create_database_schema(conn)
         await bot.load_all_extensions()
         await bot.start(bot.koa['token'])
 
-bot = KBot(command_prefix='!', description='', intents=discord.Intents.all())
 
 if __name__ == '__main__':
     # Installs async optimizations for compatible systems
@@ -7,10 +7,15 @@ from discord.ext import commands
 
 import koabot.core.net as net_core
 import koabot.core.posts as post_core
-from koabot.core.utils import list_contains
+from koabot.core.batching import Batcher
+from koabot.core.ttlcache import MISSING, TTLCache
 from koabot.kbot import KBot
 
 
+# how many ids go in a single search, unless the board's api sets max_ids_per_search
+DEFAULT_MAX_IDS_PER_SEARCH = 100
+
+
 class Board(commands.Cog):
     """Board class"""
 
@@ -19,6 +24,31 @@ class Board(commands.Cog):
 
         self._danbooru_auth: aiohttp.BasicAuth = None
         self._e621_auth: aiohttp.BasicAuth = None
+        # (board, id search url) -> batcher
+        self._post_batchers: dict[tuple[str, str], Batcher[int, dict]] = {}
+        self.post_caches: dict[str, TTLCache[int, dict]] = {}
+        self.no_preview_tags: dict[str, frozenset[str]] = {}
+        self.compile_rules()
+
+    def compile_rules(self) -> None:
+        """Turn the tag rules of each board into sets that can be checked quickly.
+        Needs to be called again whenever the rules change"""
+        self.no_preview_tags = {board: frozenset(tags) for board, tags in self.bot.rules['no_preview_tags'].items()}
+
+    def get_post_cache(self, board: str) -> TTLCache[int, dict]:
+        """Get the cache of the recently seen posts of a board"""
+        if not (post_cache := self.post_caches.get(board)):
+            post_cache = self.post_caches[board] = TTLCache(**self.bot.koa.get('post_cache', {}))
+
+        return post_cache
+
+    def remember_posts(self, posts: list[dict] | dict, /, *, board: str) -> None:
+        """Keep posts that were fetched anyway, so that looking them up by id again doesn't need a request"""
+        post_cache = self.get_post_cache(board)
+
+        for post in posts if isinstance(posts, list) else [posts]:
+            if isinstance(post, dict) and 'id' in post:
+                post_cache.put(post['id'], post)
 
     @property
     def danbooru_auth(self) -> aiohttp.BasicAuth:
@@ -111,17 +141,117 @@ class Board(commands.Cog):
                     url = guide['api']['id_search_url'].format(post_id)
                     return await net_core.http_request(url, auth=self.danbooru_auth, json=True, err_msg=f"error fetching post #{post_id}")
                 elif tags:
-                    return await net_core.http_request(guide['api']['tag_search_url'], auth=self.danbooru_auth, jdata=jdata, headers={'Content-Type': 'application/json'}, json=True, err_msg=f"error fetching search: {tags}")
+                    return await net_core.http_request(guide['api']['tag_search_url'], auth=self.danbooru_auth, jdata=jdata, headers={'Content-Type': 'application/json'}, json=True, cache=not random, err_msg=f"error fetching search: {tags}")
             case 'e621':
                 headers = guide['api']['headers']  # e621 requires to know the User-Agent
                 if post_id:
                     url = guide['api']['id_search_url'].format(post_id)
                     return await net_core.http_request(url, auth=self.e621_auth, json=True, headers=headers, err_msg=f"error fetching post #{post_id}")
                 elif tags:
-                    return await net_core.http_request(guide['api']['tag_search_url'], auth=self.e621_auth, jdata=jdata, headers=headers, json=True, err_msg=f"error fetching search: {tags}")
+                    return await net_core.http_request(guide['api']['tag_search_url'], auth=self.e621_auth, jdata=jdata, headers=headers, json=True, cache=not random, err_msg=f"error fetching search: {tags}")
             case _:
                 raise ValueError(f"Board \"{board}\" can't be handled by the post searcher.")
 
+    async def search_posts_by_id(self, post_ids: list[int], /, *, board: str = 'danbooru', guide: dict) -> list[dict | None]:
+        """Fetch many posts with as few requests as possible, by searching for their ids together
+        Arguments:
+            post_ids::list[int]
+                The ids of the posts to fetch
+        Keywords:
+            board::str
+                Specify what board to search on. Default is 'danbooru'
+            guide::dict
+                The data which holds the board information
+
+        Returns:
+            The post of each id in the same order, or None for those that couldn't be found
+        """
+        post_cache = self.get_post_cache(board)
+        found: dict[int, dict] = {}
+        ids_to_fetch: list[int] = []
+
+        for post_id in dict.fromkeys(int(post_id) for post_id in post_ids):
+            if (cached_post := post_cache.get(post_id)) is None:
+                ids_to_fetch.append(post_id)
+            elif cached_post is not MISSING:
+                found[post_id] = cached_post
+
+        chunk_size: int = guide['api'].get('max_ids_per_search', DEFAULT_MAX_IDS_PER_SEARCH)
+
+        for i in range(0, len(ids_to_fetch), chunk_size):
+            chunk = ids_to_fetch[i:i + chunk_size]
+
+            if len(chunk) == 1:
+                # a single post has its own endpoint, which also sees posts hidden from searches
+                continue
+
+            tags = f"id:{','.join(str(post_id) for post_id in chunk)}"
+            if not (results := (await self.search_query(board=board, guide=guide, tags=tags, limit=len(chunk))).json):
+                continue
+
+            # e621 fix for broken API
+            if isinstance(results, dict):
+                results = results.get('posts', [])
+
+            results = [post for post in results if 'id' in post]
+            self.remember_posts(results, board=board)
+            found |= {post['id']: post for post in results}
+
+        # posts that searches leave out (i.e. deleted ones) are fetched on their own
+        for post_id in ids_to_fetch:
+            if post_id in found:
+                continue
+
+            response = await self.search_query(board=board, guide=guide, post_id=post_id)
+            if response.status == 404:
+                post_cache.put_missing(post_id)
+                continue
+
+            if not (post := response.json):
+                continue
+
+            # e621 fix for broken API
+            if 'post' in post:
+                post = post['post']
+
+            if 'id' in post:
+                self.remember_posts(post, board=board)
+                found[post_id] = post
+
+        return [found.get(int(post_id)) for post_id in post_ids]
+
+    async def get_post(self, post_id: int, /, *, board: str = 'danbooru', guide: dict) -> dict | None:
+        """Fetch a post. Posts asked for at about the same time, i.e. from several links in one message,
+        are fetched together with search_posts_by_id
+        Arguments:
+            post_id::int
+                The id of the post
+        Keywords:
+            board::str
+                Specify what board to search on. Default is 'danbooru'
+            guide::dict
+                The data which holds the board information
+        """
+        post_id = int(post_id)
+        post_cache = self.get_post_cache(board)
+
+        # recently seen posts don't need to wait for a batch
+        if post_id in post_cache:
+            cached_post = post_cache.get(post_id)
+            return cached_post if cached_post is not MISSING else None
+
+        # each guide gets its own batches, so that they're fetched with its own urls and headers
+        batcher_key = (board, guide['api']['id_search_url'])
+
+        if not (batcher := self._post_batchers.get(batcher_key)):
+            async def fetch_many(post_ids: list[int]) -> dict[int, dict]:
+                posts = await self.search_posts_by_id(post_ids, board=board, guide=guide)
+                return {post_id: post for post_id, post in zip(post_ids, posts) if post}
+
+            batcher = self._post_batchers[batcher_key] = Batcher(fetch_many)
+
+        return await batcher.get(post_id)
+
     async def send_posts(self, msg: discord.Message, posts, /, *, board: str = 'danbooru', guide: dict, show_nsfw: bool = True, max_posts: int = 4, show_posts_remaining: bool = True, reply: bool = False) -> None:
         """Handle sending posts retrieved from image boards
         Arguments:
@@ -150,6 +280,8 @@ class Board(commands.Cog):
         if not isinstance(posts, list):
             posts = [posts]
 
+        self.remember_posts(posts, board=board)
+
         if self.post_is_missing_preview(posts[0], board=board) and len(posts) == 1:
             embed = self.generate_embed(posts[0], board=board, guide=guide)
             embed.set_footer(text=guide['embed']['footer_text'],
@@ -298,11 +430,13 @@ class Board(commands.Cog):
             board::str
                 The board to check the rules with. Default is 'danbooru'
         """
+        no_preview_tags = self.no_preview_tags[board]
+
         match board:
             case 'e621':
-                return list_contains(post['tags']['general'], self.bot.rules['no_preview_tags'][board]) and post['rating'] != 's'
+                return not no_preview_tags.isdisjoint(post['tags']['general']) and post['rating'] != 's'
             case _:
-                return list_contains(post['tag_string_general'].split(), self.bot.rules['no_preview_tags'][board]) or post['is_banned']
+                return not no_preview_tags.isdisjoint(post_core.parse_tag_string(post['tag_string_general'])) or post['is_banned']
 
 
 async def setup(bot: KBot):
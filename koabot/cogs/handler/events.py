@@ -1,11 +1,9 @@
 """Bot events"""
-import re
 import sys
 import traceback
 from datetime import datetime
 
 import discord
-import tldextract
 from discord.ext import commands
 from mergedeep import merge
 
@@ -13,8 +11,10 @@ from koabot.cogs.botstatus import BotStatus
 from koabot.cogs.imageboard import ImageBoard
 from koabot.cogs.reactionroles import ReactionRoles
 from koabot.cogs.streamservice import StreamService
+from koabot.core.pipeline import PreviewJob, PreviewQueue, run_in_order
+from koabot.core.routing import DomainRouter, find_urls
 from koabot.kbot import KBot
-from koabot.patterns import COMMAND_PATTERN, URL_PATTERN
+from koabot.patterns import COMMAND_PATTERN
 
 
 class UrlMatch():
@@ -24,10 +24,11 @@ class UrlMatch():
 
 
 class MatchGroup():
-    def __init__(self, group, url, guide) -> None:
+    def __init__(self, group, url, guide, kind='gallery') -> None:
         self.url: str = url
         self.group: str = group
         self.guide: dict = guide
+        self.kind: str = kind
 
 
 class BotEvents(commands.Cog):
@@ -41,12 +42,21 @@ class BotEvents(commands.Cog):
         self.beta_bot_id = self.bot.koa['discord_user']['beta_id']
 
         self.match_groups: list[MatchGroup] = []
+        self.domain_router = DomainRouter()
         self.build_valid_urls()
 
+        self.preview_queue = PreviewQueue(**self.bot.koa.get('preview_queue', {}))
+
     @property
     def botstatus(self) -> BotStatus:
         return self.bot.get_cog('BotStatus')
 
+    async def cog_load(self):
+        self.preview_queue.start()
+
+    async def cog_unload(self):
+        self.preview_queue.stop()
+
     @property
     def imageboard(self) -> ImageBoard:
         return self.bot.get_cog('ImageBoard')
@@ -62,13 +72,13 @@ class BotEvents(commands.Cog):
     def build_valid_urls(self) -> None:
         """Guides stuff"""
         self.match_groups = []
+        self.domain_router = DomainRouter()
 
         for group, contents in self.bot.match_groups.items():
             for match in contents:
-                url_pattern = match['url']
-                url_pattern = url_pattern.replace(r'.', r'\.')
-                url_pattern = url_pattern.replace(r'*', r'(.*?)')
-                self.match_groups.append(MatchGroup(group, url_pattern, match['guide']))
+                match_group = MatchGroup(group, match['url'], match['guide'])
+                self.match_groups.append(match_group)
+                self.domain_router.add(match_group.url, match_group)
 
         for guide_type, v in self.bot.guides.items():
             for guide_name, guide_content in v.items():
@@ -120,6 +130,16 @@ class BotEvents(commands.Cog):
 
         await self.reactionroles.reaction_removed(payload, member)
 
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
+        """When all the reactions of a message are removed"""
+        self.reactionroles.reactions_cleared(payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload: discord.RawReactionClearEmojiEvent):
+        """When all the reactions with an emoji are removed from a message"""
+        self.reactionroles.reactions_cleared(payload.message_id, str(payload.emoji))
+
     # TODO: General error handler: https://gist.github.com/EvieePy/7822af90858ef65012ea500bcecf1612
     @commands.Cog.listener()
     async def on_command_error(self, ctx: commands.Context, error: commands.CommandError):
@@ -202,8 +222,11 @@ class BotEvents(commands.Cog):
 
         url_matches_found = self.find_urls(msg.content)
 
-        if (parsed_galleries := await self.parse_galleries(msg, url_matches_found, prefix_start)):
-            await self.send_previews(msg, parsed_galleries, not prefix_start)
+        if (parsed_galleries := self.parse_galleries(url_matches_found)):
+            # the same links sent again to a channel before being previewed get previewed only once
+            preview_key = (msg.channel.id, tuple(gallery.url for gallery in parsed_galleries))
+            self.preview_queue.put(msg.guild.id, preview_key,
+                                   lambda: self.send_previews(msg, parsed_galleries, not prefix_start, delete_original=prefix_start))
 
         # checking if a command has been issued
         if prefix_start:
@@ -260,81 +283,75 @@ class BotEvents(commands.Cog):
 
     def find_urls(self, string: str) -> list[UrlMatch]:
         """Finds all urls in a given string, ignoring those enclosed in <>"""
-        url_matches = []
-        escaping_url = False
-        i = 0
-        while i < len(string):
-            # check for urls, ignoring those with escaped embeds
-            if string[i] == '<':
-                escaping_url = True
-                i += 1
-                continue
+        return [UrlMatch(full_url, fqdn) for full_url, fqdn in find_urls(string)]
 
-            if (url_match := URL_PATTERN.match(string, i)):
-                url_match_end = url_match.end()
-                end_of_string = url_match_end >= len(string)
-                within_string = url_match_end < len(string)
-                if not escaping_url or end_of_string or (within_string and string[url_match_end] != '>'):
-                    full_url = url_match.group()
-                    fqdn = tldextract.extract(url_match.group()).fqdn
-                    url_matches.append(UrlMatch(full_url, fqdn))
-
-                i = url_match_end
+    def parse_galleries(self, url_matches: list[UrlMatch]) -> list[MatchGroup]:
+        """Find what to preview for each url, in the order they were found"""
+        parsed_galleries = []
+        for url_match in url_matches:
+            if not (match_group := self.domain_router.route(url_match.fqdn)):
                 continue
 
-            escaping_url = False
-            i += 1
-
-        return url_matches
+            for guide in match_group.guide:
+                guide_type = guide['type']
+                guide_name = guide['name']
 
-    async def parse_galleries(self, msg: discord.Message, url_matches: list[UrlMatch], delete_original) -> list[MatchGroup]:
-        parsed_galleries = []
-        for url_match in url_matches:
-            for match_group in self.match_groups:
-                # match() matches only from the start of the string
-                if not re.match(match_group.url, url_match.fqdn):
+                try:
+                    guide_content = self.bot.guides[guide_type][guide_name]
+                except KeyError as e:
+                    print(f'KeyError: "{e.args[0]}" is an undefined guide name or type.')
                     continue
 
-                for guide in match_group.guide:
-                    guide_type = guide['type']
-                    guide_name = guide['name']
+                match guide_type:
+                    case 'gallery':
+                        parsed_galleries.append(MatchGroup(match_group.group, url_match.full_url, guide_content))
+                    case 'stream' if match_group.group == 'picarto':
+                        parsed_galleries.append(MatchGroup(match_group.group, url_match.full_url, guide_content, 'stream'))
 
-                    try:
-                        guide_content = self.bot.guides[guide_type][guide_name]
-                    except KeyError as e:
-                        print(f'KeyError: "{e.args[0]}" is an undefined guide name or type.')
-                        continue
+        return parsed_galleries
 
-                    match guide_type:
-                        case 'gallery':
-                            parsed_galleries.append(MatchGroup(match_group.group, url_match.full_url, guide_content))
-                        case 'stream' if match_group.group == 'picarto':
-                            picarto_preview_shown = await self.streamservice.get_picarto_stream_preview(msg, url_match.full_url, orig_to_be_deleted=delete_original)
+    async def send_previews(self, msg: discord.Message, galleries: list[MatchGroup], only_if_missing: bool, *, delete_original: bool = False) -> None:
+        """Show the previews of all the links in a message at the same time, posting them in the order they were sent
+        Arguments:
+            msg::discord.Message
+                The message that sent the links
+            galleries::list[MatchGroup]
+                What to preview, as given by parse_galleries
+            only_if_missing::bool
+                Only shows a preview if the native embed is missing from the original link
+        Keywords:
+            delete_original::bool
+                Delete the original message once a stream preview has been shown. Default is False
+        """
+        imageboard = self.imageboard
+
+        # boards that can merge several links into one preview get all of theirs at once
+        combined_urls: dict[str, list[str]] = {}
+        for gallery in galleries:
+            if gallery.kind == 'gallery' and gallery.group in imageboard.combined_preview_boards:
+                combined_urls.setdefault(gallery.group, []).append(gallery.url)
+
+        jobs: list[PreviewJob] = []
+        stream_jobs: list[int] = []
+        combined_boards_queued: set[str] = set()
+        for gallery in galleries:
+            if gallery.kind == 'stream':
+                stream_jobs.append(len(jobs))
+                jobs.append(lambda m, g=gallery: self.streamservice.get_picarto_stream_preview(m, g.url, orig_to_be_deleted=delete_original))
+                continue
 
-                            if picarto_preview_shown and delete_original:
-                                await msg.delete()
+            if len(urls := combined_urls.get(gallery.group, [])) > 1:
+                if gallery.group not in combined_boards_queued:
+                    combined_boards_queued.add(gallery.group)
+                    jobs.append(lambda m, g=gallery, urls=urls: imageboard.show_combined_preview(m, urls, board=g.group, guide=g.guide, only_if_missing=only_if_missing))
+                continue
 
-                # done with this url
-                break
+            jobs.append(lambda m, g=gallery: imageboard.show_preview(m, g.url, board=g.group, guide=g.guide, only_if_missing=only_if_missing))
 
-        return parsed_galleries
+        results = await run_in_order(msg, jobs)
 
-    async def send_previews(self, msg: discord.Message, galleries: list[MatchGroup], only_if_missing: bool) -> None:
-        # post gallery only if there's one to show...
-        if len(galleries) == 1:
-            gallery = galleries[0]
-            await self.imageboard.show_preview(msg, gallery.url, board=gallery.group, guide=gallery.guide, only_if_missing=only_if_missing)
-
-        elif len(galleries) > 1:
-            common_domain = galleries[0].group
-            for parsed_gallery in galleries:
-                if parsed_gallery.group != common_domain:
-                    print("Skipping previews. The links sent do not belong to the same domain.")
-                    return
-
-            guide = galleries[0].guide
-            gallery_urls: list[str] = [m.url for m in galleries]
-            await self.imageboard.show_combined_preview(msg, gallery_urls, board=common_domain, guide=guide, only_if_missing=only_if_missing)
+        if delete_original and any(results[i] for i in stream_jobs):
+            await msg.delete()
 
     def command_was_issued(self, msg: discord.Message) -> bool:
         if (command_name_regex := COMMAND_PATTERN.search(msg.content)):
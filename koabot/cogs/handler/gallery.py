@@ -1,19 +1,27 @@
 """Handles the use of imageboard galleries"""
-import shutil
-from pathlib import Path
+import asyncio
 from typing import Literal
 
 import discord
-import imagehash
 from discord.ext import commands
-from PIL import Image
 
 import koabot.core.net as net_core
 import koabot.core.posts as post_core
 from koabot.cogs.botstatus import BotStatus
 from koabot.cogs.handler.board import Board
+from koabot.core.filecache import FileCache
+from koabot.core.imagehashing import ImageHashes, PostHashIndex, get_image_hasher
 from koabot.kbot import KBot
 
+# how many searches and downloads a single gallery can have going at once
+MAX_GALLERY_FAN_OUT = 4
+# images are hashed from the smallest of these that a post has, unless the board sets its own hash_quality
+DEFAULT_HASH_QUALITY = ['preview_file_url', 'large_file_url']
+# total hash distance up to which two posts are considered the same image
+DUPLICATE_SCORE = 10
+# total hash distance up to which a comparison is worth repeating with bigger images
+AMBIGUOUS_SCORE = 40
+
 
 class BooruParsedPost():
     def __init__(self, post_id, ext, filename, path) -> None:
@@ -21,8 +29,11 @@ class BooruParsedPost():
         self.ext = ext
         self.filename = filename
         self.path = path
-        self.hash = []
-        self.score = []
+        self.hash: ImageHashes = None
+        self.score: list[int] = []
+        # bytes downloaded to get its image, and how big the original file is
+        self.downloaded_size = 0
+        self.original_size = 0
 
 
 class Gallery(commands.Cog):
@@ -39,6 +50,93 @@ class Gallery(commands.Cog):
     def botstatus(self) -> BotStatus:
         return self.bot.get_cog('BotStatus')
 
+    def get_hash_tiers(self, board: str) -> list[list[str]]:
+        """Get the keys of the image urls of a post to hash, grouped by size from smallest to largest"""
+        board_assets = self.bot.assets[board]
+        hash_quality: list[str] = board_assets.get('hash_quality', DEFAULT_HASH_QUALITY)
+        return [[res_key] for res_key in hash_quality] + [board_assets['post_quality']]
+
+    async def cache_post(self, post: dict, /, *, res_keys: list[str], file_cache: FileCache,
+                         known_hashes: dict[int, ImageHashes]) -> BooruParsedPost | None:
+        """Make sure the image of a post is either cached or already hashed
+        Arguments:
+            post::dict
+                The post whose image is needed
+        Keywords:
+            res_keys::list[str]
+                Keys of the image urls to try, in order of preference
+            file_cache::FileCache
+                Cache to keep the image in
+            known_hashes::dict[int, ImageHashes]
+                Hashes of the posts that don't need their image anymore, by post id
+
+        Returns:
+            The parsed post, or None if its image couldn't be obtained
+        """
+        parsed_post: BooruParsedPost = None
+        for res_key in res_keys:
+            if res_key in post:
+                url_candidate = post[res_key]
+                if (file_ext := net_core.get_url_fileext(url_candidate)) in ['png', 'jpg', 'webp']:
+                    file_url = url_candidate
+                    file_name = f"{post['id']}_{res_key}.{file_ext}"
+                    file_path = file_cache.get_path(file_name)
+                    parsed_post = BooruParsedPost(post['id'], file_ext, file_name, file_path)
+                    break
+
+        if not parsed_post:
+            return None
+
+        if post['id'] in known_hashes:
+            parsed_post.hash = known_hashes[post['id']]
+        elif file_cache.get(file_name):
+            print(f"Post #{post['id']} is already cached.")
+        else:
+            print(f"Caching post #{post['id']}...")
+            if not await file_cache.download(file_name, file_url):
+                return None
+
+            parsed_post.downloaded_size = file_path.stat().st_size
+            parsed_post.original_size = post.get('file_size', parsed_post.downloaded_size)
+
+        return parsed_post
+
+    async def hash_posts(self, posts: list[dict], /, *, res_keys: list[str], file_cache: FileCache,
+                         fan_out: asyncio.Semaphore,
+                         known_hashes: dict[int, ImageHashes] = None) -> list[BooruParsedPost]:
+        """Get the hashes of the images of many posts at the same time
+        Arguments:
+            posts::list[dict]
+                The posts to hash
+        Keywords:
+            res_keys::list[str]
+                Keys of the image urls to try, in order of preference
+            file_cache::FileCache
+                Cache to keep the images in
+            fan_out::asyncio.Semaphore
+                Limits how many images are downloaded at once
+            known_hashes::dict[int, ImageHashes]
+                Hashes of the posts that don't need their image anymore, by post id
+
+        Returns:
+            The posts whose image could be hashed, in the same order
+        """
+        known_hashes = known_hashes or {}
+
+        async def limited_cache_post(post: dict) -> BooruParsedPost | None:
+            async with fan_out:
+                return await self.cache_post(post, res_keys=res_keys, file_cache=file_cache, known_hashes=known_hashes)
+
+        cached_posts = await asyncio.gather(*[limited_cache_post(post) for post in posts])
+        parsed_posts = [parsed_post for parsed_post in cached_posts if parsed_post]
+
+        unhashed_posts = [parsed_post for parsed_post in parsed_posts if not parsed_post.hash]
+        hashes = await get_image_hasher().hash_files([parsed_post.path for parsed_post in unhashed_posts])
+        for parsed_post, post_hashes in zip(unhashed_posts, hashes):
+            parsed_post.hash = post_hashes
+
+        return [parsed_post for parsed_post in parsed_posts if parsed_post.hash]
+
     async def display_static(self, msg: discord.Message, url: str, /, *, board: str = 'danbooru', guide: dict, only_if_missing: bool = False) -> None:
         """Display posts from a gallery in separate unmodifiable embeds
         Arguments:
@@ -67,7 +165,7 @@ class Gallery(commands.Cog):
             return
 
         board_cog = self.board
-        if not (post := (await board_cog.search_query(board=board, guide=guide, post_id=post_id)).json):
+        if not (post := await board_cog.get_post(post_id, board=board, guide=guide)):
             return
 
         safe_rating: list[Literal['g', 's']] = ['s']
@@ -76,8 +174,6 @@ class Gallery(commands.Cog):
         match board:
             case 'danbooru':
                 safe_rating = ['g', 's']
-            case 'e621':
-                post = post['post']  # e621 fix for broken API
 
         post_id: int = post['id']
 
@@ -131,14 +227,22 @@ class Gallery(commands.Cog):
         if isinstance(search, str):
             search = [search]
 
-        for s in search:
-            results = await board_cog.search_query(board=board, guide=guide, tags=s, include_nsfw=on_nsfw_channel)
+        fan_out = asyncio.Semaphore(MAX_GALLERY_FAN_OUT)
+
+        async def run_search(tags: str) -> list[dict]:
+            async with fan_out:
+                results = await board_cog.search_query(board=board, guide=guide, tags=tags, include_nsfw=on_nsfw_channel)
+
             results = results.json
 
             # e621 fix for broken API
             if 'posts' in results:
                 results = results['posts']
 
+            board_cog.remember_posts(results, board=board)
+            return results
+
+        for results in await asyncio.gather(*[run_search(s) for s in search]):
             posts.extend(results)
 
         # Rudimentary fix when NSFW results are returned and it's a safe channel (should actually revert at some point)
@@ -154,60 +258,74 @@ class Gallery(commands.Cog):
 
         parsed_posts: list[BooruParsedPost] = []
         if board == 'danbooru':
-            file_cache_dir = Path(self.bot.CACHE_DIR, board, "files")
-            file_cache_dir.mkdir(exist_ok=True)
+            file_cache = self.bot.file_caches.get(board)
+            hash_tiers = self.get_hash_tiers(board)
 
             test_posts: list[dict] = [post]
             test_posts.extend(posts)
+            test_posts_by_id = {test_post['id']: test_post for test_post in test_posts}
 
-            for test_post in test_posts:
-                should_cache = True
-                for res_key in self.bot.assets[board]['post_quality']:
-                    if res_key in test_post:
-                        url_candidate = test_post[res_key]
-                        if (file_ext := net_core.get_url_fileext(url_candidate)) in ['png', 'jpg', 'webp']:
-                            file_url = url_candidate
-                            file_name = f"{test_post['id']}.{file_ext}"
-                            file_path = Path(file_cache_dir, file_name)
-
-                            # TODO Add a hash check to verify if they should be redownloaded?
-                            if file_path.exists():
-                                should_cache = False
-                                file_path.touch()
-
-                            parsed_posts.append(BooruParsedPost(test_post['id'], file_ext, file_name, file_path))
-                            break
-
-                if should_cache:
-                    print(f"Caching post #{test_post['id']}...")
-                    image_bytes = await net_core.fetch_image(file_url)
-                    with open(file_path, 'wb') as image_file:
-                        shutil.copyfileobj(image_bytes, image_file)
-                else:
-                    print(f"Post #{test_post['id']} is already cached.")
+            # posts hashed before don't need to be downloaded again
+            hash_index = PostHashIndex(self.bot.database_conn)
+            known_hashes = await hash_index.get_many(board, test_posts)
+
+            # the smallest images are hashed first, falling back to bigger ones for posts that lack them
+            res_keys = [res_key for tier in hash_tiers for res_key in tier]
+            parsed_posts = await self.hash_posts(test_posts, res_keys=res_keys, file_cache=file_cache,
+                                                 fan_out=fan_out, known_hashes=known_hashes)
+            downloaded_posts = list(parsed_posts)
 
             print("Evaluating images...")
 
-            ground_truth = parsed_posts.pop(0)
-            for hash_func in [imagehash.phash, imagehash.dhash, imagehash.average_hash, imagehash.colorhash]:
-                if hash_func != imagehash.colorhash:
-                    hash_param = {'hash_size': 16}
-                else:
-                    hash_param = {'binbits': 6}
+            await hash_index.put_many(board, [(test_posts_by_id[parsed_post.id], parsed_post.hash)
+                                              for parsed_post in parsed_posts if parsed_post.id not in known_hashes])
 
-                ground_truth.hash.append(hash_func(Image.open(ground_truth.path), **hash_param))
+            for parsed_post in parsed_posts:
+                self.bot.duplicate_index.add((board, parsed_post.id), parsed_post.hash)
 
-                for parsed_post in parsed_posts:
-                    parsed_post.hash.append(hash_func(Image.open(parsed_post.path), **hash_param))
+            if parsed_posts and parsed_posts[0].id == post_id:
+                ground_truth = parsed_posts.pop(0)
 
-                    hash_diff = ground_truth.hash[-1] - parsed_post.hash[-1]
-                    parsed_post.score.append(hash_diff)
+                reposts = self.bot.duplicate_index.find_reposts((board, post_id), ground_truth.hash)
+                for (site, other_id), distance in reposts:
+                    print(f"Post #{post_id} looks like {site} post #{other_id} (distance {distance})")
+
+                for parsed_post in parsed_posts:
+                    parsed_post.score = ground_truth.hash.distance(parsed_post.hash)
+
+                # small images can make different posts look alike, so close calls are checked again with bigger ones
+                for tier_index in range(1, len(hash_tiers)):
+                    ambiguous_posts = {parsed_post.id: parsed_post for parsed_post in parsed_posts
+                                       if DUPLICATE_SCORE < sum(parsed_post.score) <= AMBIGUOUS_SCORE}
+                    if not ambiguous_posts:
+                        break
+
+                    print(f"Taking a closer look at {len(ambiguous_posts)} posts...")
+                    res_keys = [res_key for tier in hash_tiers[tier_index:] for res_key in tier]
+                    closer_posts = await self.hash_posts([post] + [test_posts_by_id[i] for i in ambiguous_posts],
+                                                         res_keys=res_keys, file_cache=file_cache, fan_out=fan_out)
+                    downloaded_posts.extend(closer_posts)
+
+                    if not closer_posts or closer_posts[0].id != post_id:
+                        break
+
+                    closer_truth = closer_posts.pop(0)
+                    for closer_post in closer_posts:
+                        ambiguous_posts[closer_post.id].score = closer_truth.hash.distance(closer_post.hash)
+
+                if downloaded_size := sum(parsed_post.downloaded_size for parsed_post in downloaded_posts):
+                    original_size = sum(parsed_post.original_size for parsed_post in downloaded_posts)
+                    print(f"Downloaded {downloaded_size / 2**10:,.0f} KiB to compare post #{post_id} "
+                          f"(instead of {original_size / 2**10:,.0f} KiB in originals)")
+            else:
+                # nothing to compare against if the linked post couldn't be downloaded
+                parsed_posts = []
 
             print(f'Scores for post #{post_id}')
 
             for parsed_post in parsed_posts:
                 print(f"#{parsed_post.id}", parsed_post.score)
-                if sum(parsed_post.score) <= 10:
+                if sum(parsed_post.score) <= DUPLICATE_SCORE:
                     posts = posts[1:]
 
         if first_post_missing_preview:
@@ -19,6 +19,8 @@ class ImageBoard(commands.Cog):
 
     def __init__(self, bot: KBot) -> None:
         self.bot = bot
+        # boards that show_combined_preview can handle
+        self.combined_preview_boards: set[str] = {'deviantart'}
 
     @property
     def board(self) -> Board:
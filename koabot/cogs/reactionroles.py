@@ -1,4 +1,5 @@
 """All about reaction roles"""
+import asyncio
 import json
 import re
 import timeit
@@ -7,21 +8,17 @@ from pathlib import Path
 
 import discord
 import emoji
-from dataclass_wizard import JSONSerializable, fromlist
-from dataclass_wizard.enums import LetterCase
 from discord.ext import commands
 
 from koabot.cogs.botstatus import BotStatus
+from koabot.core.reactionindex import ReactionIndex
+from koabot.core.ratelimit import SlidingWindowCooldown
+from koabot.core.reactionrolestore import ReactionRoleStore, RRLink
+from koabot.core.rolechanges import RoleChangeCoalescer
 from koabot.kbot import KBot
 from koabot.patterns import CHANNEL_URL_PATTERN, DISCORD_EMOJI_PATTERN
 
 
-@dataclass
-class RRLink():
-    reactions: set[str]
-    roles: list[int] = field(default_factory=list)
-
-
 @dataclass
 class RRBind():
     message_id: int
@@ -30,10 +27,7 @@ class RRBind():
 
 
 @dataclass
-class RRWatch(JSONSerializable):
-    class _(JSONSerializable.Meta):
-        key_transform_with_dump = LetterCase.SNAKE
-
+class RRWatch():
     channel_id: int
     links: list[RRLink] = field(default_factory=list)
 
@@ -45,12 +39,6 @@ class RRConfirmation():
     link: RRLink
 
 
-@dataclass
-class RRCooldown():
-    cooldown_start: float
-    change_count: int
-
-
 def is_guild_owner():
     """Demo custom check that checks whether or the caller is the owner"""
     def predicate(ctx: commands.Context):
@@ -66,9 +54,17 @@ class ReactionRoles(commands.Cog):
         self.rr_active_binds: dict[int, RRWatch] = {}
         self.rr_unsaved_binds: dict[int, RRBind] = {}
         self.rr_confirmations: dict[int, RRConfirmation] = {}
-        self.rr_cooldown: dict[int, RRCooldown] = {}
         self.spam_limit = 12
+        # users that go over the limit within two minutes are frozen for one
+        self.rr_cooldown = SlidingWindowCooldown(self.spam_limit, 120, penalty=60)
+        self.reaction_index = ReactionIndex()
+        self._indexing: dict[int, asyncio.Task] = {}
+        self._seed_task: asyncio.Task = None
+
+        self.rr_store = ReactionRoleStore(self.bot.database_conn)
+        self.role_changes = RoleChangeCoalescer(**self.bot.koa.get('role_changes', {}))
 
+        # binds used to be kept here before they moved to the database
         self.binds_file = Path(self.bot.DATA_DIR, "binds.json")
 
     @property
@@ -77,95 +73,104 @@ class ReactionRoles(commands.Cog):
 
     async def cog_load(self):
         await self.migrate_json_data()
-        self.verify_json_integrity()
-        self.load_rr_binds()
+        await self.load_rr_binds()
+        self._seed_task = asyncio.create_task(self.seed_reaction_index())
 
-    def load_rr_binds(self):
+    async def cog_unload(self):
+        self._seed_task.cancel()
+
+    async def load_rr_binds(self):
+        for message_id, (channel_id, links) in (await self.rr_store.get_all()).items():
+            self.add_rr_watch(message_id, channel_id, links)
+
+    async def migrate_json_data(self):
+        """Migrates all existing json data, if any"""
         if not self.binds_file.exists():
-            self.binds_file.touch()
             return
 
         with open(self.binds_file, 'r', encoding="UTF-8") as json_file:
-            data: dict = json.load(json_file)
+            data: dict = json.loads(json_file.read() or "{}")
 
-            for k, v in data.items():
-                message_id: int = int(k)
-                channel_id: int = int(v['channel_id'])
-                links: list[RRLink] = fromlist(RRLink, v['links'])
-                self.add_rr_watch(message_id, channel_id, links)
+        binds: dict[int, tuple[int, list[RRLink]]] = {}
+        for message_id, watch in data.items():
+            # older files spelled it in camel case
+            channel_id = int(watch.get('channel_id', watch.get('channelId')))
+            links = [RRLink(set(link['reactions']), [int(role_id) for role_id in link['roles']])
+                     for link in watch.get('links', [])]
+            binds[int(message_id)] = (channel_id, links)
 
-    def verify_json_integrity(self):
-        """Makes sure that all keys are of their proper type"""
-        if not self.binds_file.exists():
-            return
+        await self.rr_store.put_many(binds)
 
-        with open(self.binds_file, 'r+', encoding="UTF-8") as json_file:
-            data: dict = json.load(json_file)
+        # kept around just in case, but out of the way so it's only migrated once
+        self.binds_file.rename(self.binds_file.with_name(f"{self.binds_file.name}.migrated"))
+        print(f"Migrated {len(binds)} reaction role binds from {self.binds_file.name} to the database.")
 
-            # turn top level keys to ints
-            for message_id in list(data.keys()):
-                watch = data[message_id]
+    def get_watched_reactions(self, message_id: int) -> set[str]:
+        """Get every emoji bound to roles on a message"""
+        watched_reactions: set[str] = set()
 
-                try:
-                    channel_id = int(watch['channel_id'])
-                except KeyError:
-                    channel_id = int(watch['channelId'])
-                finally:
-                    watch['channel_id'] = channel_id
+        for link in self.rr_active_binds[message_id].links:
+            watched_reactions.update(link.reactions)
 
-                if not isinstance(message_id, int):
-                    data[int(message_id)] = watch
-                    data.pop(message_id)
+        return watched_reactions
 
-            serialized_data = json.dumps(data, indent=4)
-            json_file.seek(0)
-            json_file.write(serialized_data)
-            json_file.truncate()
+    async def seed_reaction_index(self) -> None:
+        """Learn who reacted to every bound message. Reaction events keep the index up to date afterwards"""
+        await self.bot.wait_until_ready()
 
-    async def migrate_json_data(self):
-        """Migrates all existing json data, if any"""
+        start_time = timeit.default_timer()
+        indexed = await asyncio.gather(*[self.index_message(message_id) for message_id in list(self.rr_active_binds)])
+        print(f"Indexed the reactions of {sum(indexed)}/{len(indexed)} reaction role messages "
+              f"in {timeit.default_timer() - start_time:0.2f}s.")
 
-    async def manage_roles(self, user: discord.Member, reaction: str,  message_id: int, channel_id: int):
-        """Updates the roles of the given user
-        Arguments:
-            user::discord.Member
-            reaction::str
-            message_id::int
-            channel_id::int
-        """
-        channel = self.bot.get_channel(channel_id)
-        message: discord.Message = await channel.fetch_message(message_id)
-        unique_message_reactions: set[str] = set()
+    async def index_message(self, message_id: int) -> bool:
+        """Make sure the reactions of a bound message are indexed. Returns whether they are"""
+        if message_id in self.reaction_index:
+            return True
 
-        for rct in message.reactions:
-            em: str = rct.emoji
-            if not isinstance(em, str):
-                em = str(em)
+        # events that arrive while a message is being fetched wait for it instead of fetching it again
+        if (task := self._indexing.get(message_id)) is None:
+            task = self._indexing[message_id] = asyncio.create_task(self._fetch_reactions(message_id))
+            task.add_done_callback(lambda _: self._indexing.pop(message_id, None))
 
-            unique_message_reactions.add(em)
+        await asyncio.shield(task)
+        return message_id in self.reaction_index
 
+    async def _fetch_reactions(self, message_id: int) -> None:
         watch: RRWatch = self.rr_active_binds[message_id]
 
-        unique_watch_reactions = set()
-        for link in watch.links:
-            unique_watch_reactions.update(link.reactions)
+        if not (channel := self.bot.get_channel(watch.channel_id)):
+            print(f"Couldn't find the channel of reaction role message {message_id}.")
+            return
 
-        reactions_in_use = unique_watch_reactions.intersection(unique_message_reactions)
-        reactions_by_currentuser: list[str] = []
+        try:
+            message: discord.Message = await channel.fetch_message(message_id)
+        except discord.HTTPException as e:
+            print(f"Couldn't fetch reaction role message {message_id}: {e}")
+            return
 
-        for rct in message.reactions:
-            if not isinstance(rct.emoji, str):
-                em = str(rct.emoji)
-            else:
-                em = rct.emoji
+        watched_reactions = self.get_watched_reactions(message_id)
+        reactions: dict[str, set[int]] = {}
 
-            if em not in reactions_in_use:
+        for rct in message.reactions:
+            if (em := str(rct.emoji)) not in watched_reactions:
                 continue
 
-            async for u in rct.users():
-                if u.id == user.id:
-                    reactions_by_currentuser.append(em)
-                    break
+            reactions[em] = {u.id async for u in rct.users()}
+
+        self.reaction_index.seed(message_id, reactions)
+
+    async def manage_roles(self, user: discord.Member, reaction: str,  message_id: int, channel_id: int):
+        """Updates the roles of the given user
+        Arguments:
+            user::discord.Member
+            reaction::str
+            message_id::int
+            channel_id::int
+        """
+        channel = self.bot.get_channel(channel_id)
+        watch: RRWatch = self.rr_active_binds[message_id]
+        reactions_by_currentuser = self.reaction_index.get_user_reactions(message_id, user.id)
 
         # match with links
         for link in watch.links:
@@ -179,8 +184,7 @@ class ReactionRoles(commands.Cog):
             role_removal = False
 
             if not link_fully_matches:
-                reactions_by_currentuser.append(reaction)
-                role_removal = link.reactions.issubset(reactions_by_currentuser)
+                role_removal = link.reactions.issubset(reactions_by_currentuser | {reaction})
 
                 if not role_removal:
                     continue
@@ -200,10 +204,10 @@ class ReactionRoles(commands.Cog):
         try:
             if remove_roles:
                 quote = f"{user.mention}, say goodbye to {role_string}..."
-                await user.remove_roles(*roles, reason="Requested by the own user by reacting")
+                await self.role_changes.remove_roles(user, roles, reason="Requested by the own user by reacting")
             else:
                 quote = f"Congrats, {user.mention}. You get the {role_string} {singular_or_plural_roles}!"
-                await user.add_roles(*roles, reason="Requested by the own user by reacting")
+                await self.role_changes.add_roles(user, roles, reason="Requested by the own user by reacting")
         except discord.Forbidden:
             print(f"Missing permissions to grant \"{user.name}\" roles on \"{user.guild.name}\"")
 
@@ -406,21 +410,9 @@ class ReactionRoles(commands.Cog):
             for reaction in link.reactions:
                 await target_message.add_reaction(reaction)
 
-        # TODO: Possible optimization: don't open the file twice if possible
-        # create file if it doesn't exist
-        if not self.binds_file.exists():
-            with open(self.binds_file, 'w', encoding="UTF-8") as json_file:
-                json_file.write("{}")
-
-        with open(self.binds_file, 'r+', encoding="UTF-8") as json_file:
-            new_watch = RRWatch(bind.channel_id, bind.links)
-
-            data: dict = json.load(json_file)
-            data[bind.message_id] = new_watch.to_dict()
+        await self.index_message(bind.message_id)
 
-            json_file.seek(0)
-            json_file.write(json.dumps(data, indent=4))
-            json_file.truncate()
+        await self.rr_store.put(bind.message_id, bind.channel_id, bind.links)
 
         self.rr_unsaved_binds.pop(bind_tag)
         await ctx.reply("Registration complete!", mention_author=False)
@@ -438,10 +430,20 @@ class ReactionRoles(commands.Cog):
         """When a reaction is added to a message"""
         # Handle reaction role
         if payload.message_id in self.rr_active_binds:
+            reaction = str(payload.emoji)
+
+            if reaction not in self.get_watched_reactions(payload.message_id):
+                return
+
+            if not await self.index_message(payload.message_id):
+                return
+
+            self.reaction_index.add(payload.message_id, reaction, user.id)
+
             if await self.manage_rr_cooldown(user):
                 return
 
-            await self.manage_roles(user, str(payload.emoji), payload.message_id, payload.channel_id)
+            await self.manage_roles(user, reaction, payload.message_id, payload.channel_id)
         # Handle confirmation
         elif payload.message_id in self.rr_confirmations:
             confirmation: RRConfirmation = self.rr_confirmations[payload.message_id]
@@ -474,47 +476,39 @@ class ReactionRoles(commands.Cog):
         """When a reaction is removed from a message"""
         # Handle reaction role
         if payload.message_id in self.rr_active_binds:
-            if await self.manage_rr_cooldown(user):
+            reaction = str(payload.emoji)
+
+            if reaction not in self.get_watched_reactions(payload.message_id):
                 return
 
-            await self.manage_roles(user, str(payload.emoji), payload.message_id, payload.channel_id)
+            if not await self.index_message(payload.message_id):
+                return
 
-    async def manage_rr_cooldown(self, user: discord.User) -> bool:
-        """Prevents users from overloading role requests"""
-        current_time = timeit.default_timer()
+            self.reaction_index.remove(payload.message_id, reaction, user.id)
 
-        if user.id not in self.rr_cooldown:
-            self.rr_cooldown[user.id] = RRCooldown(current_time, 0)
+            if await self.manage_rr_cooldown(user):
+                return
 
-        user_cooldown: RRCooldown = self.rr_cooldown[user.id]
-        time_diff = current_time - user_cooldown.cooldown_start
+            await self.manage_roles(user, reaction, payload.message_id, payload.channel_id)
 
-        # if too many reactions were sent
-        if user_cooldown.change_count > self.spam_limit:
-            if time_diff < 60:
-                return True
+    def reactions_cleared(self, message_id: int, reaction: str = None):
+        """When a moderator removes the reactions of a message, or every reaction with a given emoji"""
+        self.reaction_index.clear(message_id, reaction)
 
-            user_cooldown.cooldown_start = current_time
-            user_cooldown.change_count = 0
+    async def manage_rr_cooldown(self, user: discord.User) -> bool:
+        """Prevents users from overloading role requests"""
+        # changes made in quick succession weigh more
+        time_diff = self.rr_cooldown.seconds_since_last(user.id)
 
-        # refresh cooldown if two minutes have passed
-        if time_diff > 120:
-            user_cooldown.cooldown_start = current_time
-            user_cooldown.change_count = 0
+        if time_diff is None or time_diff >= 5:
+            cost = 1
         elif time_diff < 1:
-            user_cooldown.change_count += 3
-        elif time_diff < 5:
-            user_cooldown.change_count += 2
+            cost = 3
         else:
-            user_cooldown.change_count += 1
-
-        # send a warning and freeze if spammed
-        if user_cooldown.change_count > self.spam_limit:
-            user_cooldown.cooldown_start = current_time
-            # await user.send("Please wait a few moments and try again.")
-            return True
+            cost = 2
 
-        return False
+        # await user.send("Please wait a few moments and try again.")
+        return self.rr_cooldown.hit(user.id, cost)
 
     async def ask_to_overwrite_link(self, ctx: commands.Context, reactions: set[str], link: RRLink):
         new_em = " AND ".join(reactions)
@@ -537,6 +531,8 @@ class ReactionRoles(commands.Cog):
     def add_rr_watch(self, message_id: int, channel_id: int, links: list[RRLink]) -> None:
         """Starts keeping track of what messages have bound actions"""
         self.rr_active_binds[message_id] = RRWatch(channel_id, links)
+        # the bound emojis may have changed, so the message is indexed again on its next use
+        self.reaction_index.forget(message_id)
 
 
 async def setup(bot: KBot):
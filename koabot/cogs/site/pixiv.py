@@ -1,6 +1,4 @@
 import re
-import shutil
-from io import BytesIO
 from pathlib import Path
 
 import discord
@@ -8,6 +6,7 @@ import pixivpy_async
 
 import koabot.core.net as net_core
 import koabot.core.posts as post_core
+from koabot.core.imagehashing import PostHashIndex, get_image_hasher
 from koabot.core.site import Site
 from koabot.core.utils import strip_html_markup
 from koabot.kbot import KBot
@@ -18,7 +17,7 @@ class PixivHelper():
         self.files: list[discord.File] = []
         self.embeds: list[discord.Embed] = []
 
-    def add_file(self, fp: BytesIO | str, filename: str) -> None:
+    def add_file(self, fp: Path | str, filename: str) -> None:
         self.files.append(discord.File(fp=fp, filename=filename))
 
     def add_embed(self, embed: discord.Embed) -> None:
@@ -74,27 +73,34 @@ class SitePixiv(Site):
         text = re.sub(r'(twitter/([a-zA-Z0-9_]+))', r'[\1](https://www.twitter.com/\2)', text)
         return text
 
-    async def cache_image(self, url: str, filename: str, pixiv_helper: PixivHelper) -> None:
-        # create if pixiv cache directory if it doesn't exist
-        file_cache_dir = Path(self.bot.CACHE_DIR, "pixiv", "files")
-        file_cache_dir.mkdir(exist_ok=True)
-        image_path = Path(file_cache_dir, filename)
+    async def index_image(self, post_id: int, image_path: Path) -> None:
+        """Remember the hashes of an illustration, and log where else it has been seen"""
+        key = ('pixiv', post_id)
+        hash_index = PostHashIndex(self.bot.database_conn)
 
-        image_bytes = None
-        if not image_path.exists():
-            print("Saving to cache...")
-            image_bytes = await net_core.fetch_image(url, headers=self.bot.assets['pixiv']['headers'])
+        if not (hashes := (await hash_index.get_many('pixiv', [{'id': post_id}])).get(post_id)):
+            if not (hashes := await get_image_hasher().hash_file(image_path)):
+                return
+
+            await hash_index.put_many('pixiv', [({'id': post_id}, hashes)])
+
+        self.bot.duplicate_index.add(key, hashes)
+        for (site, other_id), distance in self.bot.duplicate_index.find_reposts(key, hashes):
+            print(f"Pixiv #{post_id} looks like {site} post #{other_id} (distance {distance})")
 
-            with open(image_path, 'wb') as image_file:
-                shutil.copyfileobj(image_bytes, image_file)
-            image_bytes.seek(0)
+    async def cache_image(self, url: str, filename: str, pixiv_helper: PixivHelper) -> Path | None:
+        file_cache = self.bot.file_caches.get('pixiv')
 
-        if image_bytes:
-            pixiv_helper.add_file(image_bytes, filename)
-            image_bytes.close()
+        if not (image_path := file_cache.get(filename)):
+            print("Saving to cache...")
+            headers = self.bot.assets['pixiv']['headers']
+            if not (image_path := await file_cache.download(filename, url, headers=headers)):
+                return print(f"Failed to download {filename}")
         else:
             print("Uploading from cache...")
-            pixiv_helper.add_file(image_path, filename)
+
+        pixiv_helper.add_file(image_path, filename)
+        return image_path
 
     async def get_pixiv_gallery(self, msg: discord.Message, url: str, /, *, only_if_missing: bool = False) -> None:
         """Automatically fetch and post any image galleries from pixiv
@@ -186,7 +192,11 @@ class SitePixiv(Site):
                     #     image_bytes.seek(0)
 
                 # cache file if it doesn't exist
-                await self.cache_image(img_url, filename, pixiv_helper)
+                image_path = await self.cache_image(img_url, filename, pixiv_helper)
+
+                # the cover is what gets reposted the most, so it's the one worth indexing
+                if i == 0 and image_path:
+                    await self.index_image(int(post_id), image_path)
 
                 if i + 1 >= min(total_to_preview, total_illust_pictures):
                     if total_illust_pictures > total_to_preview:
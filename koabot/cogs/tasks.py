@@ -48,6 +48,7 @@ class Tasks(commands.Cog):
         loops: list[tasks.Loop] = [
             self.change_presence_periodically,
             self.check_live_streamers,
+            self.collect_blob_garbage,
         ]
 
         for loop in loops:
@@ -79,6 +80,12 @@ class Tasks(commands.Cog):
 
         await discord.utils.sleep_until(next_run)
 
+    @tasks.loop(hours=6)
+    async def collect_blob_garbage(self) -> None:
+        """Removes the blobs nothing has used in a while, i.e. images that were only ever held in memory"""
+        if self.bot.blob_store:
+            await self.bot.blob_store.collect_garbage()
+
     @tasks.loop(minutes=5)
     async def lookup_pending_posts(self) -> None:
         """Search for booru posts periodically"""
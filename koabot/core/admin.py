@@ -68,6 +68,63 @@ class Admin(commands.Cog):
         """Mention a brief summary of the last used channel"""
         await ctx.reply(f"Last channel: {self.bot.last_channel}\nCurrent count there: {self.bot.last_channel_message_count}", mention_author=False)
 
+    @commands.hybrid_command(name="netstats", hidden=True)
+    @commands.is_owner()
+    async def network_stats(self, ctx: commands.Context, /):
+        """Show how the bot's outgoing requests are doing"""
+        net_session = self.bot.net_session
+        lines: list[str] = []
+
+        if net_session.retry_counts:
+            lines.append("Retries per host:")
+            for host, count in net_session.retry_counts.most_common(10):
+                lines.append(f"   {host}: {count}")
+        else:
+            lines.append("No requests have been retried.")
+
+        cache = net_session.response_cache
+        lines.append(f"Response cache: {cache.hits} hits, {cache.revalidations} revalidated, {cache.misses} misses")
+
+        flights = net_session.flights
+        lines.append(f"Identical requests collapsed: {flights.collapsed} (out of {flights.calls + flights.collapsed})")
+
+        await ctx.reply("\n".join(lines), mention_author=False)
+
+    @commands.hybrid_command(name="cachestats", hidden=True)
+    @commands.is_owner()
+    async def cache_stats(self, ctx: commands.Context, /):
+        """Show how full the file and post caches are"""
+        lines: list[str] = []
+
+        for namespace, cache in self.bot.file_caches:
+            lines.append(f"{namespace}: {len(cache)} files, {cache.total_bytes / 2**20:.1f}/{cache.max_bytes / 2**20:.0f} MiB, "
+                         f"{cache.hits} hits, {cache.misses} misses, {cache.evictions} evicted")
+
+        for board, post_cache in self.bot.get_cog('Board').post_caches.items():
+            lines.append(f"{board} posts: {len(post_cache)} cached, {post_cache.hit_rate:.0%} hit rate "
+                         f"({post_cache.hits} hits, {post_cache.negative_hits} known missing, {post_cache.misses} misses)")
+
+        if blob_store := self.bot.blob_store:
+            lines.append(f"Blob store: {blob_store.hits} downloads avoided, "
+                         f"{blob_store.deduplicated} duplicates shared, {blob_store.released} released")
+
+        await ctx.reply("\n".join(lines) or "No files have been cached.", mention_author=False)
+
+    @commands.hybrid_command(name="previewstats", hidden=True)
+    @commands.is_owner()
+    async def preview_stats(self, ctx: commands.Context, /):
+        """Show how the preview queue is keeping up"""
+        queue = self.bot.get_cog('BotEvents').preview_queue
+        lines = [f"Waiting: {queue.depth} (from {queue.guild_count} servers)",
+                 f"Completed: {queue.completed}, dropped: {queue.dropped}, "
+                 f"coalesced: {queue.coalesced}, expired: {queue.expired}, timed out: {queue.timed_out}"]
+
+        for name, times in [("Wait", queue.wait_times), ("Run", queue.run_times)]:
+            if times:
+                lines.append(f"{name} time: {sum(times) / len(times):0.2f}s average, {max(times):0.2f}s max")
+
+        await ctx.reply("\n".join(lines), mention_author=False)
+
     @commands.hybrid_command(name="sync", hidden=True)
     @commands.is_owner()
     async def sync_slash_commands(self, ctx: commands.Context):
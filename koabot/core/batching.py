@@ -0,0 +1,61 @@
+"""Grouping lookups that arrive at about the same time into a single request"""
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class Batcher(Generic[K, V]):
+    """Collects the keys asked for within a short window and looks them all up with one call.
+    Callers that ask for the same key share its result.
+    Arguments:
+        fetch_many::Callable
+            Coroutine function that takes a list of keys and returns a dict of the values found for them
+    Keywords:
+        window::float
+            Seconds to wait for more keys after the first one arrives. Default is 0.01
+    """
+
+    def __init__(self, fetch_many: Callable[[list[K]], Awaitable[dict[K, V]]], *, window: float = 0.01) -> None:
+        self.fetch_many = fetch_many
+        self.window = window
+        self._pending: dict[K, asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.keys_fetched = 0
+
+    async def get(self, key: K) -> V | None:
+        """Get the value of a key, or None if it wasn't found"""
+        if (future := self._pending.get(key)) is None:
+            if not self._pending:
+                asyncio.get_running_loop().call_later(self.window, self._flush)
+
+            future = self._pending[key] = asyncio.get_running_loop().create_future()
+
+        # shielded so one caller giving up doesn't cancel the lookup for everyone else
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        # the loop only keeps weak references to tasks
+        task = asyncio.create_task(self._fetch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, pending: dict[K, asyncio.Future]) -> None:
+        self.batches += 1
+        self.keys_fetched += len(pending)
+
+        try:
+            values = await self.fetch_many(list(pending))
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(values.get(key))
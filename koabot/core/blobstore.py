@@ -0,0 +1,207 @@
+"""Content-addressed storage of downloaded media"""
+import asyncio
+import hashlib
+import os
+import shutil
+import time
+from pathlib import Path
+
+import aiosqlite
+
+from koabot.core.httpcache import write_atomically
+
+HASH_CHUNK_SIZE = 2**16
+# how long a blob that no cache links to is kept around, in case its url comes up again
+DEFAULT_MAX_IDLE = 7 * 24 * 60 * 60
+
+
+def hash_file(path: Path) -> str:
+    """Get the sha256 digest of a file"""
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def link_or_copy(source: Path, destination: Path) -> None:
+    """Make destination point to the same contents as source, replacing it atomically if it exists"""
+    tmp_path = destination.with_name(f".{destination.name}.tmp")
+    tmp_path.unlink(missing_ok=True)
+
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        # filesystems without hardlinks, or a store on another device
+        shutil.copyfile(source, tmp_path)
+
+    os.replace(tmp_path, destination)
+
+
+class BlobStore():
+    """Files stored by the sha256 of their contents, so the same image is kept only once however many places use it.
+    Blobs live in <directory>/<digest[:2]>/<digest[2:4]>/<digest>, and the caches that use them hold hardlinks to them.
+    Which url each blob was downloaded from is remembered, to avoid downloading it again.
+    Arguments:
+        directory::Path
+            Where the blobs are kept
+        conn::aiosqlite.Connection
+            The connection to the database holding the blobUrl table
+    """
+
+    def __init__(self, directory: Path, conn: aiosqlite.Connection) -> None:
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.conn = conn
+
+        self.hits = 0
+        self.deduplicated = 0
+        self.released = 0
+
+    def get_path(self, digest: str) -> Path:
+        return Path(self.directory, digest[:2], digest[2:4], digest)
+
+    def get_inode_index(self) -> dict[int, str]:
+        """Get the digest of every blob by its inode, to recognize the files linked to them without hashing them.
+        Walks the whole store, so it's meant to be run in a thread"""
+        inodes: dict[int, str] = {}
+
+        for blob_path in self.directory.glob("??/??/*"):
+            if blob_path.name.startswith('.'):
+                continue
+
+            try:
+                inodes[blob_path.stat().st_ino] = blob_path.name
+            except FileNotFoundError:
+                continue
+
+        return inodes
+
+    async def get_by_url(self, url: str) -> Path | None:
+        """Get the blob that was downloaded from an url, if it's still around"""
+        async with self.conn.execute("SELECT digest FROM blobUrl WHERE url = ?", (url,)) as cursor:
+            if not (row := await cursor.fetchone()):
+                return None
+
+        path = self.get_path(row[0])
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            await self.conn.execute("DELETE FROM blobUrl WHERE url = ?", (url,))
+            await self.conn.commit()
+            return None
+
+        self.hits += 1
+        return path
+
+    async def read(self, url: str) -> bytes | None:
+        """Get the contents of the blob that was downloaded from an url"""
+        if not (path := await self.get_by_url(url)):
+            return None
+
+        try:
+            return await asyncio.to_thread(path.read_bytes)
+        except OSError:
+            return None
+
+    async def put_file(self, path: Path, url: str = None, *, digest: str = None) -> str:
+        """Store a downloaded file, turning it into a link to its blob. Returns its digest
+        Arguments:
+            path::Path
+                The file to store
+            url::str
+                Where the file was downloaded from
+        Keywords:
+            digest::str
+                The sha256 of the file, if it's already known
+        """
+        digest = digest or await asyncio.to_thread(hash_file, path)
+        blob_path = self.get_path(digest)
+
+        if blob_path.exists():
+            # a copy is already stored, so this one can share it
+            link_or_copy(blob_path, path)
+            self.deduplicated += 1
+        else:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(path, blob_path)
+
+        await self._remember_url(url, digest)
+        return digest
+
+    async def put_bytes(self, data: bytes, url: str = None) -> str:
+        """Store contents held in memory. Returns their digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.get_path(digest)
+
+        if not blob_path.exists():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(write_atomically, blob_path, data)
+        else:
+            self.deduplicated += 1
+
+        await self._remember_url(url, digest)
+        return digest
+
+    def link(self, digest: str, destination: Path) -> Path:
+        """Make a file elsewhere that holds the contents of a blob"""
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(self.get_path(digest), destination)
+        return destination
+
+    def release(self, digest: str) -> bool:
+        """Remove a blob once nothing links to it anymore. Returns whether it was removed.
+        Its urls are forgotten the next time they're looked up"""
+        blob_path = self.get_path(digest)
+
+        try:
+            if blob_path.stat().st_nlink > 1:
+                return False
+        except FileNotFoundError:
+            return False
+
+        blob_path.unlink(missing_ok=True)
+        self.released += 1
+        return True
+
+    async def _remember_url(self, url: str | None, digest: str) -> None:
+        if not url:
+            return
+
+        await self.conn.execute("INSERT OR REPLACE INTO blobUrl (url, digest) VALUES (?, ?)", (url, digest))
+        await self.conn.commit()
+
+    def _remove_unused(self, max_idle: float) -> list[str]:
+        removed: list[str] = []
+        oldest_allowed = time.time() - max_idle
+
+        for blob_path in self.directory.glob("??/??/*"):
+            if blob_path.name.startswith('.'):
+                # leftovers of an interrupted write
+                blob_path.unlink(missing_ok=True)
+                continue
+
+            stat = blob_path.stat()
+            if stat.st_nlink <= 1 and stat.st_mtime < oldest_allowed:
+                blob_path.unlink(missing_ok=True)
+                removed.append(blob_path.name)
+
+        return removed
+
+    async def collect_garbage(self, max_idle: float = DEFAULT_MAX_IDLE) -> int:
+        """Remove the blobs that no cache links to and that haven't been used in a while,
+        along with their urls. Returns how many were removed
+        Arguments:
+            max_idle::float
+                Seconds an unlinked blob is kept since it was last used. Default is a week
+        """
+        removed = await asyncio.to_thread(self._remove_unused, max_idle)
+
+        if removed:
+            await self.conn.executemany("DELETE FROM blobUrl WHERE digest = ?", [(digest,) for digest in removed])
+            await self.conn.commit()
+
+        return len(removed)
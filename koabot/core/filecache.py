@@ -0,0 +1,219 @@
+"""Size-bounded caches of downloaded files"""
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import koabot.core.net as net_core
+from koabot.core.blobstore import BlobStore
+
+DEFAULT_MAX_MB = 512
+
+
+class FileCache():
+    """Directory of cached files that evicts the least recently used ones once it goes over its budget.
+    The files are tracked in memory, so eviction never has to walk the directory.
+    Arguments:
+        directory::Path
+            Where the files are kept
+    Keywords:
+        max_bytes::int
+            How big the cache is allowed to grow. Default is 512 MiB
+        blob_store::BlobStore
+            Where downloads are deduplicated. The cached files become links to its blobs
+    """
+
+    def __init__(self, directory: Path, *, max_bytes: int = DEFAULT_MAX_MB * 2**20,
+                 blob_store: BlobStore = None) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.blob_store = blob_store
+        # file name -> size, least recently used first
+        self._files: OrderedDict[str, int] = OrderedDict()
+        # file name -> digest of its blob, for the files stored since startup
+        self._digests: dict[str, str] = {}
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def reconcile(self, blob_inodes: dict[int, str] = None) -> None:
+        """Rebuild the index from what's actually on disk, clearing leftovers of interrupted downloads.
+        Reads the whole directory, so it's best run in a thread when the cache is big
+        Arguments:
+            blob_inodes::dict[int, str]
+                The digest of each blob by inode, as returned by BlobStore.get_inode_index.
+                It's read from the blob store if needed and not given
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._files.clear()
+        self._digests.clear()
+        self.total_bytes = 0
+        found: list[tuple[float, str, int]] = []
+        linked: dict[str, int] = {}
+
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+
+                # temporary files that were never moved into place
+                if entry.name.startswith('.') and entry.name.endswith(('.part', '.tmp')):
+                    Path(entry.path).unlink(missing_ok=True)
+                    continue
+
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+
+                if stat.st_nlink > 1:
+                    linked[entry.name] = stat.st_ino
+
+        if self.blob_store and linked:
+            # a file and its blob are the same inode, so its digest is known without having to hash it
+            if blob_inodes is None:
+                blob_inodes = self.blob_store.get_inode_index()
+
+            for name, inode in linked.items():
+                if digest := blob_inodes.get(inode):
+                    self._digests[name] = digest
+
+        # files are touched on use, so their modification time is the last time they were used
+        for _, name, size in sorted(found):
+            self._files[name] = size
+            self.total_bytes += size
+
+        self.evict()
+
+    def get_path(self, name: str) -> Path:
+        return Path(self.directory, name)
+
+    def get(self, name: str) -> Path | None:
+        """Get the path of a cached file, marking it as recently used"""
+        if name not in self._files:
+            self.misses += 1
+            return None
+
+        path = self.get_path(name)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # removed behind our back
+            self._forget(name)
+            self.misses += 1
+            return None
+
+        self._files.move_to_end(name)
+        self.hits += 1
+        return path
+
+    def add(self, name: str) -> None:
+        """Track a file that has been written into the cache directory"""
+        try:
+            size = self.get_path(name).stat().st_size
+        except OSError:
+            return
+
+        self._forget(name)
+        self._files[name] = size
+        self.total_bytes += size
+        self.evict()
+
+    async def download(self, name: str, url: str, **kwargs) -> Path | None:
+        """Download a file into the cache
+        Arguments:
+            name::str
+                Name of the file in the cache
+            url::str
+                Where to download it from
+        Keywords:
+            Any keyword accepted by net_core.download_image
+        """
+        path = self.get_path(name)
+
+        digest: str = None
+
+        if self.blob_store and (blob_path := await self.blob_store.get_by_url(url)):
+            digest = blob_path.name
+            self.blob_store.link(digest, path)
+        else:
+            if not await net_core.download_image(url, path, **kwargs):
+                return None
+
+            if self.blob_store:
+                digest = await self.blob_store.put_file(path, url)
+
+        self.add(name)
+
+        if digest and name in self._files:
+            self._digests[name] = digest
+
+        return path
+
+    def evict(self) -> None:
+        """Remove the least recently used files until the cache is within budget"""
+        while self.total_bytes > self.max_bytes and len(self._files) > 1:
+            name, _ = next(iter(self._files.items()))
+            path = self.get_path(name)
+            digest = self._digests.get(name)
+            path.unlink(missing_ok=True)
+            self._forget(name)
+            self.evictions += 1
+
+            # otherwise the blob would keep taking up the space that was just freed
+            if digest and self.blob_store:
+                self.blob_store.release(digest)
+
+    def _forget(self, name: str) -> None:
+        self._digests.pop(name, None)
+
+        if (size := self._files.pop(name, None)) is not None:
+            self.total_bytes -= size
+
+
+class FileCaches():
+    """The file caches of every cog, each under its own namespace in the cache directory
+    Arguments:
+        cache_dir::Path
+            The bot's cache directory
+    Keywords:
+        max_mb::int
+            Budget of each namespace in MiB, unless set in namespaces. Default is 512
+        namespaces::dict[str, dict]
+            Settings of specific namespaces, i.e. {"danbooru": {"max_mb": 1024}}
+        blob_store::BlobStore
+            Store shared by all the namespaces to deduplicate their files
+    """
+
+    def __init__(self, cache_dir: Path, **kwargs) -> None:
+        self.cache_dir = cache_dir
+        self.blob_store: BlobStore = kwargs.get('blob_store')
+        self.max_mb: int = kwargs.get('max_mb', DEFAULT_MAX_MB)
+        self.namespaces: dict[str, dict] = kwargs.get('namespaces', {})
+        self._caches: dict[str, FileCache] = {}
+
+    def __iter__(self):
+        return iter(self._caches.items())
+
+    def reconcile_all(self) -> None:
+        """Load every namespace that has files on disk, evicting whatever is over budget.
+        Reads every cache directory, so it's meant to be run in a thread"""
+        blob_inodes = self.blob_store.get_inode_index() if self.blob_store else None
+
+        for files_dir in self.cache_dir.glob("*/files"):
+            if files_dir.is_dir():
+                self.get(files_dir.parent.name, blob_inodes)
+
+    def get(self, namespace: str, blob_inodes: dict[int, str] = None) -> FileCache:
+        """Get the cache of a namespace, reconciling it with the disk the first time it's used"""
+        if (cache := self._caches.get(namespace)) is None:
+            max_mb = self.namespaces.get(namespace, {}).get('max_mb', self.max_mb)
+            cache = FileCache(Path(self.cache_dir, namespace, "files"), max_bytes=max_mb * 2**20,
+                              blob_store=self.blob_store)
+            cache.reconcile(blob_inodes)
+            self._caches[namespace] = cache
+
+        return cache
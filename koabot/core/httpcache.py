@@ -0,0 +1,217 @@
+"""Cache for http responses"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+DEFAULT_MAX_DISK_MB = 64
+
+
+@dataclass
+class CacheEntry():
+    url: str
+    status: int
+    body: bytes
+    expires: float
+    etag: str | None = None
+    last_modified: str | None = None
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires
+
+    @property
+    def can_revalidate(self) -> bool:
+        return bool(self.etag or self.last_modified)
+
+
+class ResponseCache():
+    """In-memory LRU of responses backed by a directory on disk, which is itself kept within a budget.
+    The disk is only touched from worker threads, and reconcile must run once before the budget accounts for
+    the entries left by a previous run
+    Arguments:
+        cache_dir::Path | None
+            Where the entries are persisted. Nothing is written to disk if None
+    Keywords:
+        max_entries::int
+            How many entries are kept in memory. Default is 256
+        max_disk_bytes::int
+            How much space the entries can take on disk. Default is 64 MiB
+    """
+
+    def __init__(self, cache_dir: Path | None = None, *, max_entries: int = 256,
+                 max_disk_bytes: int = DEFAULT_MAX_DISK_MB * 2**20) -> None:
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        # key -> size on disk, least recently used first
+        self._disk_entries: OrderedDict[str, int] = OrderedDict()
+        self.disk_bytes = 0
+
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(method: str, url: str, params: dict = None, jdata: dict = None) -> str:
+        """Get the key that identifies a request"""
+        raw_key = json.dumps([method, url, params, jdata], sort_keys=True, default=str)
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+
+    def _get_paths(self, key: str) -> tuple[Path, Path]:
+        entry_dir = Path(self.cache_dir, key[:2])
+        return Path(entry_dir, f"{key}.json"), Path(entry_dir, f"{key}.body")
+
+    def reconcile(self) -> None:
+        """Rebuild the index of the entries on disk, removing the ones that expired and can't be revalidated.
+        Blocks while it goes through the directory"""
+        if not self.cache_dir:
+            return
+
+        self._disk_entries.clear()
+        self.disk_bytes = 0
+        found: list[tuple[float, str, int]] = []
+
+        for leftover_path in [*self.cache_dir.glob("??/.*.tmp"), *self.cache_dir.glob("??/*.body")]:
+            # interrupted writes, and bodies whose metadata never got written
+            if leftover_path.suffix == '.tmp' or not leftover_path.with_suffix('.json').exists():
+                leftover_path.unlink(missing_ok=True)
+
+        for meta_path in self.cache_dir.glob("??/*.json"):
+            key = meta_path.stem
+            _, body_path = self._get_paths(key)
+
+            try:
+                meta_stat = meta_path.stat()
+                size = meta_stat.st_size + body_path.stat().st_size
+                entry = CacheEntry(body=b"", **json.loads(meta_path.read_bytes()))
+            except (OSError, ValueError, TypeError):
+                self._unlink(key)
+                continue
+
+            if not entry.is_fresh and not entry.can_revalidate:
+                self._unlink(key)
+                continue
+
+            found.append((meta_stat.st_mtime, key, size))
+
+        # entries are touched on use, so their modification time is the last time they were used
+        for _, key, size in sorted(found):
+            self._disk_entries[key] = size
+            self.disk_bytes += size
+
+        self._unlink(*self._pop_over_budget())
+
+    async def get(self, key: str) -> CacheEntry | None:
+        """Get an entry, fresh or not, from memory or from disk"""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        if not self.cache_dir or (entry := await asyncio.to_thread(self._read, key)) is None:
+            return None
+
+        if not entry.is_fresh and not entry.can_revalidate:
+            # of no use anymore, the response has to be requested again anyway
+            self._forget_disk_entry(key)
+            await asyncio.to_thread(self._unlink, key)
+            return None
+
+        if key in self._disk_entries:
+            self._disk_entries.move_to_end(key)
+
+        self._remember(key, entry)
+        return entry
+
+    async def put(self, key: str, entry: CacheEntry) -> None:
+        """Store an entry in memory and on disk"""
+        self._remember(key, entry)
+
+        if not self.cache_dir:
+            return
+
+        size = await asyncio.to_thread(self._write, key, entry)
+
+        # the index is only ever changed from the event loop, the threads just get handed what to remove
+        self._forget_disk_entry(key)
+        self._disk_entries[key] = size
+        self.disk_bytes += size
+
+        if (evicted := self._pop_over_budget()):
+            await asyncio.to_thread(self._unlink, *evicted)
+
+    async def refresh(self, key: str, entry: CacheEntry, ttl: float) -> None:
+        """Extend the life of an entry that the server confirmed to be unchanged"""
+        entry.expires = time.time() + ttl
+        await self.put(key, entry)
+
+    def _read(self, key: str) -> CacheEntry | None:
+        meta_path, body_path = self._get_paths(key)
+        try:
+            with open(meta_path, encoding="UTF-8") as meta_file:
+                meta: dict = json.load(meta_file)
+            meta['body'] = body_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+
+        return CacheEntry(**meta)
+
+    def _write(self, key: str, entry: CacheEntry) -> int:
+        meta_path, body_path = self._get_paths(key)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+
+        meta = asdict(entry)
+        meta.pop('body')
+        meta_data = json.dumps(meta).encode()
+
+        # the body goes first so that metadata never points to a missing body
+        write_atomically(body_path, entry.body)
+        write_atomically(meta_path, meta_data)
+
+        return len(entry.body) + len(meta_data)
+
+    def _pop_over_budget(self) -> list[str]:
+        evicted: list[str] = []
+
+        while self.disk_bytes > self.max_disk_bytes and self._disk_entries:
+            key, size = self._disk_entries.popitem(last=False)
+            self.disk_bytes -= size
+            evicted.append(key)
+
+        return evicted
+
+    def _unlink(self, *keys: str) -> None:
+        for key in keys:
+            for path in self._get_paths(key):
+                path.unlink(missing_ok=True)
+
+    def _forget_disk_entry(self, key: str) -> None:
+        if (size := self._disk_entries.pop(key, None)) is not None:
+            self.disk_bytes -= size
+
+    def _remember(self, key: str, entry: CacheEntry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def write_atomically(path: Path, data: bytes) -> None:
+    """Write a file so that readers see either the old or the new contents, never half of them"""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(data)
+
+    os.replace(tmp_path, path)
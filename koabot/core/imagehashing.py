@@ -0,0 +1,179 @@
+"""Perceptual hashing of images away from the event loop"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import aiosqlite
+import imagehash
+from PIL import Image
+
+HASH_SIZE = 16
+COLORHASH_BINBITS = 6
+
+
+@dataclass
+class ImageHashes():
+    phash: imagehash.ImageHash
+    dhash: imagehash.ImageHash
+    average_hash: imagehash.ImageHash
+    colorhash: imagehash.ImageHash
+
+    def as_list(self) -> list[imagehash.ImageHash]:
+        return [self.phash, self.dhash, self.average_hash, self.colorhash]
+
+    def distance(self, other: 'ImageHashes') -> list[int]:
+        """Get the distance between each of the hashes of two images"""
+        return [mine - theirs for mine, theirs in zip(self.as_list(), other.as_list())]
+
+    def to_hex(self) -> tuple[str, str, str, str]:
+        return tuple(str(image_hash) for image_hash in self.as_list())
+
+    @classmethod
+    def from_hex(cls, phash: str, dhash: str, average_hash: str, colorhash: str) -> 'ImageHashes':
+        return cls(
+            phash=imagehash.hex_to_hash(phash),
+            dhash=imagehash.hex_to_hash(dhash),
+            average_hash=imagehash.hex_to_hash(average_hash),
+            colorhash=imagehash.hex_to_flathash(colorhash, COLORHASH_BINBITS))
+
+
+def compute_hashes(path: Path | str) -> ImageHashes:
+    """Decode an image once and compute all of its hashes from it"""
+    with Image.open(path) as img:
+        img.load()
+
+        return ImageHashes(
+            phash=imagehash.phash(img, hash_size=HASH_SIZE),
+            dhash=imagehash.dhash(img, hash_size=HASH_SIZE),
+            average_hash=imagehash.average_hash(img, hash_size=HASH_SIZE),
+            colorhash=imagehash.colorhash(img, binbits=COLORHASH_BINBITS))
+
+
+def try_compute_hashes(path: Path | str) -> ImageHashes | None:
+    """compute_hashes, but returns None for images that can't be read"""
+    try:
+        return compute_hashes(path)
+    except (OSError, ValueError) as e:
+        print(f"Couldn't hash {path}: {e}")
+        return None
+
+
+class ImageHasher():
+    """Computes image hashes in a pool of worker processes, so big galleries don't freeze the bot
+    Keywords:
+        workers::int
+            How many processes hash images at the same time. Default is the amount of cpus, up to 4
+    """
+
+    def __init__(self, **kwargs) -> None:
+        self.workers: int = kwargs.get('workers', min(os.cpu_count() or 1, 4))
+        self._executor: ProcessPoolExecutor = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # processes are only spawned the first time something needs hashing
+        if not self._executor:
+            # forking a process that already runs threads (aiosqlite, to_thread) can deadlock the children,
+            # so the workers start from a clean process instead
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(start_method))
+
+        return self._executor
+
+    async def hash_file(self, path: Path | str) -> ImageHashes | None:
+        """Get the hashes of an image, or None if it couldn't be read"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, try_compute_hashes, path)
+
+    async def hash_files(self, paths: list[Path | str]) -> list[ImageHashes | None]:
+        """Get the hashes of many images at the same time, in the same order as the paths"""
+        return await asyncio.gather(*[self.hash_file(path) for path in paths])
+
+    def close(self) -> None:
+        """Shut down the worker processes"""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class PostHashIndex():
+    """Hashes of board posts stored in the database, so each post is only downloaded and hashed once
+    Arguments:
+        conn::aiosqlite.Connection
+            The connection to the database holding the boardPostHash table
+    """
+
+    def __init__(self, conn: aiosqlite.Connection) -> None:
+        self.conn = conn
+
+    async def get_many(self, board: str, posts: list[dict]) -> dict[int, ImageHashes]:
+        """Get the stored hashes of posts, by post id. Posts whose file changed since they were hashed are left out
+        Arguments:
+            board::str
+                The board the posts are from
+            posts::list[dict]
+                The posts as returned by the board, with their 'id' and 'md5'
+        """
+        if not posts:
+            return {}
+
+        md5s = {post['id']: post.get('md5', '') for post in posts}
+        query = f"""SELECT postId, fileMd5, pHash, dHash, averageHash, colorHash FROM boardPostHash
+            WHERE board = ? AND postId IN ({', '.join('?' * len(md5s))})"""
+
+        async with self.conn.execute(query, (board, *md5s)) as cursor:
+            rows = await cursor.fetchall()
+
+        return {post_id: ImageHashes.from_hex(*hex_hashes) for post_id, md5, *hex_hashes in rows if md5s[post_id] == md5}
+
+    async def get_all(self) -> list[tuple[str, int, ImageHashes]]:
+        """Get the board, post id and hashes of every stored post"""
+        query = "SELECT board, postId, pHash, dHash, averageHash, colorHash FROM boardPostHash"
+
+        async with self.conn.execute(query) as cursor:
+            rows = await cursor.fetchall()
+
+        return [(board, post_id, ImageHashes.from_hex(*hex_hashes)) for board, post_id, *hex_hashes in rows]
+
+    async def put_many(self, board: str, hashed_posts: list[tuple[dict, ImageHashes]]) -> None:
+        """Store the hashes of posts, replacing any older ones
+        Arguments:
+            board::str
+                The board the posts are from
+            hashed_posts::list[tuple[dict, ImageHashes]]
+                Each post along with its hashes
+        """
+        if not hashed_posts:
+            return
+
+        query = """INSERT INTO boardPostHash (board, postId, fileMd5, pHash, dHash, averageHash, colorHash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (board, postId) DO UPDATE SET
+                fileMd5 = excluded.fileMd5, pHash = excluded.pHash, dHash = excluded.dHash,
+                averageHash = excluded.averageHash, colorHash = excluded.colorHash, dateHashed = CURRENT_TIMESTAMP"""
+        rows = [(board, post['id'], post.get('md5', ''), *hashes.to_hex()) for post, hashes in hashed_posts]
+
+        await self.conn.executemany(query, rows)
+        await self.conn.commit()
+
+
+_image_hasher: ImageHasher = None
+
+
+def set_image_hasher(hasher: ImageHasher, /) -> None:
+    """Set the hasher that all images will be hashed with"""
+    global _image_hasher
+    _image_hasher = hasher
+
+
+def get_image_hasher() -> ImageHasher:
+    """Get the hasher that all images are hashed with.
+    A default one is created if none has been set"""
+    global _image_hasher
+    if not _image_hasher:
+        _image_hasher = ImageHasher()
+
+    return _image_hasher
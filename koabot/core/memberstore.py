@@ -0,0 +1,54 @@
+"""Storage of the servers the bot is in and their members"""
+from datetime import datetime
+
+import aiosqlite
+
+# (user id, user name, nickname in the server)
+MemberRow = tuple[int, str, str | None]
+
+
+class MemberStore():
+    """Keeps the servers, users and server nicknames in the database in sync with Discord
+    Arguments:
+        conn::aiosqlite.Connection
+            The connection to the database holding the discordServer, discordUser and discordServerUser tables
+    """
+
+    def __init__(self, conn: aiosqlite.Connection) -> None:
+        self.conn = conn
+
+    async def sync_guild(self, guild_id: int, guild_name: str, members: list[MemberRow]) -> None:
+        """Insert or update a server along with its members, in a single transaction
+        Arguments:
+            guild_id::int
+                The Discord id of the server
+            guild_name::str
+            members::list[tuple[int, str, str | None]]
+                The Discord id, name and server nickname of each member
+        """
+        now = datetime.now()
+
+        try:
+            query = """INSERT INTO discordServer (serverDId, serverName, dateFirstSeen) VALUES (?, ?, ?)
+                ON CONFLICT (serverDId) DO UPDATE SET serverName = excluded.serverName"""
+            await self.conn.execute(query, (guild_id, guild_name, now))
+
+            # RETURNING would do, but it needs sqlite 3.35 and Debian bullseye ships 3.34
+            query = "SELECT serverId FROM discordServer WHERE serverDId = ?"
+            async with self.conn.execute(query, (guild_id,)) as cursor:
+                (server_id,) = await cursor.fetchone()
+
+            query = """INSERT INTO discordUser (userDId, userName, dateFirstSeen) VALUES (?, ?, ?)
+                ON CONFLICT (userDId) DO UPDATE SET userName = excluded.userName"""
+            await self.conn.executemany(query, [(user_id, name, now) for user_id, name, _ in members])
+
+            # the WHERE is needed for sqlite to tell the ON CONFLICT apart from a join
+            query = """INSERT INTO discordServerUser (userId, serverId, userNickname)
+                SELECT userId, ?, ? FROM discordUser WHERE userDId = ?
+                ON CONFLICT (userId, serverId) DO UPDATE SET userNickname = excluded.userNickname"""
+            await self.conn.executemany(query, [(server_id, nick, user_id) for user_id, _, nick in members])
+        except BaseException:
+            await self.conn.rollback()
+            raise
+
+        await self.conn.commit()
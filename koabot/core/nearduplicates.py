@@ -0,0 +1,115 @@
+"""Finding images that look alike among everything the bot has hashed"""
+from typing import Hashable
+
+from koabot.core.imagehashing import HASH_SIZE, ImageHashes, PostHashIndex
+
+PostKey = tuple[str, int]
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash():
+    """Multi-index hashing, which finds the hashes within a distance of another without comparing against all of them.
+    Hashes are split into max_distance + 1 chunks. Two hashes that differ in max_distance bits or less
+    must share at least one of those chunks, so only hashes with a matching chunk need to be compared.
+    Arguments:
+        bits::int
+            Length of the hashes
+        max_distance::int
+            The furthest distance that can be searched
+    """
+
+    def __init__(self, bits: int, max_distance: int) -> None:
+        self.max_distance = max_distance
+        chunk_count = min(max_distance + 1, bits)
+        bounds = [bits * i // chunk_count for i in range(chunk_count + 1)]
+        # (shift, mask) of each chunk
+        self.chunks = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self.tables: list[dict[int, list[tuple[int, Hashable]]]] = [{} for _ in self.chunks]
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, item: int, value: Hashable) -> None:
+        """Add a hash along with the value to return when it's found"""
+        self.size += 1
+        entry = (item, value)
+
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            table.setdefault(item >> shift & mask, []).append(entry)
+
+    def search(self, item: int, max_distance: int = None) -> list[tuple[int, Hashable]]:
+        """Get the values of the hashes within max_distance of a hash, closest first"""
+        if max_distance is None:
+            max_distance = self.max_distance
+        elif max_distance > self.max_distance:
+            raise ValueError(f"Can't search further than {self.max_distance} bits away.")
+
+        found: dict[int, tuple[int, Hashable]] = {}
+
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            for entry in table.get(item >> shift & mask, ()):
+                if id(entry) in found:
+                    continue
+
+                if (distance := hamming_distance(item, entry[0])) <= max_distance:
+                    found[id(entry)] = (distance, entry[1])
+
+        return sorted(found.values(), key=lambda match: match[0])
+
+
+class NearDuplicateIndex():
+    """Index of the perceptual hashes of posts from every site, to recognize the same art posted anywhere
+    Arguments:
+        max_distance::int
+            The furthest that searches can look, in bits of the phash. Default is 10
+    """
+
+    def __init__(self, max_distance: int = 10) -> None:
+        self._index = MultiIndexHash(HASH_SIZE ** 2, max_distance)
+        self._hashes: dict[PostKey, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, key: PostKey, hashes: ImageHashes) -> None:
+        """Index the hashes of a post
+        Arguments:
+            key::tuple[str, int]
+                The site (or board) and id of the post
+            hashes::ImageHashes
+                The hashes of its image
+        """
+        phash = int(str(hashes.phash), 16)
+
+        if self._hashes.get(key) == phash:
+            return
+
+        # a post whose file changed keeps its old entry, but searches skip it
+        self._hashes[key] = phash
+        self._index.add(phash, (key, phash))
+
+    def search(self, hashes: ImageHashes, max_distance: int = None) -> list[tuple[PostKey, int]]:
+        """Get the posts that look like an image, closest first
+        Arguments:
+            hashes::ImageHashes
+                The hashes of the image to look for
+            max_distance::int
+                How many bits of the phash can differ. Default is the furthest the index can look
+        """
+        phash = int(str(hashes.phash), 16)
+        matches = self._index.search(phash, max_distance)
+        return [(key, distance) for distance, (key, indexed_phash) in matches if self._hashes[key] == indexed_phash]
+
+    def find_reposts(self, key: PostKey, hashes: ImageHashes, max_distance: int = None) -> list[tuple[PostKey, int]]:
+        """Get the posts from other sites that look like a post, closest first"""
+        return [(other_key, distance) for other_key, distance in self.search(hashes, max_distance)
+                if other_key[0] != key[0]]
+
+    async def load(self, post_hash_index: PostHashIndex) -> None:
+        """Index every post hashed so far"""
+        for board, post_id, hashes in await post_hash_index.get_all():
+            self.add((board, post_id), hashes)
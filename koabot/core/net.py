@@ -1,16 +1,238 @@
 """Handle network requests"""
+import asyncio
+import contextlib
 import io
-from datetime import datetime
+import json as jsonlib
+import os
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable
 
 import aiohttp
 
+from koabot.core.blobstore import BlobStore
+from koabot.core.httpcache import DEFAULT_MAX_DISK_MB, CacheEntry, ResponseCache
+from koabot.core.ratelimit import HostLimiter
+
+# Budgets for the domains (and their subdomains) known to throttle us.
+# Sites can override or extend these with a "rate_limit" entry in their assets
+DEFAULT_RATE_LIMITS: dict[str, dict] = {
+    'donmai.us': {'per_second': 10, 'burst': 10, 'max_in_flight': 4},
+    'e621.net': {'per_second': 2, 'burst': 2, 'max_in_flight': 2},
+    'e926.net': {'per_second': 2, 'burst': 2, 'max_in_flight': 2},
+}
+
+# Largest file that will be downloaded into a cache, in bytes
+DEFAULT_MAX_DOWNLOAD_SIZE = 32 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# How many seconds GET responses from these domains (and their subdomains) are reused for.
+# Sites can override or extend these with a "cache" entry in their assets
+DEFAULT_CACHE_TTLS: dict[str, dict] = {
+    'donmai.us': {'ttl': 300},
+    'e621.net': {'ttl': 300},
+    'e926.net': {'ttl': 300},
+    'jisho.org': {'ttl': 86400},
+    'urbandictionary.com': {'ttl': 3600},
+    'dictionaryapi.com': {'ttl': 86400},
+    'wikipedia.org': {'ttl': 3600},
+}
+
+
+class RetryPolicy():
+    """When and how long to wait before repeating a failed GET request
+    Keywords:
+        attempts::int
+            How many times a request is sent at most, counting the first one. Default is 3
+        backoff::float
+            Base of the exponential backoff in seconds. Default is 0.5
+        max_backoff::float
+            The longest a single wait can last, Retry-After included. Default is 30
+        deadline::float
+            Seconds after which no more attempts will be made. Default is 30
+    """
+    RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524})
+
+    def __init__(self, **kwargs) -> None:
+        self.attempts: int = kwargs.get('attempts', 3)
+        self.backoff: float = kwargs.get('backoff', 0.5)
+        self.max_backoff: float = kwargs.get('max_backoff', 30)
+        self.deadline: float = kwargs.get('deadline', 30)
+        # its own generator, so that retries don't disturb the rolls of anything using the global one
+        self._random = random.Random()
+
+    def get_retry_delay(self, status: int | None, retry_after: str | None, attempt: int, deadline: float) -> float | None:
+        """Get how long to wait before trying again, or None if the request shouldn't be retried
+        Arguments:
+            status::int | None
+                The status the request failed with. None if it failed to connect
+            retry_after::str | None
+                The Retry-After header sent by the server, if any
+            attempt::int
+                How many attempts have failed before this one
+            deadline::float
+                Monotonic time past which the request must be given up on
+        """
+        if attempt + 1 >= self.attempts:
+            return None
+
+        if status is not None and status not in self.RETRY_STATUSES:
+            return None
+
+        if (delay := parse_retry_after(retry_after)) is None:
+            # "full jitter" keeps callers that failed together from retrying together
+            delay = self._random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+        if delay > self.max_backoff or time.monotonic() + delay > deadline:
+            return None
+
+        return delay
+
+
+class SingleFlight():
+    """Lets concurrent callers asking for the same thing share a single call"""
+
+    def __init__(self) -> None:
+        self._flights: dict[str, asyncio.Task] = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Await func(), or the call already in flight under the same key"""
+        if (task := self._flights.get(key)):
+            self.collapsed += 1
+        else:
+            self.calls += 1
+            task = asyncio.create_task(func())
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+
+        # one caller giving up mustn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+
+class NetSession():
+    """Bot-lifetime http session that keeps connections warm between requests
+    Keywords:
+        limit::int
+            Total amount of simultaneous connections. Default is 100
+        limit_per_host::int
+            Simultaneous connections to the same host. Default is 10
+        keepalive_timeout::float
+            Seconds an idle connection is kept open for reuse. Default is 30
+        dns_cache_ttl::int
+            Seconds resolved addresses are kept for. Default is 300
+        timeout::float
+            Seconds before a request is given up on. Default is 60
+        rate_limits::dict
+            Rate limits to apply per domain, on top of DEFAULT_RATE_LIMITS.
+            Each entry takes the keywords of HostLimiter
+        retry::dict
+            The keywords of the RetryPolicy used for GET requests
+        cache_ttls::dict
+            Seconds to cache responses for per domain, on top of DEFAULT_CACHE_TTLS
+        cache_dir::Path
+            Where cached responses are persisted. They're only kept in memory if not set
+        cache_max_entries::int
+            How many cached responses are kept in memory. Default is 256
+        cache_max_mb::int
+            How much space cached responses can take on disk, in MiB. Default is 64
+    """
+
+    def __init__(self, **kwargs) -> None:
+        self.limit: int = kwargs.get('limit', 100)
+        self.limit_per_host: int = kwargs.get('limit_per_host', 10)
+        self.keepalive_timeout: float = kwargs.get('keepalive_timeout', 30)
+        self.dns_cache_ttl: int = kwargs.get('dns_cache_ttl', 300)
+        self.timeout: float = kwargs.get('timeout', 60)
+        self.rate_limits: dict[str, dict] = DEFAULT_RATE_LIMITS | kwargs.get('rate_limits', {})
+
+        self.retry_policy = RetryPolicy(**kwargs.get('retry', {}))
+        self.retry_counts: Counter[str] = Counter()
+        self.cache_ttls: dict[str, dict] = DEFAULT_CACHE_TTLS | kwargs.get('cache_ttls', {})
+        self.flights = SingleFlight()
+        self.response_cache = ResponseCache(kwargs.get('cache_dir'), max_entries=kwargs.get('cache_max_entries', 256),
+                                            max_disk_bytes=kwargs.get('cache_max_mb', DEFAULT_MAX_DISK_MB) * 2**20)
+
+        self._session: aiohttp.ClientSession = None
+        self._limiters: dict[str, HostLimiter | None] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared client session, created on first use"""
+        if not self._session or self._session.closed:
+            # aiohttp picks the aiodns resolver by itself when it's installed
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             use_dns_cache=True,
+                                             ttl_dns_cache=self.dns_cache_ttl)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        return self._session
+
+    def get_limiter(self, host: str, /) -> HostLimiter | None:
+        """Get the limiter of the closest configured parent domain of a host, if any"""
+        if host in self._limiters:
+            return self._limiters[host]
+
+        limiter = None
+        if (domain := find_parent_domain(host, self.rate_limits)):
+            # subdomains that fall under the same entry share their budget
+            if domain not in self._limiters:
+                self._limiters[domain] = HostLimiter(**self.rate_limits[domain])
+
+            limiter = self._limiters[domain]
+
+        self._limiters[host] = limiter
+        return limiter
+
+    def get_cache_ttl(self, host: str, /) -> float:
+        """Get for how many seconds responses from a host are cached. 0 if they aren't"""
+        if not (domain := find_parent_domain(host, self.cache_ttls)):
+            return 0
+
+        return self.cache_ttls[domain]['ttl']
+
+    async def close(self) -> None:
+        """Close the session and all of its pooled connections"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+        self._session = None
+
+
+_net_session: NetSession = None
+
+
+def set_net_session(net_session: NetSession, /) -> None:
+    """Set the session that all requests will be made through"""
+    global _net_session
+    _net_session = net_session
+
+
+def get_net_session() -> NetSession:
+    """Get the session that all requests are made through.
+    A default one is created if none has been set"""
+    global _net_session
+    if not _net_session:
+        _net_session = NetSession()
+
+    return _net_session
+
 
 class NetResponse():
     """Custom network response class"""
 
-    def __init__(self, response: aiohttp.ClientResponse, **kwargs) -> None:
+    def __init__(self, response: aiohttp.ClientResponse | None, **kwargs) -> None:
         self.client_response = response
-        self.status: int = self.client_response.status
+        # responses served from the cache have no client response
+        self.status: int = response.status if response else kwargs.get('status')
         self.response_body = kwargs.get('response_body', None)
 
         if kwargs.get('json'):
@@ -22,7 +244,7 @@ class NetResponse():
 
 
 async def http_request(url: str, **kwargs) -> NetResponse:
-    """Make an http request
+    """Make an http request. Identical GET requests made at the same time are sent only once
     Arguments:
         url::str
             The url to point to
@@ -42,7 +264,31 @@ async def http_request(url: str, **kwargs) -> NetResponse:
             whether or not the request is a POST request
         jdata::dict
             a dict containing the json data to be sent
+        retry::bool
+            whether or not a failed GET request may be sent again. Default is True
+        cache::bool
+            whether or not the response may be served from, and stored in, the cache. Default is True
     """
+    if kwargs.get('post'):
+        return await send_request(url, **kwargs)
+
+    auth: aiohttp.BasicAuth = kwargs.get('auth')
+    flight_key = jsonlib.dumps([url,
+                                kwargs.get('params'),
+                                kwargs.get('jdata'),
+                                kwargs.get('headers'),
+                                auth.login if auth else None,
+                                bool(kwargs.get('json')),
+                                bool(kwargs.get('image')),
+                                str(kwargs.get('save_to')),
+                                kwargs.get('cache', True)], sort_keys=True, default=str)
+
+    return await get_net_session().flights.do(flight_key, lambda: send_request(url, **kwargs))
+
+
+async def send_request(url: str, **kwargs) -> NetResponse:
+    """Send an http request through the rate limiter, the retry policy and the response cache.
+    Takes the same keywords as http_request"""
     auth: aiohttp.BasicAuth = kwargs.get('auth')
     cookies = kwargs.get('cookies', None)
     headers: dict = kwargs.get('headers')
@@ -51,13 +297,73 @@ async def http_request(url: str, **kwargs) -> NetResponse:
     post: bool = kwargs.get('post', None)
     jdata: dict = kwargs.get('jdata', None)
 
-    async with aiohttp.ClientSession(auth=auth) as session:
-        if post:
-            async with session.post(url, cookies=cookies, headers=headers, params=params, data=data, json=jdata) as response:
-                return await handle_request(response, **kwargs)
+    net_session = get_net_session()
+    method = 'POST' if post else 'GET'
+    host = get_domain(url)
+    limiter = net_session.get_limiter(host) or contextlib.nullcontext()
+
+    # only requests that are safe to repeat get retried
+    retry_policy = net_session.retry_policy if not post and kwargs.get('retry', True) else None
+    deadline = time.monotonic() + net_session.retry_policy.deadline
+    attempt = 0
+
+    cache = net_session.response_cache
+    cache_key: str = None
+    cached: CacheEntry = None
+    cache_ttl = 0
+
+    # images are left to the file caches
+    if not post and not kwargs.get('image') and kwargs.get('cache', True):
+        cache_ttl = net_session.get_cache_ttl(host)
+
+    if cache_ttl:
+        cache_key = cache.make_key(method, url, params, jdata)
+
+        if (cached := await cache.get(cache_key)) and cached.is_fresh:
+            cache.hits += 1
+            return get_cached_response(cached, **kwargs)
+
+        if cached and cached.can_revalidate:
+            headers = dict(headers or {})
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
         else:
-            async with session.get(url, cookies=cookies, headers=headers, params=params, data=data, json=jdata) as response:
-                return await handle_request(response, **kwargs)
+            cached = None
+            cache.misses += 1
+
+    while True:
+        try:
+            # waits in line for the host's budget before sending anything
+            async with limiter:
+                async with net_session.session.request(method, url, auth=auth, cookies=cookies, headers=headers, params=params, data=data, json=jdata) as response:
+                    delay = None
+                    if retry_policy and response.status not in (200, 304):
+                        delay = retry_policy.get_retry_delay(response.status, response.headers.get('Retry-After'), attempt, deadline)
+
+                    if delay is None:
+                        if cached and response.status == 304:
+                            cache.revalidations += 1
+                            await cache.refresh(cache_key, cached, cache_ttl)
+                            return get_cached_response(cached, **kwargs)
+
+                        if cache_key and response.status == 200:
+                            await store_response(cache, cache_key, response, cache_ttl)
+
+                        return await handle_request(response, **kwargs)
+
+                    reason = f"[Network status {response.status}]: {response.reason}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not retry_policy or (delay := retry_policy.get_retry_delay(None, None, attempt, deadline)) is None:
+                raise
+
+            reason = f"[{type(e).__name__}]: {e}"
+
+        attempt += 1
+        net_session.retry_counts[host] += 1
+        print(f"{reason} Retrying {url} in {delay:0.2f}s (attempt {attempt + 1}/{retry_policy.attempts})")
+        await asyncio.sleep(delay)
 
 
 async def handle_request(response: aiohttp.ClientResponse, **kwargs) -> NetResponse:
@@ -71,9 +377,12 @@ async def handle_request(response: aiohttp.ClientResponse, **kwargs) -> NetRespo
             False = returns plain text
         err_msg::str
             message to display on failure
+        save_to::Path
+            stream the body into this file instead of reading it into memory
     """
     json: bool = kwargs.get('json', False)
     err_msg: str = kwargs.get('err_msg')
+    save_to: Path = kwargs.get('save_to')
 
     if response.status != 200:
         # Timeout error
@@ -83,7 +392,11 @@ async def handle_request(response: aiohttp.ClientResponse, **kwargs) -> NetRespo
         print(failure_msg)
         return NetResponse(response)
 
-    if json:
+    if save_to:
+        response_body = await stream_to_file(response, save_to,
+                                             max_size=kwargs.get('max_size', DEFAULT_MAX_DOWNLOAD_SIZE),
+                                             content_type=kwargs.get('content_type', 'image/'))
+    elif json:
         response_body = await response.json(content_type=None)
     else:
         response_body = await response.read()
@@ -91,10 +404,150 @@ async def handle_request(response: aiohttp.ClientResponse, **kwargs) -> NetRespo
     return NetResponse(response, response_body=response_body, **kwargs)
 
 
-async def fetch_image(url: str, /, **kwargs) -> io.BytesIO:
-    """Download an image"""
-    img_bytes = io.BytesIO((await http_request(url, image=True, **kwargs)).image)
-    return img_bytes
+async def stream_to_file(response: aiohttp.ClientResponse, path: Path, /, *, max_size: int, content_type: str) -> Path | None:
+    """Write a response body into a file chunk by chunk. The file only appears once it's complete
+    Arguments:
+        response::ClientResponse
+        path::Path
+            Where the file will be saved
+    Keywords:
+        max_size::int
+            Bytes after which the download is abandoned
+        content_type::str
+            What the Content-Type of the response must start with
+
+    Returns:
+        The path of the file, or None if it was rejected
+    """
+    if not (received_type := response.headers.get('Content-Type', '')).startswith(content_type):
+        print(f"Not saving {response.real_url}: expected {content_type} but got \"{received_type}\"")
+        # the unread body would otherwise be left on a connection that goes back to the pool
+        response.close()
+        return None
+
+    if response.content_length and response.content_length > max_size:
+        print(f"Not saving {response.real_url}: {response.content_length} bytes is over the {max_size} bytes limit")
+        response.close()
+        return None
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.part")
+    size = 0
+
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    print(f"Not saving {response.real_url}: went over the {max_size} bytes limit")
+                    response.close()
+                    return None
+
+                tmp_file.write(chunk)
+
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return path
+
+
+async def store_response(cache: ResponseCache, key: str, response: aiohttp.ClientResponse, ttl: float) -> None:
+    """Keep the body of a successful response in the cache"""
+    if 'no-store' in response.headers.get('Cache-Control', ''):
+        return
+
+    # aiohttp keeps the body around, so reading it here doesn't consume it
+    body = await response.read()
+    await cache.put(key, CacheEntry(url=str(response.url),
+                                    status=response.status,
+                                    body=body,
+                                    expires=time.time() + ttl,
+                                    etag=response.headers.get('ETag'),
+                                    last_modified=response.headers.get('Last-Modified')))
+
+
+def get_cached_response(entry: CacheEntry, /, **kwargs) -> NetResponse:
+    """Make a response out of a cache entry, as if it was just received"""
+    response_body = entry.body
+
+    if kwargs.get('json'):
+        response_body = jsonlib.loads(response_body) if response_body.strip() else None
+
+    return NetResponse(None, status=entry.status, response_body=response_body, **kwargs)
+
+
+async def download_image(url: str, path: Path, /, **kwargs) -> Path | None:
+    """Download an image straight into a file, without holding it in memory
+    Arguments:
+        url::str
+        path::Path
+            Where the image will be saved. Replaced atomically if it exists
+    Keywords:
+        max_size::int
+            Bytes after which the download is abandoned. Default is DEFAULT_MAX_DOWNLOAD_SIZE
+        Any other keyword taken by http_request
+
+    Returns:
+        The path of the image, or None if it couldn't be downloaded
+    """
+    response = await http_request(url, image=True, save_to=path, **kwargs)
+
+    if response.status != 200:
+        return None
+
+    return response.image
+
+
+async def fetch_image(url: str, /, *, blob_store: BlobStore = None, **kwargs) -> io.BytesIO:
+    """Download an image into memory. Prefer download_image for anything that gets cached
+    Arguments:
+        url::str
+    Keywords:
+        blob_store::BlobStore
+            Store to look the image up in before downloading it, and to keep it in afterwards.
+            Only for urls whose contents never change
+        Any other keyword taken by http_request
+    """
+    if blob_store and (image := await blob_store.read(url)) is not None:
+        return io.BytesIO(image)
+
+    image = (await http_request(url, image=True, **kwargs)).image
+
+    if blob_store and image:
+        await blob_store.put_bytes(image, url)
+
+    return io.BytesIO(image)
+
+
+def find_parent_domain(host: str, domains: dict, /) -> str | None:
+    """Find the closest domain of a host, itself included, that is present in the given dict"""
+    labels = host.split(':')[0].split('.')
+
+    for i in range(len(labels)):
+        if (domain := '.'.join(labels[i:])) in domains:
+            return domain
+
+    return None
+
+
+def parse_retry_after(retry_after: str | None, /) -> float | None:
+    """Get the seconds to wait from a Retry-After header, which can be either seconds or an http date"""
+    if not retry_after:
+        return None
+
+    if retry_after.isdigit():
+        return float(retry_after)
+
+    try:
+        retry_date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    if not retry_date.tzinfo:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
 
 
 def get_url_filename(url: str, /) -> str:
@@ -0,0 +1,233 @@
+"""Scheduling and running the previews of messages"""
+import asyncio
+import sys
+import time
+import traceback
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable
+
+import discord
+
+PreviewJob = Callable[[discord.Message], Awaitable[Any]]
+
+
+@dataclass
+class QueuedPreview():
+    guild_id: int
+    key: Hashable
+    job: Callable[[], Awaitable[Any]]
+    enqueued_at: float
+    deadline: float
+
+
+class PreviewQueue():
+    """Queue of preview work that takes turns between guilds, so that one busy guild can't starve the rest
+    Keywords:
+        workers::int
+            How many messages are previewed at the same time. Default is 4
+        max_depth::int
+            How many messages can wait in the queue overall. New ones are dropped past it. Default is 100
+        max_depth_per_guild::int
+            How many messages a single guild can have waiting. Its oldest one is dropped past it. Default is 20
+        deadline::float
+            Seconds after which a waiting message isn't worth previewing anymore. Default is 60
+    """
+
+    def __init__(self, **kwargs) -> None:
+        self.workers: int = kwargs.get('workers', 4)
+        self.max_depth: int = kwargs.get('max_depth', 100)
+        self.max_depth_per_guild: int = kwargs.get('max_depth_per_guild', 20)
+        self.deadline: float = kwargs.get('deadline', 60)
+
+        self._queues: OrderedDict[int, deque[QueuedPreview]] = OrderedDict()
+        self._keys: set[Hashable] = set()
+        self._has_work = asyncio.Event()
+        self._worker_tasks: list[asyncio.Task] = []
+
+        self.depth = 0
+        self.completed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.timed_out = 0
+        # seconds spent waiting in the queue and running, for the latest jobs
+        self.wait_times: deque[float] = deque(maxlen=100)
+        self.run_times: deque[float] = deque(maxlen=100)
+
+    @property
+    def guild_count(self) -> int:
+        """How many guilds have jobs waiting"""
+        return len(self._queues)
+
+    def put(self, guild_id: int, key: Hashable, job: Callable[[], Awaitable[Any]]) -> bool:
+        """Queue up a job. Returns whether or not it was accepted
+        Arguments:
+            guild_id::int
+                The guild the job is for
+            key::Hashable
+                Identifies the work being done. A job is dropped if the same key is already waiting
+            job::Callable
+                The coroutine function to run
+        """
+        if key in self._keys:
+            self.coalesced += 1
+            return False
+
+        guild_queue = self._queues.get(guild_id)
+
+        if guild_queue and len(guild_queue) >= self.max_depth_per_guild:
+            # the oldest job is the one the guild is least likely to still care about
+            self._discard(guild_queue.popleft())
+            self.dropped += 1
+        elif self.depth >= self.max_depth:
+            print(f"Preview queue is full. Dropping job for guild {guild_id}")
+            self.dropped += 1
+            return False
+
+        if guild_queue is None:
+            guild_queue = self._queues[guild_id] = deque()
+
+        now = time.monotonic()
+        guild_queue.append(QueuedPreview(guild_id, key, job, now, now + self.deadline))
+        self._keys.add(key)
+        self.depth += 1
+        self._has_work.set()
+        return True
+
+    def _discard(self, queued: QueuedPreview) -> None:
+        self._keys.discard(queued.key)
+        self.depth -= 1
+
+    def _pop(self) -> QueuedPreview:
+        # the guild at the front gets served and goes to the back of the line
+        guild_id, guild_queue = next(iter(self._queues.items()))
+        queued = guild_queue.popleft()
+
+        if guild_queue:
+            self._queues.move_to_end(guild_id)
+        else:
+            del self._queues[guild_id]
+
+        if not self._queues:
+            self._has_work.clear()
+
+        self._discard(queued)
+        return queued
+
+    async def _work(self) -> None:
+        while True:
+            await self._has_work.wait()
+
+            # every waiting worker wakes up, but the job may have been taken by another already
+            if not self._queues:
+                continue
+
+            queued = self._pop()
+            started_at = time.monotonic()
+
+            if started_at > queued.deadline:
+                self.expired += 1
+                continue
+
+            self.wait_times.append(started_at - queued.enqueued_at)
+
+            try:
+                # a job that hangs would otherwise hold on to its worker forever
+                await asyncio.wait_for(queued.job(), queued.deadline - started_at)
+            except asyncio.TimeoutError:
+                print(f"Preview job for guild {queued.guild_id} ran past its deadline and was cancelled",
+                      file=sys.stderr)
+                self.timed_out += 1
+            except Exception as e:
+                print("Ignoring exception in preview queue:", file=sys.stderr)
+                traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+
+            self.run_times.append(time.monotonic() - started_at)
+            self.completed += 1
+
+    def start(self) -> None:
+        """Start the workers"""
+        if not self._worker_tasks:
+            self._worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def stop(self) -> None:
+        """Stop the workers. Jobs still waiting are kept"""
+        for task in self._worker_tasks:
+            task.cancel()
+
+        self._worker_tasks = []
+
+
+class OrderedChannel():
+    """Stand-in for a channel that holds back anything sent to it until it's its owner's turn"""
+
+    def __init__(self, channel: discord.abc.Messageable, turn: asyncio.Event) -> None:
+        self._channel = channel
+        self._turn = turn
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._channel, name)
+
+    async def send(self, *args, **kwargs) -> discord.Message:
+        await self._turn.wait()
+        return await self._channel.send(*args, **kwargs)
+
+
+class OrderedMessage():
+    """Stand-in for a message that holds back any replies to it until it's its owner's turn"""
+
+    def __init__(self, msg: discord.Message, turn: asyncio.Event) -> None:
+        self._msg = msg
+        self._turn = turn
+        self.channel = OrderedChannel(msg.channel, turn)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._msg, name)
+
+    async def reply(self, *args, **kwargs) -> discord.Message:
+        await self._turn.wait()
+        return await self._msg.reply(*args, **kwargs)
+
+
+async def run_in_order(msg: discord.Message, jobs: list[PreviewJob], /, *, max_concurrency: int = 4) -> list[Any]:
+    """Run the jobs responding to a message at the same time, while keeping what they send in the order of the jobs.
+    Each job receives a stand-in of the message that delays its replies until all the jobs before it are done.
+    Arguments:
+        msg::discord.Message
+            The message being responded to
+        jobs::list[PreviewJob]
+            The jobs to run, in the order their responses should appear
+    Keywords:
+        max_concurrency::int
+            How many jobs can run at the same time. Default is 4
+
+    Returns:
+        The result of each job, or None for those that failed
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    first_turn = asyncio.Event()
+    first_turn.set()
+    finished = [asyncio.Event() for _ in jobs]
+    turns = [first_turn] + finished[:-1]
+
+    async def run(job: PreviewJob, turn: asyncio.Event, done: asyncio.Event) -> Any:
+        try:
+            return await job(OrderedMessage(msg, turn))
+        except Exception as e:
+            print("Ignoring exception in preview:", file=sys.stderr)
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            return None
+        finally:
+            # jobs that finish early still have to wait for their turn, or the ones after them could jump ahead
+            await turn.wait()
+            done.set()
+            semaphore.release()
+
+    tasks: list[asyncio.Task] = []
+    for job, turn, done in zip(jobs, turns, finished):
+        # slots are taken in order so that the job whose turn it is always has one
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(run(job, turn, done)))
+
+    return await asyncio.gather(*tasks)
@@ -1,5 +1,6 @@
 """Post utilities"""
 import re
+from functools import lru_cache
 
 
 def get_name_or_id(url: str, /, *, start: str | list = None, end: str | list = None, pattern: str = "") -> str:
@@ -84,3 +85,10 @@ def combine_tags(tags: str | list, /,  *, maximum: int = 5) -> str:
         return joint_tags.strip().replace("_", " ")
 
     return "".join(tag_list).strip().replace("_", " ")
+
+
+@lru_cache(maxsize=2048)
+def parse_tag_string(tag_string: str, /) -> frozenset[str]:
+    """Get the tags of a space separated tag string (i.e. danbooru's tag_string_general).
+    Results are cached, since the same posts get checked over and over"""
+    return frozenset(tag_string.split())
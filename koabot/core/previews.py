@@ -75,7 +75,7 @@ class PreviewHandler(commands.Cog):
         url_matches_found = botevents.find_urls(message.content)
         prefix_start = False
 
-        if (parsed_galleries := await botevents.parse_galleries(message, url_matches_found, prefix_start)):
+        if (parsed_galleries := botevents.parse_galleries(url_matches_found)):
             await botevents.send_previews(message, parsed_galleries, not prefix_start)
 
 
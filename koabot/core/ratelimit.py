@@ -0,0 +1,168 @@
+"""Rate limiting primitives"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Hashable
+
+
+class TokenBucket():
+    """Token bucket that hands out tokens to its callers in the order they asked for them
+    Arguments:
+        rate::float
+            Tokens regained per second
+        capacity::float
+            Maximum amount of tokens that can be stored, i.e. the burst size
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        if rate <= 0:
+            raise ValueError("The rate of a token bucket must be greater than 0.")
+
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        # asyncio.Lock wakes up its waiters in FIFO order, which keeps the queue fair
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            self._refill()
+
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+
+            self.tokens -= 1
+
+
+class HostLimiter():
+    """Limits both the rate and the amount of simultaneous requests made to a host
+    Keywords:
+        per_second::float
+            Requests allowed per second
+        burst::int
+            Requests that can be sent at once before being throttled. Default is per_second
+        max_in_flight::int
+            Requests that can be waiting for a response at the same time. 0 means unlimited
+    """
+
+    def __init__(self, *, per_second: float, burst: int = None, max_in_flight: int = 0) -> None:
+        self.bucket = TokenBucket(per_second, burst or per_second)
+        self._in_flight = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+    async def __aenter__(self) -> 'HostLimiter':
+        if self._in_flight:
+            await self._in_flight.acquire()
+
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            if self._in_flight:
+                self._in_flight.release()
+            raise
+
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._in_flight:
+            self._in_flight.release()
+
+
+@dataclass
+class _CooldownState():
+    # (time, cost) of the hits still within the window, oldest first
+    hits: deque[tuple[float, float]] = field(default_factory=deque)
+    total: float = 0
+    blocked_until: float = 0
+    last_hit: float = 0
+
+
+class SlidingWindowCooldown():
+    """Limits how much each key (i.e. a user id) can do within a sliding window of time.
+    Keys that go over the limit are blocked for a while, and keys that have been idle long enough are forgotten,
+    so only the recently active ones take up memory.
+    Arguments:
+        limit::float
+            Total cost allowed within the window
+        window::float
+            Length of the window in seconds
+    Keywords:
+        penalty::float
+            Seconds a key stays blocked after going over the limit. Default is the length of the window
+    """
+
+    def __init__(self, limit: float, window: float, *, penalty: float = None) -> None:
+        if window <= 0:
+            raise ValueError("The window of a cooldown must be greater than 0.")
+
+        self.limit = limit
+        self.window = window
+        self.penalty = window if penalty is None else penalty
+        # least recently hit first
+        self._keys: OrderedDict[Hashable, _CooldownState] = OrderedDict()
+
+    def __len__(self) -> int:
+        """How many keys are being tracked"""
+        self._evict(time.monotonic())
+        return len(self._keys)
+
+    def seconds_since_last(self, key: Hashable) -> float | None:
+        """Seconds since a key was last hit, or None if it isn't being tracked"""
+        now = time.monotonic()
+        self._evict(now)
+
+        if (state := self._keys.get(key)) is None:
+            return None
+
+        return now - state.last_hit
+
+    def is_blocked(self, key: Hashable) -> bool:
+        return (state := self._keys.get(key)) is not None and state.blocked_until > time.monotonic()
+
+    def hit(self, key: Hashable, cost: float = 1) -> bool:
+        """Count something done by a key. Returns whether the key is blocked, in which case it isn't counted"""
+        now = time.monotonic()
+        self._evict(now)
+
+        if (state := self._keys.get(key)) is None:
+            state = self._keys[key] = _CooldownState()
+
+        self._keys.move_to_end(key)
+
+        if state.blocked_until > now:
+            return True
+
+        state.last_hit = now
+
+        while state.hits and state.hits[0][0] <= now - self.window:
+            state.total -= state.hits.popleft()[1]
+
+        state.hits.append((now, cost))
+        state.total += cost
+
+        if state.total > self.limit:
+            state.blocked_until = now + self.penalty
+            state.hits.clear()
+            state.total = 0
+            return True
+
+        return False
+
+    def _evict(self, now: float) -> None:
+        # keys are kept in the order they were hit, so the idle ones are at the front.
+        # A blocked key holds back the ones behind it, but only until its penalty is over
+        while self._keys:
+            key, state = next(iter(self._keys.items()))
+
+            if state.last_hit + self.window > now or state.blocked_until > now:
+                break
+
+            del self._keys[key]
@@ -0,0 +1,69 @@
+"""In-memory record of who reacted with what on a message"""
+
+
+class ReactionIndex():
+    """Keeps the users behind each reaction of the messages being watched, so that
+    who reacted with what can be answered without asking Discord.
+    It's seeded once per message and kept up to date from reaction events afterwards."""
+
+    def __init__(self) -> None:
+        # message id -> emoji -> user ids
+        self._messages: dict[int, dict[str, set[int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._messages
+
+    def seed(self, message_id: int, reactions: dict[str, set[int]]) -> None:
+        """Replace everything known about a message
+        Arguments:
+            message_id::int
+            reactions::dict[str, set[int]]
+                The ids of the users behind each of its reactions
+        """
+        self._messages[message_id] = {em: set(user_ids) for em, user_ids in reactions.items() if user_ids}
+
+    def forget(self, message_id: int) -> None:
+        self._messages.pop(message_id, None)
+
+    def add(self, message_id: int, reaction: str, user_id: int) -> None:
+        """Record that a user reacted to a message"""
+        if (reactions := self._messages.get(message_id)) is None:
+            return
+
+        reactions.setdefault(reaction, set()).add(user_id)
+
+    def remove(self, message_id: int, reaction: str, user_id: int) -> None:
+        """Record that a user took back their reaction to a message"""
+        if not (user_ids := self._messages.get(message_id, {}).get(reaction)):
+            return
+
+        user_ids.discard(user_id)
+
+        if not user_ids:
+            del self._messages[message_id][reaction]
+
+    def clear(self, message_id: int, reaction: str = None) -> None:
+        """Record that the reactions of a message were removed by a moderator
+        Arguments:
+            message_id::int
+            reaction::str
+                The only emoji that was removed. Default is all of them
+        """
+        if (reactions := self._messages.get(message_id)) is None:
+            return
+
+        if reaction is None:
+            reactions.clear()
+        else:
+            reactions.pop(reaction, None)
+
+    def get_users(self, message_id: int, reaction: str) -> set[int]:
+        """Get who reacted to a message with an emoji"""
+        return self._messages.get(message_id, {}).get(reaction, set())
+
+    def get_user_reactions(self, message_id: int, user_id: int) -> set[str]:
+        """Get the emojis a user reacted to a message with"""
+        return {em for em, user_ids in self._messages.get(message_id, {}).items() if user_id in user_ids}
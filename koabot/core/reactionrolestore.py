@@ -0,0 +1,100 @@
+"""Storage of reaction role binds in the database"""
+from dataclasses import dataclass, field
+
+import aiosqlite
+
+
+@dataclass
+class RRLink():
+    reactions: set[str]
+    roles: list[int] = field(default_factory=list)
+
+
+class ReactionRoleStore():
+    """Keeps the reaction role binds of every message, each saved on its own as it changes
+    Arguments:
+        conn::aiosqlite.Connection
+            The connection to the database holding the tables in db/schema/reactionroles.sql
+    """
+
+    def __init__(self, conn: aiosqlite.Connection) -> None:
+        self.conn = conn
+
+    async def get_all(self) -> dict[int, tuple[int, list[RRLink]]]:
+        """Get the channel id and links of every enabled bind, by message id"""
+        binds: dict[int, tuple[int, list[RRLink]]] = {}
+        links: dict[int, RRLink] = {}
+
+        query = """SELECT rr.messageDId, rr.channelDId, ln.linkId FROM reactionRoles rr
+            LEFT JOIN rrLink ln ON ln.rrId = rr.rrId
+            WHERE rr.isEnabled
+            ORDER BY ln.linkId"""
+        async with self.conn.execute(query) as cursor:
+            async for message_id, channel_id, link_id in cursor:
+                _, bind_links = binds.setdefault(message_id, (channel_id, []))
+
+                if link_id is not None:
+                    links[link_id] = RRLink(set())
+                    bind_links.append(links[link_id])
+
+        async with self.conn.execute("SELECT linkId, reaction FROM rrLinkReaction") as cursor:
+            async for link_id, reaction in cursor:
+                if link_id in links:
+                    links[link_id].reactions.add(reaction)
+
+        query = """SELECT rel.linkId, rl.roleDId FROM rrRelationships rel
+            INNER JOIN discordRole rl ON rl.roleId = rel.roleId
+            ORDER BY rel.rowid"""
+        async with self.conn.execute(query) as cursor:
+            async for link_id, role_id in cursor:
+                if link_id in links:
+                    links[link_id].roles.append(role_id)
+
+        return binds
+
+    async def put(self, message_id: int, channel_id: int, links: list[RRLink]) -> None:
+        """Save the bind of a message, replacing the one it had"""
+        await self.put_many({message_id: (channel_id, links)})
+
+    async def put_many(self, binds: dict[int, tuple[int, list[RRLink]]]) -> None:
+        """Save the binds of several messages in a single transaction
+        Arguments:
+            binds::dict[int, tuple[int, list[RRLink]]]
+                The channel id and links of each bind, by message id
+        """
+        try:
+            for message_id, (channel_id, links) in binds.items():
+                await self._write(message_id, channel_id, links)
+        except BaseException:
+            await self.conn.rollback()
+            raise
+
+        await self.conn.commit()
+
+    async def _write(self, message_id: int, channel_id: int, links: list[RRLink]) -> None:
+        query = """INSERT INTO reactionRoles (messageDId, channelDId) VALUES (?, ?)
+            ON CONFLICT (messageDId) DO UPDATE SET channelDId = excluded.channelDId"""
+        await self.conn.execute(query, (message_id, channel_id))
+
+        # RETURNING would do, but it needs sqlite 3.35 and Debian bullseye ships 3.34
+        async with self.conn.execute("SELECT rrId FROM reactionRoles WHERE messageDId = ?", (message_id,)) as cursor:
+            (rr_id,) = await cursor.fetchone()
+
+        # the old links of the message are dropped rather than diffed, there's only ever a handful of them
+        old_links = "SELECT linkId FROM rrLink WHERE rrId = ?"
+        await self.conn.execute(f"DELETE FROM rrLinkReaction WHERE linkId IN ({old_links})", (rr_id,))
+        await self.conn.execute(f"DELETE FROM rrRelationships WHERE linkId IN ({old_links})", (rr_id,))
+        await self.conn.execute("DELETE FROM rrLink WHERE rrId = ?", (rr_id,))
+
+        role_ids = {role_id for link in links for role_id in link.roles}
+        await self.conn.executemany("INSERT INTO discordRole (roleDId) VALUES (?) ON CONFLICT (roleDId) DO NOTHING",
+                                    [(role_id,) for role_id in role_ids])
+
+        for link in links:
+            async with self.conn.execute("INSERT INTO rrLink (rrId) VALUES (?)", (rr_id,)) as cursor:
+                link_id = cursor.lastrowid
+
+            await self.conn.executemany("INSERT INTO rrLinkReaction (linkId, reaction) VALUES (?, ?)",
+                                        [(link_id, reaction) for reaction in link.reactions])
+            await self.conn.executemany("""INSERT OR IGNORE INTO rrRelationships (linkId, roleId)
+                SELECT ?, roleId FROM discordRole WHERE roleDId = ?""", [(link_id, role_id) for role_id in link.roles])
@@ -0,0 +1,107 @@
+"""Grouping the role changes of a member into a single edit"""
+import asyncio
+from dataclasses import dataclass, field
+
+import discord
+
+MemberKey = tuple[int, int]
+
+
+@dataclass
+class PendingRoleChanges():
+    member: discord.Member
+    future: asyncio.Future
+    reason: str | None = None
+    # role id -> (role, whether it's granted or taken away)
+    changes: dict[int, tuple[discord.Role, bool]] = field(default_factory=dict)
+
+
+class RoleChangeCoalescer():
+    """Collects the roles granted to and taken from a member within a short window,
+    then applies what changed overall with one Member.edit call.
+    A role that's granted and taken away within the window is left as it was.
+    Keywords:
+        window::float
+            Seconds to wait for more changes after the first one arrives. Default is 1
+    """
+
+    def __init__(self, **kwargs) -> None:
+        self.window: float = kwargs.get('window', 1.0)
+        self._pending: dict[MemberKey, PendingRoleChanges] = {}
+        self._in_flight: dict[MemberKey, asyncio.Task] = {}
+        # roles a member was left with by the last edit, since the cache may not have caught up yet
+        self._applied_roles: dict[MemberKey, list[discord.Role]] = {}
+
+        self.changes_queued = 0
+        self.edits = 0
+
+    async def add_roles(self, member: discord.Member, roles: list[discord.Role], *, reason: str = None) -> None:
+        """Grant roles to a member. Returns once they've been granted"""
+        await self._queue(member, roles, True, reason)
+
+    async def remove_roles(self, member: discord.Member, roles: list[discord.Role], *, reason: str = None) -> None:
+        """Take roles away from a member. Returns once they've been taken away"""
+        await self._queue(member, roles, False, reason)
+
+    async def _queue(self, member: discord.Member, roles: list[discord.Role], grant: bool, reason: str | None) -> None:
+        key = (member.guild.id, member.id)
+
+        if (pending := self._pending.get(key)) is None:
+            loop = asyncio.get_running_loop()
+            pending = self._pending[key] = PendingRoleChanges(member, loop.create_future())
+            loop.call_later(self.window, self._flush, key)
+
+        pending.member = member
+        pending.reason = reason or pending.reason
+
+        for role in roles:
+            pending.changes[role.id] = (role, grant)
+
+        self.changes_queued += len(roles)
+        # shielded so one caller giving up doesn't cancel the edit for everyone else
+        await asyncio.shield(pending.future)
+
+    def _flush(self, key: MemberKey) -> None:
+        pending = self._pending.pop(key)
+        # edits of the same member go one after the other, each building on the last
+        previous = self._in_flight.get(key)
+        task = self._in_flight[key] = asyncio.create_task(self._apply(key, pending, previous))
+        task.add_done_callback(lambda _: self._forget_flush(key, task))
+
+    def _forget_flush(self, key: MemberKey, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+            self._applied_roles.pop(key, None)
+
+    async def _apply(self, key: MemberKey, pending: PendingRoleChanges, previous: asyncio.Task | None) -> None:
+        try:
+            await self._edit(key, pending, previous)
+        except Exception as e:
+            pending.future.set_exception(e)
+            # nobody may be waiting anymore
+            pending.future.exception()
+        else:
+            pending.future.set_result(None)
+        finally:
+            # i.e. cancelled on shutdown. Whoever is waiting is let go rather than left hanging
+            if not pending.future.done():
+                pending.future.cancel()
+
+    async def _edit(self, key: MemberKey, pending: PendingRoleChanges, previous: asyncio.Task | None) -> None:
+        if previous:
+            await asyncio.wait([previous])
+
+        member = pending.member.guild.get_member(pending.member.id) or pending.member
+
+        if not previous or (current_roles := self._applied_roles.get(key)) is None:
+            # the first role is @everyone, which can't be assigned
+            current_roles = member.roles[1:]
+
+        current_ids = {role.id for role in current_roles}
+        new_roles = [role for role in current_roles if pending.changes.get(role.id, (role, True))[1]]
+        new_roles += [role for role, grant in pending.changes.values() if grant and role.id not in current_ids]
+
+        if {role.id for role in new_roles} != current_ids:
+            await member.edit(roles=new_roles, reason=pending.reason)
+            self.edits += 1
+            self._applied_roles[key] = new_roles
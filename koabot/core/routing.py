@@ -0,0 +1,115 @@
+"""Finding urls in text and routing them to the sites that handle them"""
+import re
+from functools import lru_cache
+from typing import Any, Iterator
+from urllib.parse import urlsplit
+
+import tldextract
+
+from koabot.patterns import URL_PATTERN
+
+
+def find_urls(text: str, /) -> Iterator[tuple[str, str]]:
+    """Find all urls in a text along with their hostnames, ignoring those enclosed in <>"""
+    text_length = len(text)
+
+    for url_match in URL_PATTERN.finditer(text):
+        start, end = url_match.span()
+
+        # <url> suppresses the embed, so it's not meant to be previewed either
+        if start > 0 and text[start - 1] == '<' and end < text_length and text[end] == '>':
+            continue
+
+        url = url_match.group()
+        yield url, get_hostname(url)
+
+
+def get_hostname(url: str, /) -> str:
+    """Get the hostname of an url, lowercased and without port or credentials"""
+    try:
+        hostname = urlsplit(url).hostname
+    except ValueError:
+        # malformed, i.e. unbalanced brackets. Let the public suffix list sort it out
+        return get_fqdn(url)
+
+    return hostname.rstrip('.') if hostname else ""
+
+
+@lru_cache(maxsize=1024)
+def get_fqdn(url: str, /) -> str:
+    """Get the fully qualified domain name of an url using the public suffix list"""
+    return tldextract.extract(url).fqdn
+
+
+class DomainTrieNode():
+    def __init__(self) -> None:
+        self.children: dict[str, DomainTrieNode] = {}
+        # indexes of the routes ending here
+        self.exact: int = None
+        self.wildcard: int = None
+
+
+class DomainRouter():
+    """Matches hostnames against a list of patterns in one lookup, however many there are.
+
+    Patterns use * as a wildcard (i.e. "*.donmai.us") and must match the whole host.
+    Plain hosts and hosts with a leading "*." go into a trie of reversed labels, anything
+    else is folded into one compiled regex. When several patterns match a host, the one
+    added first wins.
+    """
+
+    def __init__(self) -> None:
+        self.routes: list[Any] = []
+        self._trie = DomainTrieNode()
+        self._patterns: list[str] = []
+        self._regex: re.Pattern = None
+
+    def add(self, pattern: str, value: Any) -> None:
+        """Route the hosts matching a pattern to a value"""
+        index = len(self.routes)
+        self.routes.append(value)
+        labels = pattern.lower().split('.')
+
+        if '*' not in pattern:
+            node = self._get_node(labels)
+            if node.exact is None:
+                node.exact = index
+        elif labels[0] == '*' and '*' not in pattern[1:]:
+            node = self._get_node(labels[1:])
+            if node.wildcard is None:
+                node.wildcard = index
+        else:
+            regex = re.escape(pattern.lower()).replace(r'\*', '.*?')
+            self._patterns.append(f"(?P<r{index}>{regex})")
+            self._regex = re.compile('|'.join(self._patterns))
+
+    def _get_node(self, labels: list[str]) -> DomainTrieNode:
+        node = self._trie
+        for label in reversed(labels):
+            node = node.children.setdefault(label, DomainTrieNode())
+
+        return node
+
+    def route(self, host: str) -> Any | None:
+        """Get the value of the first pattern that matches the host, if any"""
+        host = host.lower()
+        best: int = None
+
+        node = self._trie
+        labels = host.split('.')
+        for remaining in range(len(labels), 0, -1):
+            if not (node := node.children.get(labels[remaining - 1])):
+                break
+
+            # a wildcard needs at least one more label in front of it
+            if node.wildcard is not None and remaining > 1:
+                best = node.wildcard if best is None else min(best, node.wildcard)
+        else:
+            if node.exact is not None:
+                best = node.exact if best is None else min(best, node.exact)
+
+        if self._regex and (regex_match := self._regex.fullmatch(host)):
+            index = int(regex_match.lastgroup[1:])
+            best = index if best is None else min(best, index)
+
+        return self.routes[best] if best is not None else None
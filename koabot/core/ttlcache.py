@@ -0,0 +1,84 @@
+"""In-memory cache whose entries expire"""
+import time
+from collections import OrderedDict
+from typing import Any, Generic, Hashable, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+# stands in for values that are known not to exist
+MISSING = object()
+
+
+class TTLCache(Generic[K, V]):
+    """LRU cache whose entries expire after a while. It can also remember that something doesn't exist
+    Keywords:
+        max_entries::int
+            How many entries are kept. The least recently used ones are dropped past it. Default is 1024
+        ttl::float
+            Seconds an entry is kept. Default is 300
+        negative_ttl::float
+            Seconds it's remembered that something doesn't exist. Default is 60
+    """
+
+    def __init__(self, **kwargs) -> None:
+        self.max_entries: int = kwargs.get('max_entries', 1024)
+        self.ttl: float = kwargs.get('ttl', 300)
+        self.negative_ttl: float = kwargs.get('negative_ttl', 60)
+        # key -> (expiry time, value)
+        self._entries: OrderedDict[K, tuple[float, Any]] = OrderedDict()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return self._lookup(key) is not None
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.negative_hits + self.misses
+        return (self.hits + self.negative_hits) / lookups if lookups else 0.0
+
+    def _lookup(self, key: K) -> tuple[float, Any] | None:
+        if (entry := self._entries.get(key)) is None:
+            return None
+
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+
+        return entry
+
+    def get(self, key: K, default: Any = None) -> V | Any:
+        """Get the value of a key. Returns MISSING if it's known not to exist, or default if it's not cached"""
+        if (entry := self._lookup(key)) is None:
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+
+        if entry[1] is MISSING:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+
+        return entry[1]
+
+    def put(self, key: K, value: V) -> None:
+        """Store the value of a key"""
+        self._store(key, value, self.ttl)
+
+    def put_missing(self, key: K) -> None:
+        """Remember that a key doesn't exist"""
+        self._store(key, MISSING, self.negative_ttl)
+
+    def _store(self, key: K, value: Any, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -1,4 +1,5 @@
 """The main bot class"""
+import asyncio
 import os
 import re
 import timeit
@@ -11,6 +12,13 @@ import discord
 from discord.ext import commands
 from tqdm import tqdm
 
+import koabot.core.imagehashing as imagehashing
+import koabot.core.net as net_core
+from koabot.core.blobstore import BlobStore
+from koabot.core.filecache import FileCaches
+from koabot.core.memberstore import MemberStore
+from koabot.core.nearduplicates import NearDuplicateIndex
+
 
 class BaseDirectory(Enum):
     PROJECT_NAME = 1
@@ -29,6 +37,11 @@ class KBot(commands.Bot):
         self.launch_time: datetime = None
         self.connect_time: datetime = None
         self.isconnected: bool = False
+        self.net_session: net_core.NetSession = None
+        self.image_hasher: imagehashing.ImageHasher = None
+        self.duplicate_index = NearDuplicateIndex()
+        self.blob_store: BlobStore = None
+        self.file_caches: FileCaches = None
 
         self.PROJECT_NAME: str = None
         self.PROJECT_DIR: Path = None
@@ -38,13 +51,57 @@ class KBot(commands.Bot):
         self.CACHE_DIR: Path = None
 
     async def setup_hook(self):
+        net_config: dict = dict(self.koa.get('net', {}))
+        net_config['rate_limits'] = net_config.get('rate_limits', {}) | self.get_domain_settings('rate_limit')
+        net_config['cache_ttls'] = net_config.get('cache_ttls', {}) | self.get_domain_settings('cache')
+        net_config.setdefault('cache_dir', Path(self.CACHE_DIR, "http"))
+
+        self.net_session = net_core.NetSession(**net_config)
+        net_core.set_net_session(self.net_session)
+        await asyncio.to_thread(self.net_session.response_cache.reconcile)
+
+        self.blob_store = BlobStore(Path(self.CACHE_DIR, "blobs"), self.database_conn)
+        self.file_caches = FileCaches(self.CACHE_DIR, blob_store=self.blob_store, **self.koa.get('file_cache', {}))
+        await asyncio.to_thread(self.file_caches.reconcile_all)
+        await self.blob_store.collect_garbage()
+
+        self.image_hasher = imagehashing.ImageHasher(**self.koa.get('image_hashing', {}))
+        imagehashing.set_image_hasher(self.image_hasher)
+        await self.duplicate_index.load(imagehashing.PostHashIndex(self.database_conn))
+
         self.add_check(debug_check)
         self.loop.create_task(self.run_once_when_ready())
 
+    async def close(self) -> None:
+        await super().close()
+
+        if self.net_session:
+            await self.net_session.close()
+
+        if self.image_hasher:
+            self.image_hasher.close()
+
     async def run_once_when_ready(self) -> None:
         await self.wait_until_ready()
         await self.populate_server_db()
 
+    def get_domain_settings(self, setting: str) -> dict[str, dict]:
+        """Collect a per-domain network setting (i.e. rate_limit) declared in each site's assets"""
+        domain_settings: dict[str, dict] = {}
+
+        for site_name, site in self.assets.items():
+            if not isinstance(site, dict) or setting not in site:
+                continue
+
+            values = dict(site[setting])
+            if not (domains := values.pop('domains', [])):
+                print(f"WARNING: The {setting} of \"{site_name}\" doesn't list any domains to apply to.")
+
+            for domain in domains:
+                domain_settings[domain] = values
+
+        return domain_settings
+
     def set_base_directory(self, directory: BaseDirectory, value: str | Path) -> None:
         match directory:
             case BaseDirectory.PROJECT_NAME:
@@ -111,66 +168,22 @@ class KBot(commands.Bot):
         print(log_msg)
 
     async def populate_server_db(self) -> None:
-        conn = self.database_conn
-        srv_query = "INSERT INTO discordServer (serverDId, serverName, dateFirstSeen) VALUES (?, ?, ?)"
-        usr_query = "INSERT INTO discordUser (userDid, userName, dateFirstSeen) VALUES (?, ? ,?)"
-        srv_usr_query = "INSERT INTO discordServerUser (userId, serverId, userNickname) VALUES (?, ?, ?)"
-
-        async with conn.cursor() as cursor:
-            for guild in self.guilds:
-                guild_id: int
-                try:
-                    await cursor.execute(srv_query, (guild.id, guild.name, datetime.now()))
-                    guild_id = cursor.lastrowid
-                    await conn.commit()
-                except aiosqlite.IntegrityError:
-                    # print(f"Guild '{guild.name}' is already in the database")
-                    await cursor.execute("SELECT serverId FROM discordServer WHERE serverDId = ?", (guild.id, ))
-                    guild_id, = await cursor.fetchone()
-
-                for member in guild.members:
-                    member_id: int
-                    try:
-                        await cursor.execute(usr_query, (member.id, member.name, datetime.now()))
-                        member_id = cursor.lastrowid
-                    except aiosqlite.IntegrityError:
-                        # print(f"Member '{member.name}' is already in the database")
-                        await cursor.execute("SELECT userId FROM discordUser WHERE userDId = ?", (member.id, ))
-                        member_id, = await cursor.fetchone()  # unpacking tuple
-
-                    try:
-                        await cursor.execute(srv_usr_query, (member_id, guild_id, member.nick))
-                        await conn.commit()
-                    except aiosqlite.IntegrityError:
-                        # print("This user-guild pair already exists")
-                        ...
+        """Bring the servers the bot is in and all of their members up to date in the database"""
+        member_store = MemberStore(self.database_conn)
+        start_time = timeit.default_timer()
+        member_count = 0
 
-    async def add_member_to_db(self, member: discord.Member) -> None:
-        conn = self.database_conn
-        srv_query = "INSERT INTO discordServer (serverDId, serverName, dateFirstSeen) VALUES (?, ?, ?)"
-        usr_query = "INSERT INTO discordUser (userDid, userName, dateFirstSeen) VALUES (?, ? ,?)"
-        srv_usr_query = "INSERT INTO discordServerUser (userId, serverId, userNickname) VALUES (?, ?, ?)"
-        async with conn.cursor() as cursor:
-            guild = member.guild
-            try:
-                await cursor.execute(srv_query, (guild.id, guild.name, datetime.now()))
-                await conn.commit()
-            except aiosqlite.IntegrityError:
-                # print(f"Guild '{guild.name}' is already in the database")
-                ...
+        for guild in tqdm(self.guilds, ncols=75):
+            members = [(member.id, member.name, member.nick) for member in guild.members]
+            await member_store.sync_guild(guild.id, guild.name, members)
+            member_count += len(members)
 
-            try:
-                await cursor.execute(usr_query, (member.id, member.name, datetime.now()))
-            except aiosqlite.IntegrityError:
-                # print(f"Member '{member.name}' is already in the database")
-                ...
+        time_to_finish = timeit.default_timer() - start_time
+        print(f"Synced {member_count} members of {len(self.guilds)} servers to the database in {time_to_finish:0.2f}s.")
 
-            try:
-                await cursor.execute(srv_usr_query, (member.id, guild.id, member.nick))
-                await conn.commit()
-            except aiosqlite.IntegrityError:
-                # print("This user-guild pair already exists")
-                ...
+    async def add_member_to_db(self, member: discord.Member) -> None:
+        guild = member.guild
+        await MemberStore(self.database_conn).sync_guild(guild.id, guild.name, [(member.id, member.name, member.nick)])
 
 
 async def debug_check(ctx: commands.Context) -> bool:
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from koabot.core.batching import Batcher
+
+
+def test_keys_asked_together_share_a_call():
+    calls = []
+
+    async def fetch_many(keys: list[int]) -> dict[int, str]:
+        calls.append(keys)
+        return {key: f"post {key}" for key in keys if key != 3}
+
+    async def ask():
+        batcher = Batcher(fetch_many)
+        together = await asyncio.gather(batcher.get(1), batcher.get(2), batcher.get(1), batcher.get(3))
+        later = await batcher.get(4)
+        return together, later
+
+    together, later = asyncio.run(ask())
+
+    assert together == ["post 1", "post 2", "post 1", None]
+    assert later == "post 4"
+    assert calls == [[1, 2, 3], [4]]
+
+
+def test_errors_reach_every_caller():
+    async def fetch_many(keys: list[int]) -> dict[int, str]:
+        raise RuntimeError("board is down")
+
+    async def ask():
+        batcher = Batcher(fetch_many)
+        return await asyncio.gather(batcher.get(1), batcher.get(2), return_exceptions=True)
+
+    results = asyncio.run(ask())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_cancelled_caller_does_not_cancel_the_batch():
+    async def fetch_many(keys: list[int]) -> dict[int, str]:
+        await asyncio.sleep(0.02)
+        return {key: str(key) for key in keys}
+
+    async def ask():
+        batcher = Batcher(fetch_many)
+        impatient = asyncio.create_task(batcher.get(1))
+        patient = asyncio.create_task(batcher.get(1))
+        await asyncio.sleep(0.015)
+        impatient.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await impatient
+
+        return await patient
+
+    assert asyncio.run(ask()) == "1"
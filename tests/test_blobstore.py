@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import aiosqlite
+
+from koabot.core.blobstore import BlobStore
+
+SCHEMA = Path(__file__).parent.parent / "db" / "database.sql"
+
+
+def with_store(tmp_path: Path, test):
+    async def run():
+        async with aiosqlite.connect(":memory:") as conn:
+            await conn.executescript(SCHEMA.read_text(encoding="UTF-8"))
+            return await test(BlobStore(Path(tmp_path, "blobs"), conn))
+
+    return asyncio.run(run())
+
+
+def write_file(path: Path, data: bytes) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def test_files_are_sharded_by_digest(tmp_path: Path):
+    async def test(store: BlobStore):
+        path = write_file(Path(tmp_path, "danbooru", "1.png"), b"image")
+        digest = await store.put_file(path, "https://cdn.donmai.us/1.png")
+
+        assert digest == hashlib.sha256(b"image").hexdigest()
+        assert store.get_path(digest) == Path(store.directory, digest[:2], digest[2:4], digest)
+        assert await store.get_by_url("https://cdn.donmai.us/1.png") == store.get_path(digest)
+        assert await store.get_by_url("https://cdn.donmai.us/2.png") is None
+
+    with_store(tmp_path, test)
+
+
+def test_identical_files_share_a_blob(tmp_path: Path):
+    async def test(store: BlobStore):
+        first = write_file(Path(tmp_path, "danbooru", "1.png"), b"image")
+        second = write_file(Path(tmp_path, "pixiv", "1_p0.png"), b"image")
+        digest = await store.put_file(first, "https://a")
+        await store.put_file(second, "https://b")
+
+        assert store.deduplicated == 1
+        assert os.path.samefile(first, second)
+        assert store.get_path(digest).stat().st_nlink == 3
+
+    with_store(tmp_path, test)
+
+
+def test_link_into_another_cache(tmp_path: Path):
+    async def test(store: BlobStore):
+        digest = await store.put_bytes(b"thumbnail", "https://thumb")
+        linked = store.link(digest, Path(tmp_path, "pixiv", "copy.png"))
+
+        assert linked.read_bytes() == b"thumbnail"
+        assert await store.read("https://thumb") == b"thumbnail"
+
+    with_store(tmp_path, test)
+
+
+def test_release_once_unlinked(tmp_path: Path):
+    async def test(store: BlobStore):
+        first = write_file(Path(tmp_path, "danbooru", "1.png"), b"image")
+        second = write_file(Path(tmp_path, "pixiv", "1_p0.png"), b"image")
+        digest = await store.put_file(first, "https://a")
+        await store.put_file(second, "https://b")
+
+        first.unlink()
+        assert not store.release(digest)
+        second.unlink()
+        assert store.release(digest)
+        assert not store.get_path(digest).exists()
+        assert await store.get_by_url("https://a") is None
+
+    with_store(tmp_path, test)
+
+
+def test_garbage_collection(tmp_path: Path):
+    async def test(store: BlobStore):
+        linked = write_file(Path(tmp_path, "danbooru", "1.png"), b"kept")
+        await store.put_file(linked, "https://kept")
+        fresh_digest = await store.put_bytes(b"fresh", "https://fresh")
+        stale_digest = await store.put_bytes(b"stale", "https://stale")
+        os.utime(store.get_path(stale_digest), (time.time() - 3600, time.time() - 3600))
+
+        assert await store.collect_garbage(max_idle=60) == 1
+        assert await store.read("https://stale") is None
+        assert await store.read("https://fresh") == b"fresh"
+        assert await store.read("https://kept") == b"kept"
+
+        linked.unlink()
+        os.utime(store.get_path(fresh_digest), (0, 0))
+        assert await store.collect_garbage(max_idle=60) == 1
+        assert await store.read("https://fresh") is None
+
+    with_store(tmp_path, test)
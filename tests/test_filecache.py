@@ -0,0 +1,164 @@
+import asyncio
+import os
+from pathlib import Path
+
+import aiosqlite
+
+import koabot.core.blobstore as blobstore
+import koabot.core.net as net_core
+from koabot.core.blobstore import BlobStore
+from koabot.core.filecache import FileCache, FileCaches
+
+SCHEMA = Path(__file__).parent.parent / "db" / "database.sql"
+
+
+def write_file(directory: Path, name: str, size: int, mtime: float = None) -> Path:
+    path = Path(directory, name)
+    path.write_bytes(b"x" * size)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_reconcile_orders_by_last_use(tmp_path: Path):
+    write_file(tmp_path, "new.png", 10, mtime=300)
+    write_file(tmp_path, "old.png", 10, mtime=100)
+    write_file(tmp_path, "mid.png", 10, mtime=200)
+    write_file(tmp_path, ".half.png.part", 10)
+
+    cache = FileCache(tmp_path, max_bytes=20)
+    cache.reconcile()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["mid.png", "new.png"]
+    assert (len(cache), cache.total_bytes, cache.evictions) == (2, 20, 1)
+
+
+def test_evicts_least_recently_used(tmp_path: Path):
+    cache = FileCache(tmp_path, max_bytes=25)
+    cache.reconcile()
+
+    for name in ("a", "b"):
+        write_file(tmp_path, name, 10)
+        cache.add(name)
+
+    assert cache.get("a")
+    write_file(tmp_path, "c", 10)
+    cache.add("c")
+
+    assert cache.get("b") is None
+    assert not Path(tmp_path, "b").exists()
+    assert cache.get("a") and cache.get("c")
+    assert cache.total_bytes == 20
+
+
+def test_keeps_newest_file_over_budget(tmp_path: Path):
+    cache = FileCache(tmp_path, max_bytes=5)
+    cache.reconcile()
+    write_file(tmp_path, "big", 10)
+    cache.add("big")
+
+    assert cache.get("big")
+
+
+def test_forgets_files_removed_from_disk(tmp_path: Path):
+    cache = FileCache(tmp_path, max_bytes=100)
+    cache.reconcile()
+    write_file(tmp_path, "a", 10).unlink()
+    cache.add("a")
+    write_file(tmp_path, "b", 10)
+    cache.add("b")
+    Path(tmp_path, "b").unlink()
+
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert (len(cache), cache.total_bytes) == (0, 0)
+
+
+def test_namespace_budgets(tmp_path: Path):
+    Path(tmp_path, "pixiv", "files").mkdir(parents=True)
+    caches = FileCaches(tmp_path, max_mb=1, namespaces={'danbooru': {'max_mb': 4}})
+    caches.reconcile_all()
+
+    assert [namespace for namespace, _ in caches] == ['pixiv']
+    assert caches.get('danbooru').max_bytes == 4 * 2**20
+    assert caches.get('pixiv').max_bytes == 2**20
+    assert Path(tmp_path, "danbooru", "files").is_dir()
+
+
+def test_downloads_go_through_blob_store(tmp_path: Path, monkeypatch):
+    downloads = []
+
+    async def download_image(url: str, path: Path, **kwargs) -> Path:
+        downloads.append(url)
+        return write_file(path.parent, path.name, 10)
+
+    monkeypatch.setattr(net_core, 'download_image', download_image)
+
+    async def download_twice():
+        async with aiosqlite.connect(":memory:") as conn:
+            await conn.executescript(SCHEMA.read_text(encoding="UTF-8"))
+            caches = FileCaches(tmp_path, blob_store=BlobStore(Path(tmp_path, "blobs"), conn))
+            first = await caches.get('danbooru').download("1.png", "https://cdn.donmai.us/1.png")
+            second = await caches.get('pixiv').download("copy.png", "https://cdn.donmai.us/1.png")
+            return caches, first, second
+
+    caches, first, second = asyncio.run(download_twice())
+
+    assert downloads == ["https://cdn.donmai.us/1.png"]
+    assert os.path.samefile(first, second)
+    assert caches.get('pixiv').get("copy.png") == second
+
+
+def test_eviction_releases_blobs(tmp_path: Path, monkeypatch):
+    async def download_image(url: str, path: Path, **kwargs) -> Path:
+        return write_file(path.parent, path.name, int(url[-1]))
+
+    monkeypatch.setattr(net_core, 'download_image', download_image)
+
+    async def fill_cache():
+        async with aiosqlite.connect(":memory:") as conn:
+            await conn.executescript(SCHEMA.read_text(encoding="UTF-8"))
+            blob_store = BlobStore(Path(tmp_path, "blobs"), conn)
+            cache = FileCache(Path(tmp_path, "danbooru"), max_bytes=10, blob_store=blob_store)
+            cache.reconcile()
+
+            for size in (4, 5, 6):
+                await cache.download(f"{size}.png", f"https://cdn.donmai.us/{size}")
+
+            return blob_store
+
+    blob_store = asyncio.run(fill_cache())
+    blobs = [path for path in blob_store.directory.glob("??/??/*")]
+
+    assert blob_store.released == 2
+    assert sum(path.stat().st_size for path in blobs) == 6
+
+
+def test_reconcile_finds_blobs_without_hashing(tmp_path: Path, monkeypatch):
+    async def download_image(url: str, path: Path, **kwargs) -> Path:
+        return write_file(path.parent, path.name, int(url[-1]))
+
+    monkeypatch.setattr(net_core, 'download_image', download_image)
+
+    async def restart_smaller():
+        async with aiosqlite.connect(":memory:") as conn:
+            await conn.executescript(SCHEMA.read_text(encoding="UTF-8"))
+            blob_store = BlobStore(Path(tmp_path, "blobs"), conn)
+            caches = FileCaches(tmp_path, blob_store=blob_store)
+
+            for size in (4, 5):
+                await caches.get('danbooru').download(f"{size}.png", f"https://cdn.donmai.us/{size}")
+
+            def no_hashing(path):
+                raise AssertionError("files shouldn't be hashed to find their blob")
+
+            monkeypatch.setattr(blobstore, 'hash_file', no_hashing)
+            restarted = FileCaches(tmp_path, blob_store=blob_store, namespaces={'danbooru': {'max_mb': 5 / 2**20}})
+            await asyncio.to_thread(restarted.reconcile_all)
+            return blob_store
+
+    blob_store = asyncio.run(restart_smaller())
+    blobs = [path for path in blob_store.directory.glob("??/??/*")]
+
+    assert blob_store.released == 1
+    assert [path.stat().st_size for path in blobs] == [5]
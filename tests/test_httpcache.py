@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from koabot.core.httpcache import CacheEntry, ResponseCache
+
+
+def make_entry(url: str, ttl: float = 60, **kwargs) -> CacheEntry:
+    return CacheEntry(url=url, status=200, body=b'{"id": 1}', expires=time.time() + ttl, **kwargs)
+
+
+def load_cache(cache_dir, **kwargs) -> ResponseCache:
+    cache = ResponseCache(cache_dir, **kwargs)
+    cache.reconcile()
+    return cache
+
+
+def test_key_depends_on_request():
+    key = ResponseCache.make_key('GET', "https://a.com", {'q': 1})
+
+    assert key == ResponseCache.make_key('GET', "https://a.com", {'q': 1})
+    assert key != ResponseCache.make_key('GET', "https://a.com", {'q': 2})
+    assert key != ResponseCache.make_key('POST', "https://a.com", {'q': 1})
+    assert key != ResponseCache.make_key('GET', "https://a.com", {'q': 1}, {'tags': "x"})
+
+
+def test_lru_evicts_oldest():
+    async def fill():
+        cache = ResponseCache(max_entries=2)
+        await cache.put('a', make_entry("a"))
+        await cache.put('b', make_entry("b"))
+        await cache.get('a')
+        await cache.put('c', make_entry("c"))
+        return [await cache.get(key) for key in ['a', 'b', 'c']]
+
+    a, b, c = asyncio.run(fill())
+    assert a is not None
+    assert b is None
+    assert c is not None
+
+
+def test_entries_persist_on_disk(tmp_path):
+    asyncio.run(load_cache(tmp_path).put('abc', make_entry("a", etag='"v1"')))
+
+    entry = asyncio.run(load_cache(tmp_path).get('abc'))
+    assert entry.body == b'{"id": 1}'
+    assert entry.etag == '"v1"'
+    assert entry.is_fresh
+
+
+def test_refresh_extends_stale_entry(tmp_path):
+    cache = load_cache(tmp_path)
+    entry = make_entry("a", ttl=-1, last_modified="Wed, 21 Oct 2015 07:28:00 GMT")
+    asyncio.run(cache.put('abc', entry))
+
+    assert not entry.is_fresh
+    assert entry.can_revalidate
+
+    asyncio.run(cache.refresh('abc', entry, 60))
+    assert asyncio.run(load_cache(tmp_path).get('abc')).is_fresh
+
+
+def test_disk_is_kept_within_budget(tmp_path):
+    async def fill():
+        cache = load_cache(tmp_path, max_disk_bytes=250)
+        for key in ['aa1', 'bb2', 'cc3']:
+            await cache.put(key, make_entry(key))
+        return cache
+
+    cache = asyncio.run(fill())
+    assert cache.disk_bytes <= 250
+    assert len(list(tmp_path.glob("??/*.json"))) < 3
+    assert asyncio.run(load_cache(tmp_path).get('cc3')) is not None
+    assert asyncio.run(load_cache(tmp_path).get('aa1')) is None
+
+
+def test_dead_entries_are_removed_from_disk(tmp_path):
+    async def fill():
+        cache = load_cache(tmp_path)
+        await cache.put('aa1', make_entry("a", ttl=-1))
+        await cache.put('bb2', make_entry("b", ttl=-1, etag='"v1"'))
+        await cache.put('cc3', make_entry("c"))
+
+    asyncio.run(fill())
+    reloaded = load_cache(tmp_path)
+    assert sorted(path.stem for path in tmp_path.glob("??/*.json")) == ['bb2', 'cc3']
+    assert asyncio.run(reloaded.get('bb2')) is not None
+    assert asyncio.run(reloaded.get('aa1')) is None
@@ -0,0 +1,80 @@
+import asyncio
+from pathlib import Path
+
+import aiosqlite
+from PIL import Image, ImageDraw
+
+from koabot.core.imagehashing import ImageHasher, ImageHashes, PostHashIndex, compute_hashes, try_compute_hashes
+
+SCHEMA = Path(__file__).parent.parent / "db" / "database.sql"
+
+
+def make_image(path: Path, shade: int, size: tuple[int, int] = (256, 256)) -> Path:
+    img = Image.new('RGB', (256, 256), (shade, 255 - shade, 128))
+    ImageDraw.Draw(img).ellipse((40, 40, 200, 160), fill=(255 - shade, shade, 0))
+    img.resize(size).save(path)
+    return path
+
+
+def test_resized_image_is_close(tmp_path: Path):
+    original = compute_hashes(make_image(tmp_path / "a.png", 30))
+    resized = compute_hashes(make_image(tmp_path / "b.png", 30, (512, 512)))
+    different = compute_hashes(make_image(tmp_path / "c.png", 220))
+
+    assert sum(original.distance(resized)) <= 10
+    assert sum(original.distance(different)) > 10
+
+
+def test_unreadable_image(tmp_path: Path):
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+
+    assert try_compute_hashes(broken) is None
+    assert try_compute_hashes(tmp_path / "missing.png") is None
+
+
+def test_hasher_keeps_order(tmp_path: Path):
+    paths = [make_image(tmp_path / f"{shade}.png", shade) for shade in (0, 120, 240)]
+    paths.insert(1, tmp_path / "missing.png")
+
+    hasher = ImageHasher(workers=2)
+    try:
+        hashes = asyncio.run(hasher.hash_files(paths))
+    finally:
+        hasher.close()
+
+    assert hashes[1] is None
+    assert [h.as_list() for h in hashes if h] == [compute_hashes(p).as_list() for p in paths if p.exists()]
+
+
+def test_hashes_survive_hex(tmp_path: Path):
+    hashes = compute_hashes(make_image(tmp_path / "a.png", 30))
+
+    assert ImageHashes.from_hex(*hashes.to_hex()).distance(hashes) == [0, 0, 0, 0]
+
+
+def test_post_hash_index(tmp_path: Path):
+    hashes = compute_hashes(make_image(tmp_path / "a.png", 30))
+    other_hashes = compute_hashes(make_image(tmp_path / "b.png", 220))
+
+    async def store_and_look_up():
+        async with aiosqlite.connect(":memory:") as conn:
+            await conn.executescript(SCHEMA.read_text(encoding="UTF-8"))
+            index = PostHashIndex(conn)
+
+            await index.put_many('danbooru', [({'id': 1, 'md5': "aa"}, hashes), ({'id': 2, 'md5': "bb"}, hashes)])
+            await index.put_many('danbooru', [({'id': 2, 'md5': "cc"}, other_hashes)])
+
+            posts = [{'id': 1, 'md5': "aa"}, {'id': 2, 'md5': "cc"}, {'id': 3, 'md5': "dd"}]
+            found = await index.get_many('danbooru', posts)
+            replaced_file = await index.get_many('danbooru', [{'id': 1, 'md5': "ee"}])
+            other_board = await index.get_many('e621', posts)
+            return found, replaced_file, other_board
+
+    found, replaced_file, other_board = asyncio.run(store_and_look_up())
+
+    assert sorted(found) == [1, 2]
+    assert found[1].distance(hashes) == [0, 0, 0, 0]
+    assert found[2].distance(other_hashes) == [0, 0, 0, 0]
+    assert replaced_file == {}
+    assert other_board == {}
@@ -0,0 +1,34 @@
+import asyncio
+from pathlib import Path
+
+import aiosqlite
+
+from koabot.core.memberstore import MemberStore
+
+SCHEMA = Path(__file__).parent.parent / "db" / "database.sql"
+
+
+def test_sync_guild_upserts():
+    async def sync_twice():
+        async with aiosqlite.connect(":memory:") as conn:
+            await conn.executescript(SCHEMA.read_text(encoding="UTF-8"))
+            store = MemberStore(conn)
+
+            await store.sync_guild(1, "koa", [(10, "alice", None), (11, "bob", "bobby")])
+            await store.sync_guild(2, "other", [(10, "alice", "al")])
+            await store.sync_guild(1, "koa renamed", [(10, "alice2", "ali"), (12, "carol", None)])
+
+            query = """SELECT s.serverDId, s.serverName, u.userDId, u.userName, su.userNickname
+                FROM discordServerUser su
+                INNER JOIN discordServer s ON s.serverId = su.serverId
+                INNER JOIN discordUser u ON u.userId = su.userId
+                ORDER BY s.serverDId, u.userDId"""
+            async with conn.execute(query) as cursor:
+                return await cursor.fetchall()
+
+    assert asyncio.run(sync_twice()) == [
+        (1, "koa renamed", 10, "alice2", "ali"),
+        (1, "koa renamed", 11, "bob", "bobby"),
+        (1, "koa renamed", 12, "carol", None),
+        (2, "other", 10, "alice2", "al"),
+    ]
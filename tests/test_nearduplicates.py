@@ -0,0 +1,75 @@
+import random
+
+import imagehash
+import numpy as np
+import pytest
+
+from koabot.core.imagehashing import ImageHashes
+from koabot.core.nearduplicates import MultiIndexHash, NearDuplicateIndex, hamming_distance
+
+
+def make_hashes(phash: int) -> ImageHashes:
+    bits = np.array([bool(phash >> i & 1) for i in reversed(range(256))]).reshape(16, 16)
+    placeholder = imagehash.ImageHash(np.zeros((2, 2), dtype=bool))
+    return ImageHashes(imagehash.ImageHash(bits), placeholder, placeholder, placeholder)
+
+
+def flip_bits(value: int, count: int, rng: random.Random, bits: int = 256) -> int:
+    for bit in rng.sample(range(bits), count):
+        value ^= 1 << bit
+    return value
+
+
+def test_multi_index_matches_linear_scan():
+    rng = random.Random(3)
+    items = [rng.getrandbits(64) for _ in range(300)]
+    # plant some near-duplicates for the search to find
+    items += [flip_bits(item, rng.randint(0, 8), rng, 64) for item in items[:100]]
+    index = MultiIndexHash(64, 8)
+    for i, item in enumerate(items):
+        index.add(item, i)
+
+    assert len(index) == 400
+
+    for query in items[:50] + [rng.getrandbits(64) for _ in range(20)]:
+        expected = sorted((hamming_distance(query, item), i) for i, item in enumerate(items)
+                          if hamming_distance(query, item) <= 8)
+        assert sorted(index.search(query)) == expected
+        assert sorted(index.search(query, 3)) == [match for match in expected if match[0] <= 3]
+
+
+def test_multi_index_keeps_identical_items():
+    index = MultiIndexHash(8, 2)
+    index.add(0b1010, 'a')
+    index.add(0b1010, 'b')
+    index.add(0b1011, 'c')
+
+    assert index.search(0b1010, 0) == [(0, 'a'), (0, 'b')]
+    assert index.search(0b1010) == [(0, 'a'), (0, 'b'), (1, 'c')]
+    with pytest.raises(ValueError):
+        index.search(0b1010, 3)
+
+
+def test_index_finds_reposts():
+    rng = random.Random(5)
+    original = rng.getrandbits(256)
+    index = NearDuplicateIndex()
+    index.add(('danbooru', 1), make_hashes(original))
+    index.add(('danbooru', 2), make_hashes(flip_bits(original, 4, rng)))
+    index.add(('pixiv', 3), make_hashes(flip_bits(original, 6, rng)))
+    index.add(('pixiv', 4), make_hashes(rng.getrandbits(256)))
+
+    assert [key for key, _ in index.search(make_hashes(original))] == [('danbooru', 1), ('danbooru', 2), ('pixiv', 3)]
+    assert index.find_reposts(('danbooru', 1), make_hashes(original)) == [(('pixiv', 3), 6)]
+
+
+def test_index_forgets_replaced_files():
+    rng = random.Random(7)
+    old, new = rng.getrandbits(256), rng.getrandbits(256)
+    index = NearDuplicateIndex()
+    index.add(('danbooru', 1), make_hashes(old))
+    index.add(('danbooru', 1), make_hashes(new))
+
+    assert len(index) == 1
+    assert index.search(make_hashes(old)) == []
+    assert index.search(make_hashes(new)) == [(('danbooru', 1), 0)]
@@ -0,0 +1,223 @@
+import asyncio
+import contextlib
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from aiohttp import web
+
+from koabot.core import net
+from koabot.core.net import NetSession, RetryPolicy, SingleFlight, parse_retry_after
+
+
+@contextlib.asynccontextmanager
+async def serve(routes: web.RouteTableDef, **kwargs):
+    """Run a local server and route every request through a fresh NetSession made with kwargs"""
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+
+    net_session = NetSession(**kwargs)
+    net.set_net_session(net_session)
+
+    try:
+        yield f"http://{host}:{port}", net_session
+    finally:
+        await net_session.close()
+        net.set_net_session(None)
+        await runner.cleanup()
+
+
+def test_retry_after_seconds():
+    assert parse_retry_after("120") == 120
+
+
+def test_retry_after_http_date():
+    retry_date = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert parse_retry_after(format_datetime(retry_date, usegmt=True)) == pytest.approx(30, abs=2)
+
+
+@pytest.mark.parametrize("retry_after", [None, "", "soon"])
+def test_retry_after_missing_or_invalid(retry_after):
+    assert parse_retry_after(retry_after) is None
+
+
+def test_retry_policy_backoff_is_bounded():
+    policy = RetryPolicy(attempts=10, backoff=0.5, max_backoff=4)
+    deadline = time.monotonic() + 60
+
+    for attempt in range(8):
+        delay = policy.get_retry_delay(502, None, attempt, deadline)
+        assert 0 <= delay <= min(4, 0.5 * 2 ** attempt)
+
+
+def test_retry_policy_honours_retry_after():
+    policy = RetryPolicy()
+    assert policy.get_retry_delay(429, "2", 0, time.monotonic() + 30) == 2
+
+
+def test_retry_policy_gives_up():
+    policy = RetryPolicy(attempts=3, max_backoff=10)
+    deadline = time.monotonic() + 30
+
+    # client errors aren't worth repeating
+    assert policy.get_retry_delay(404, None, 0, deadline) is None
+    # out of attempts
+    assert policy.get_retry_delay(502, None, 2, deadline) is None
+    # the server asks for longer than we're willing to wait
+    assert policy.get_retry_delay(429, "60", 0, deadline) is None
+    # the wait would go past the deadline
+    assert policy.get_retry_delay(429, "5", 0, time.monotonic() + 1) is None
+    # connection errors are retried
+    assert policy.get_retry_delay(None, None, 0, deadline) is not None
+
+
+def test_single_flight_collapses_concurrent_calls():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    async def concurrent():
+        flights = SingleFlight()
+        results = await asyncio.gather(*(flights.do("same", fetch) for _ in range(5)))
+        # once finished, the next call goes through again
+        results.append(await flights.do("same", fetch))
+        return flights, results
+
+    flights, results = asyncio.run(concurrent())
+    assert results == [1, 1, 1, 1, 1, 2]
+    assert flights.calls == 2
+    assert flights.collapsed == 4
+
+
+def test_single_flight_shares_errors():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream down")
+
+    async def concurrent():
+        flights = SingleFlight()
+        return await asyncio.gather(*(flights.do("same", fail) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(concurrent()))
+
+
+def test_rejected_downloads_leave_the_session_usable(tmp_path):
+    routes = web.RouteTableDef()
+
+    @routes.get("/page")
+    async def page(_):
+        return web.Response(body=b"<html></html>" * 1000, content_type="text/html")
+
+    @routes.get("/{name}.png")
+    async def image(request):
+        return web.Response(body=b"\x89PNG" * int(request.query.get("repeat", 1)), content_type="image/png")
+
+    async def download():
+        async with serve(routes) as (url, _):
+            return [await net.download_image(f"{url}/page", tmp_path / "page.png"),
+                    await net.download_image(f"{url}/big.png?repeat=1000", tmp_path / "big.png", max_size=100),
+                    await net.download_image(f"{url}/small.png", tmp_path / "small.png")]
+
+    assert asyncio.run(download()) == [None, None, tmp_path / "small.png"]
+    assert (tmp_path / "small.png").read_bytes() == b"\x89PNG"
+    assert [path.name for path in tmp_path.iterdir()] == ["small.png"]
+
+
+def test_transient_error_is_retried_through_the_host_limiter():
+    routes = web.RouteTableDef()
+    hits = 0
+
+    @routes.get("/posts")
+    async def posts(_):
+        nonlocal hits
+        hits += 1
+        if hits == 1:
+            return web.Response(status=502, headers={"Retry-After": "0"})
+
+        return web.json_response({"id": 1})
+
+    async def fetch():
+        # one request every quarter of a second, so the retry has to wait for the limiter
+        async with serve(routes, rate_limits={"127.0.0.1": {"per_second": 4, "burst": 1}}) as (url, net_session):
+            start = time.monotonic()
+            response = await net.http_request(f"{url}/posts", json=True)
+            return response, time.monotonic() - start, net_session.retry_counts[net.get_domain(url)]
+
+    response, elapsed, retries = asyncio.run(fetch())
+    assert (response.status, response.json) == (200, {"id": 1})
+    assert hits == 2
+    assert retries == 1
+    assert elapsed >= 0.2
+
+
+def test_retry_after_past_the_max_backoff_gives_up():
+    routes = web.RouteTableDef()
+    hits = 0
+
+    @routes.get("/posts")
+    async def posts(_):
+        nonlocal hits
+        hits += 1
+        return web.Response(status=503, headers={"Retry-After": "120"})
+
+    async def fetch():
+        async with serve(routes, retry={"max_backoff": 5}) as (url, _):
+            return await net.http_request(f"{url}/posts", json=True)
+
+    assert asyncio.run(fetch()).status == 503
+    assert hits == 1
+
+
+def test_cached_responses_are_revalidated_and_kept_within_budget(tmp_path):
+    routes = web.RouteTableDef()
+    hits = Counter()
+
+    @routes.get("/posts")
+    async def posts(request):
+        hits["posts"] += 1
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304, headers={"ETag": '"v1"'})
+
+        return web.json_response({"id": 1}, headers={"ETag": '"v1"'})
+
+    @routes.get("/dumps/{name}")
+    async def dumps(request):
+        hits[request.match_info["name"]] += 1
+        return web.Response(body=b"0" * 600 * 1024)
+
+    async def fetch():
+        config = {"cache_ttls": {"127.0.0.1": {"ttl": 0.5}}, "cache_dir": tmp_path, "cache_max_mb": 1}
+        async with serve(routes, **config) as (url, net_session):
+            cache = net_session.response_cache
+            responses = [await net.http_request(f"{url}/posts", json=True)]
+            # still fresh, the server isn't asked
+            responses.append(await net.http_request(f"{url}/posts", json=True))
+            assert (hits["posts"], cache.hits) == (1, 1)
+
+            await asyncio.sleep(0.6)
+            responses.append(await net.http_request(f"{url}/posts", json=True))
+            assert (hits["posts"], cache.revalidations) == (2, 1)
+            # the 304 made it fresh again
+            responses.append(await net.http_request(f"{url}/posts", json=True))
+            assert (hits["posts"], cache.hits) == (2, 2)
+
+            await net.http_request(f"{url}/dumps/a")
+            await net.http_request(f"{url}/dumps/b")
+            return responses, cache, cache.make_key("GET", f"{url}/dumps/b")
+
+    responses, cache, last_key = asyncio.run(fetch())
+    assert [(response.status, response.json) for response in responses] == [(200, {"id": 1})] * 4
+    assert (hits["a"], hits["b"]) == (1, 1)
+    assert cache.disk_bytes <= 2**20
+    # the oldest entries made room for the last one
+    assert [path.stem for path in tmp_path.glob("??/*.json")] == [last_key]
@@ -0,0 +1,164 @@
+import asyncio
+
+from koabot.core.pipeline import PreviewQueue, run_in_order
+
+
+class FakeChannel:
+    def __init__(self, sent: list) -> None:
+        self.sent = sent
+
+    async def send(self, content):
+        self.sent.append(content)
+
+
+class FakeMessage:
+    def __init__(self) -> None:
+        self.sent = []
+        self.channel = FakeChannel(self.sent)
+        self.content = "links"
+
+    async def reply(self, content):
+        self.sent.append(content)
+
+
+def make_job(name: str, delay: float, replies: int = 1):
+    async def job(msg):
+        assert msg.content == "links"
+        await asyncio.sleep(delay)
+        for i in range(replies):
+            await msg.channel.send(f"{name}{i}") if i else await msg.reply(f"{name}{i}")
+        return name
+    return job
+
+
+def test_responses_keep_message_order():
+    msg = FakeMessage()
+    jobs = [make_job("a", 0.05, 2), make_job("b", 0.01), make_job("c", 0.03)]
+
+    results = asyncio.run(run_in_order(msg, jobs))
+
+    assert results == ["a", "b", "c"]
+    assert msg.sent == ["a0", "a1", "b0", "c0"]
+
+
+def test_jobs_run_concurrently():
+    async def timed():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await run_in_order(FakeMessage(), [make_job(str(i), 0.05) for i in range(4)], max_concurrency=4)
+        return loop.time() - start
+
+    assert asyncio.run(timed()) < 0.15
+
+
+def test_concurrency_is_bounded():
+    running = peak = 0
+
+    async def job(msg):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    asyncio.run(run_in_order(FakeMessage(), [job] * 10, max_concurrency=3))
+    assert peak == 3
+
+
+def test_failed_job_doesnt_block_the_rest():
+    async def broken(msg):
+        raise RuntimeError("site is down")
+
+    msg = FakeMessage()
+    results = asyncio.run(run_in_order(msg, [broken, make_job("b", 0)]))
+
+    assert results == [None, "b"]
+    assert msg.sent == ["b0"]
+
+
+def run_queue(queue: PreviewQueue, jobs: list[tuple[int, str]], log: list) -> list:
+    async def fill_and_drain():
+        def make(name):
+            async def job():
+                log.append(name)
+                await asyncio.sleep(0)
+            return job
+
+        accepted = [queue.put(guild_id, name, make(name)) for guild_id, name in jobs]
+        queue.start()
+        while queue.depth:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        queue.stop()
+        return accepted
+
+    return asyncio.run(fill_and_drain())
+
+
+def test_queue_takes_turns_between_guilds():
+    log = []
+    jobs = [(1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (3, "c1"), (2, "b2")]
+    run_queue(PreviewQueue(workers=1), jobs, log)
+
+    assert log == ["a1", "b1", "c1", "a2", "b2", "a3"]
+
+
+def test_queue_coalesces_and_drops():
+    log = []
+    jobs = [(1, "a1"), (1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (3, "c1")]
+    queue = PreviewQueue(workers=1, max_depth=3, max_depth_per_guild=2)
+    accepted = run_queue(queue, jobs, log)
+
+    # a1 is coalesced, then pushed out by a3; c1 finds the queue full
+    assert accepted == [True, False, True, True, True, False]
+    assert log == ["a2", "b1", "a3"]
+    assert (queue.coalesced, queue.dropped, queue.completed) == (1, 2, 3)
+
+
+def test_queue_skips_expired_jobs():
+    log = []
+    queue = PreviewQueue(workers=1, deadline=-1)
+    run_queue(queue, [(1, "a1")], log)
+
+    assert log == []
+    assert queue.expired == 1
+
+
+def test_queue_workers_survive_empty_wakeups():
+    async def one_job():
+        queue = PreviewQueue(workers=4)
+        queue.start()
+        # let every worker start waiting, so that they're all woken up by the same job
+        await asyncio.sleep(0)
+        done = asyncio.Event()
+
+        async def job():
+            done.set()
+
+        queue.put(1, "a1", job)
+        await done.wait()
+        await asyncio.sleep(0.01)
+        alive = [task for task in queue._worker_tasks if not task.done()]
+        worker_count = len(queue._worker_tasks)
+        queue.stop()
+        return len(alive), worker_count
+
+    alive, worker_count = asyncio.run(one_job())
+    assert alive == worker_count == 4
+
+
+def test_queue_cancels_hung_jobs():
+    async def hang():
+        queue = PreviewQueue(workers=1, deadline=0.05)
+        queue.start()
+
+        async def job():
+            await asyncio.sleep(10)
+
+        queue.put(1, "a1", job)
+        await asyncio.sleep(0.1)
+        queue.stop()
+        return queue
+
+    queue = asyncio.run(hang())
+    assert (queue.timed_out, queue.completed) == (1, 1)
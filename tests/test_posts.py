@@ -0,0 +1,15 @@
+from koabot.core.posts import parse_tag_string
+
+
+def test_parse_tag_string():
+    tags = parse_tag_string("1girl  solo\tlong_hair ")
+
+    assert tags == frozenset({"1girl", "solo", "long_hair"})
+    assert parse_tag_string("") == frozenset()
+    assert not frozenset({"comic", "solo"}).isdisjoint(tags)
+
+
+def test_parse_tag_string_is_cached():
+    tag_string = " ".join(f"tag_{i}" for i in range(50))
+
+    assert parse_tag_string(tag_string) is parse_tag_string(tag_string)
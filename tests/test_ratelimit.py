@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+import pytest
+
+from koabot.core.ratelimit import HostLimiter, SlidingWindowCooldown, TokenBucket
+
+
+def test_bucket_allows_burst():
+    async def burst():
+        bucket = TokenBucket(1, 5)
+        start = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(burst()) < 0.1
+
+
+def test_bucket_throttles_past_burst():
+    async def throttled():
+        bucket = TokenBucket(20, 2)
+        start = time.monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # 2 free tokens, then 4 more at 20 per second
+    assert asyncio.run(throttled()) == pytest.approx(0.2, abs=0.08)
+
+
+def test_bucket_serves_callers_in_order():
+    async def ordered():
+        bucket = TokenBucket(50, 1)
+        served = []
+
+        async def caller(i):
+            await bucket.acquire()
+            served.append(i)
+
+        await asyncio.gather(*(caller(i) for i in range(8)))
+        return served
+
+    assert asyncio.run(ordered()) == list(range(8))
+
+
+def test_bucket_rejects_invalid_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(0, 1)
+
+
+def test_limiter_caps_in_flight():
+    async def in_flight():
+        limiter = HostLimiter(per_second=1000, burst=1000, max_in_flight=2)
+        current = peak = 0
+
+        async def request():
+            nonlocal current, peak
+            async with limiter:
+                current += 1
+                peak = max(peak, current)
+                await asyncio.sleep(0.01)
+                current -= 1
+
+        await asyncio.gather(*(request() for _ in range(10)))
+        return peak
+
+    assert asyncio.run(in_flight()) == 2
+
+
+def test_cooldown_blocks_over_limit(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    cooldown = SlidingWindowCooldown(3, 10, penalty=30)
+
+    assert [cooldown.hit('a') for _ in range(4)] == [False, False, False, True]
+    assert cooldown.is_blocked('a')
+    assert not cooldown.hit('b', 2)
+
+    now += 20
+    assert cooldown.hit('a')
+
+    now += 11
+    assert not cooldown.hit('a')
+
+
+def test_cooldown_window_slides(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    cooldown = SlidingWindowCooldown(3, 10)
+
+    for _ in range(3):
+        assert not cooldown.hit('a')
+        now += 4
+
+    # the first hit has left the window
+    assert not cooldown.hit('a')
+    assert cooldown.hit('a', 2)
+
+
+def test_cooldown_forgets_idle_keys(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    cooldown = SlidingWindowCooldown(1, 10, penalty=60)
+
+    cooldown.hit('a')
+    cooldown.hit('b', 5)
+    now += 5
+    cooldown.hit('c')
+
+    assert len(cooldown) == 3
+    assert cooldown.seconds_since_last('a') == 5
+
+    now += 10
+    # a is idle, b is still blocked
+    assert len(cooldown) == 2
+    assert cooldown.seconds_since_last('a') is None
+
+    now += 60
+    assert len(cooldown) == 0
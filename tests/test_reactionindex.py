@@ -0,0 +1,42 @@
+from koabot.core.reactionindex import ReactionIndex
+
+
+def test_seed_and_lookup():
+    index = ReactionIndex()
+    index.seed(1, {"🎉": {10, 11}, "🎊": {10}, "❌": set()})
+
+    assert 1 in index
+    assert index.get_user_reactions(1, 10) == {"🎉", "🎊"}
+    assert index.get_user_reactions(1, 11) == {"🎉"}
+    assert index.get_user_reactions(1, 12) == set()
+    assert index.get_users(1, "❌") == set()
+
+
+def test_events_update_seeded_messages_only():
+    index = ReactionIndex()
+    index.seed(1, {})
+    index.add(1, "🎉", 10)
+    index.add(2, "🎉", 10)
+
+    assert index.get_users(1, "🎉") == {10}
+    assert 2 not in index
+
+    index.remove(1, "🎉", 10)
+    index.remove(1, "🎊", 10)
+
+    assert index.get_user_reactions(1, 10) == set()
+
+
+def test_clear():
+    index = ReactionIndex()
+    index.seed(1, {"🎉": {10}, "🎊": {10, 11}})
+
+    index.clear(1, "🎉")
+    assert index.get_user_reactions(1, 10) == {"🎊"}
+
+    index.clear(1)
+    assert index.get_user_reactions(1, 11) == set()
+    assert 1 in index
+
+    index.forget(1)
+    assert 1 not in index
@@ -0,0 +1,62 @@
+import asyncio
+from pathlib import Path
+
+import aiosqlite
+
+from koabot.core.reactionrolestore import ReactionRoleStore, RRLink
+
+SCHEMA = Path(__file__).parent.parent / "db" / "schema" / "reactionroles.sql"
+
+
+async def open_store(conn: aiosqlite.Connection) -> ReactionRoleStore:
+    await conn.executescript(SCHEMA.read_text(encoding="UTF-8"))
+    return ReactionRoleStore(conn)
+
+
+def test_put_and_get_all():
+    async def store_and_load():
+        async with aiosqlite.connect(":memory:") as conn:
+            store = await open_store(conn)
+            await store.put(1, 10, [RRLink({"🎉"}, [100, 101]), RRLink({"🎉", "🎊"}, [102])])
+            await store.put(2, 20, [RRLink({"🎊"}, [100])])
+            return await store.get_all()
+
+    binds = asyncio.run(store_and_load())
+
+    assert binds == {
+        1: (10, [RRLink({"🎉"}, [100, 101]), RRLink({"🎉", "🎊"}, [102])]),
+        2: (20, [RRLink({"🎊"}, [100])]),
+    }
+
+
+def test_put_replaces_links():
+    async def store_twice():
+        async with aiosqlite.connect(":memory:") as conn:
+            store = await open_store(conn)
+            await store.put(1, 10, [RRLink({"🎉"}, [100]), RRLink({"🎊"}, [101])])
+            await store.put(1, 11, [RRLink({"❌"}, [101])])
+
+            async with conn.execute("SELECT COUNT(*) FROM rrLink") as cursor:
+                (link_count,) = await cursor.fetchone()
+
+            return await store.get_all(), link_count
+
+    binds, link_count = asyncio.run(store_twice())
+
+    assert binds == {1: (11, [RRLink({"❌"}, [101])])}
+    assert link_count == 1
+
+
+def test_put_many_rolls_back_on_error():
+    async def store_broken():
+        async with aiosqlite.connect(":memory:") as conn:
+            store = await open_store(conn)
+
+            try:
+                await store.put_many({1: (10, [RRLink({"🎉"}, [100])]), 2: (20, [RRLink({"🎊"}, None)])})
+            except TypeError:
+                pass
+
+            return await store.get_all()
+
+    assert asyncio.run(store_broken()) == {}
@@ -0,0 +1,119 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from koabot.core.rolechanges import RoleChangeCoalescer
+
+EVERYONE = SimpleNamespace(id=1)
+RED, GREEN, BLUE = (SimpleNamespace(id=i) for i in (2, 3, 4))
+
+
+class FakeMember():
+    def __init__(self, roles: list) -> None:
+        self.id = 10
+        self.guild = SimpleNamespace(id=1, get_member=lambda _: None)
+        self.roles = [EVERYONE, *roles]
+        self.edits = []
+
+    async def edit(self, *, roles: list, reason: str = None) -> None:
+        await asyncio.sleep(0.01)
+        self.edits.append({role.id for role in roles})
+
+
+def test_changes_are_applied_in_one_edit():
+    async def react():
+        member = FakeMember([RED])
+        coalescer = RoleChangeCoalescer(window=0.02)
+        await asyncio.gather(coalescer.add_roles(member, [GREEN]),
+                             coalescer.add_roles(member, [BLUE]),
+                             coalescer.remove_roles(member, [RED]))
+        return member, coalescer
+
+    member, coalescer = asyncio.run(react())
+
+    assert member.edits == [{GREEN.id, BLUE.id}]
+    assert coalescer.changes_queued == 3
+
+
+def test_flip_flop_is_not_applied():
+    async def react():
+        member = FakeMember([RED])
+        coalescer = RoleChangeCoalescer(window=0.02)
+        await asyncio.gather(coalescer.add_roles(member, [GREEN]),
+                             coalescer.remove_roles(member, [GREEN]),
+                             coalescer.remove_roles(member, [RED]),
+                             coalescer.add_roles(member, [RED]))
+        return member
+
+    assert asyncio.run(react()).edits == []
+
+
+def test_later_edits_build_on_earlier_ones():
+    async def react():
+        member = FakeMember([])
+        coalescer = RoleChangeCoalescer(window=0.005)
+        first = asyncio.create_task(coalescer.add_roles(member, [GREEN]))
+        # queued while the first edit is still in flight, before the member's roles are updated
+        await asyncio.sleep(0.008)
+        await coalescer.add_roles(member, [BLUE])
+        await first
+        return member, coalescer
+
+    member, coalescer = asyncio.run(react())
+
+    assert member.edits == [{GREEN.id}, {GREEN.id, BLUE.id}]
+    assert coalescer.edits == 2
+
+
+def test_errors_reach_every_caller():
+    class ForbiddenMember(FakeMember):
+        async def edit(self, *, roles: list, reason: str = None) -> None:
+            raise PermissionError()
+
+    async def react():
+        member = ForbiddenMember([])
+        coalescer = RoleChangeCoalescer(window=0.01)
+        return await asyncio.gather(coalescer.add_roles(member, [GREEN]),
+                                    coalescer.add_roles(member, [BLUE]), return_exceptions=True)
+
+    assert [type(result) for result in asyncio.run(react())] == [PermissionError, PermissionError]
+
+
+def test_cancelled_edit_releases_callers():
+    class HangingMember(FakeMember):
+        async def edit(self, *, roles: list, reason: str = None) -> None:
+            await asyncio.sleep(10)
+
+    async def react():
+        member = HangingMember([])
+        coalescer = RoleChangeCoalescer(window=0.01)
+        caller = asyncio.create_task(coalescer.add_roles(member, [GREEN]))
+        await asyncio.sleep(0.02)
+
+        # i.e. the bot shutting down
+        for task in coalescer._in_flight.values():
+            task.cancel()
+
+        return await asyncio.wait_for(asyncio.gather(caller, return_exceptions=True), 1)
+
+    [result] = asyncio.run(react())
+    assert isinstance(result, asyncio.CancelledError)
+
+
+def test_errors_before_the_edit_reach_callers():
+    class BrokenMember(FakeMember):
+        @property
+        def roles(self) -> list:
+            raise RuntimeError()
+
+        @roles.setter
+        def roles(self, value: list) -> None:
+            pass
+
+    async def react():
+        coalescer = RoleChangeCoalescer(window=0.01)
+        return await asyncio.wait_for(coalescer.add_roles(BrokenMember([]), [GREEN]), 1)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(react())
@@ -0,0 +1,50 @@
+import time
+
+from koabot.core.ttlcache import MISSING, TTLCache
+
+
+def test_entries_expire(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    cache = TTLCache(ttl=10, negative_ttl=2)
+    cache.put(1, {'id': 1})
+    cache.put_missing(2)
+
+    assert cache.get(1) == {'id': 1}
+    assert cache.get(2) is MISSING
+
+    now += 5
+    assert 1 in cache
+    assert 2 not in cache
+    assert cache.get(2) is None
+
+    now += 10
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+def test_lru_eviction():
+    cache = TTLCache(max_entries=2)
+    cache.put(1, 'a')
+    cache.put(2, 'b')
+    cache.get(1)
+    cache.put(3, 'c')
+
+    assert cache.get(2) is None
+    assert cache.get(1) == 'a'
+    assert cache.get(3) == 'c'
+
+
+def test_hit_rate():
+    cache = TTLCache()
+    assert cache.hit_rate == 0
+
+    cache.put(1, 'a')
+    cache.put_missing(2)
+    cache.get(1)
+    cache.get(2)
+    cache.get(3)
+    cache.get(4, 'default')
+
+    assert (cache.hits, cache.negative_hits, cache.misses) == (1, 1, 2)
+    assert cache.hit_rate == 0.5